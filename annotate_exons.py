@@ -6,7 +6,14 @@ This script:
 2. Queries VariantValidator API for exon/intron positions using HGVS transcript
 3. Updates the database with PATCH requests (only for variants without existing exon/intron data)
 
-Rate Limit: VariantValidator recommends max 4 requests per second
+With --local-exons, the exon structure of each transcript is fetched once and cached on disk,
+and exon/intron numbers are computed locally (see exon_structures.py).
+
+With --gff, the exon structures come from a local RefSeq GFF3 instead (see refseq_gff.py) and
+VariantValidator is not used at all.
+
+Rate Limit: VariantValidator recommends max 4 requests per second (with --workers, a token
+bucket starts requests at that rate while several are in flight)
 
 Author: Nick Gleadall
 Date: November 2025
@@ -18,26 +25,53 @@ import pandas as pd
 import time
 import logging
 import argparse
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import quote
+
+from exon_structures import (DEFAULT_STRUCTURE_CACHE_PATH, ExonStructureCache, fetch_exon_structures,
+                             map_exonic_positions, map_genomic_positions)
+from http_client import (DEFAULT_POOL_MAXSIZE, RETRY_STATUS_CODES, TokenBucket, configure_session,
+                         disable_transport_retries, get_with_retries)
+from refseq_gff import open_exon_index
+from vv_cache import DEFAULT_CACHE_PATH, GENOME_BUILD, VariantValidatorCache, fetch_vv_release
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+VARIANTVALIDATOR_URL = "https://rest.variantvalidator.org/VariantValidator/variantvalidator/{build}/{variants}/{transcript}"
+
+# VariantValidator requests are retried per attempt under the rate limit, not by the transport
+VARIANTVALIDATOR_URL_PREFIX = "https://rest.variantvalidator.org/"
+
+# Descriptions per batched VariantValidator request (1 sends each variant on its own)
+DEFAULT_BATCH_SIZE = 1
+
+# Longest pipe-separated description list sent in one URL (URL-encoded characters)
+MAX_BATCH_URL_LENGTH = 1500
 
-def login(lead_url, email, password):
+# Requests per second recommended by VariantValidator (used by the worker pool)
+VV_RATE_LIMIT = 4
+
+
+def login(lead_url, email, password, pool_maxsize=DEFAULT_POOL_MAXSIZE):
     """
     Authenticate with the blood group database.
 
     :param lead_url: Base URL of the API
     :param email: User's email for authentication
     :param password: User's password for authentication
+    :param pool_maxsize: Maximum number of kept-alive connections per host
     :return: Authenticated session object
     """
     login_url = f"{lead_url}/auth/login"
     login_data = {"email": email, "password": password}
 
     try:
-        session = requests.Session()
+        # One session per run, shared by the database and VariantValidator requests
+        session = configure_session(requests.Session(), pool_maxsize=pool_maxsize)
+        disable_transport_retries(session, [VARIANTVALIDATOR_URL_PREFIX], pool_maxsize=pool_maxsize)
         login_response = session.post(login_url, json=login_data, timeout=30)
         login_response.raise_for_status()
         logger.info("Successfully logged in")
@@ -73,22 +107,428 @@ def get_variants(lead_url, session):
         raise
 
 
-def annotate_exons_introns(variants, session, lead_url, test_mode=True, overwrite_all=False, clear_not_found=False):
+def latest_exonic_positions(variant_exonic_positions):
+    """
+    Pick the exon/intron positions on the latest GRCh38 chromosome accession (highest NC_*.{version}).
+
+    :param variant_exonic_positions: VariantValidator variant_exonic_positions dict keyed by genomic accession
+    :return: Positions dict with start_exon, end_exon, start_intron and end_intron, or None
+    """
+    pos_data = None
+    latest_version = 0
+    for key in variant_exonic_positions.keys():
+        if key.startswith("NC"):
+            try:
+                version = int(key.split(".")[1])
+                if version > latest_version:
+                    latest_version = version
+                    pos_data = variant_exonic_positions[key]
+            except (IndexError, ValueError):
+                continue
+    return pos_data
+
+
+def format_exon_intron(pos_data):
+    """
+    Format exon and intron values from exon/intron positions.
+
+    :param pos_data: Dict with start_exon, end_exon, start_intron and end_intron (or None)
+    :return: Tuple of (exon value, intron value), e.g. ('3', None) or ('2-3', '2'); None where missing
+    """
+    pos_data = pos_data or {}
+    start_exon = pos_data.get("start_exon")
+    end_exon = pos_data.get("end_exon")
+    start_intron = pos_data.get("start_intron")
+    end_intron = pos_data.get("end_intron")
+    
+    new_exon_value = None
+    new_intron_value = None
+    
+    if start_exon and end_exon:
+        if start_exon == end_exon:
+            new_exon_value = str(start_exon)
+        else:
+            new_exon_value = f"{start_exon}-{end_exon}"
+    
+    if start_intron and end_intron:
+        if start_intron == end_intron:
+            new_intron_value = str(start_intron)
+        else:
+            new_intron_value = f"{start_intron}-{end_intron}"
+    
+    return new_exon_value, new_intron_value
+
+
+def exonic_positions_from_response(response_data, hgvs_transcript):
+    """
+    Extract the exon/intron positions of one variant from a VariantValidator response.
+
+    Entries are matched by the submitted description, so variants that VariantValidator
+    rewrites (e.g. c.100_102delCTG to c.100_102del) are still found.
+
+    :param response_data: Parsed JSON of a VariantValidator response (one or more variants)
+    :param hgvs_transcript: Submitted HGVS transcript description
+    :return: Tuple of (variant_exonic_positions dict or None, reason it wasn't found or None)
+    """
+    entry = response_data.get(hgvs_transcript)
+    if not isinstance(entry, dict):
+        entry = next((value for value in response_data.values()
+                      if isinstance(value, dict) and value.get("submitted_variant") == hgvs_transcript), None)
+    if entry is None:
+        return None, "HGVS transcript not in response"
+    
+    variant_exonic_positions = entry.get("variant_exonic_positions", {})
+    if not variant_exonic_positions:
+        return None, "No exonic positions found"
+    
+    return variant_exonic_positions, None
+
+
+def query_exonic_positions(hgvs_transcript, transcript, session, bucket=None):
+    """
+    Query VariantValidator for the exon/intron positions of one variant.
+
+    :param hgvs_transcript: HGVS transcript description
+    :param transcript: Transcript ID
+    :param session: Requests session object
+    :param bucket: Optional TokenBucket that every attempt takes a token from
+    :return: Tuple of (variant_exonic_positions dict or None, reason it wasn't found or None)
+    :raises requests.exceptions.RequestException: If the request fails
+    """
+    return query_exonic_positions_batch([hgvs_transcript], transcript, session, bucket)[hgvs_transcript]
+
+
+def query_exonic_positions_batch(descriptions, transcript, session, bucket=None):
+    """
+    Query VariantValidator for the exon/intron positions of several variants on one transcript.
+
+    The descriptions are sent pipe-separated in one request. If VariantValidator rejects
+    the whole batch, each description is queried on its own so one bad description
+    doesn't fail the others. Transient failures are retried here (see get_with_retries),
+    taking a bucket token per attempt.
+
+    :param descriptions: List of HGVS transcript descriptions
+    :param transcript: Transcript ID
+    :param session: Requests session object
+    :param bucket: Optional TokenBucket shared with other workers, taken before every attempt
+                   (default: 0.25s between fallback requests)
+    :return: Dict mapping each description to a (variant_exonic_positions dict or None, reason or None) tuple
+    :raises requests.exceptions.RequestException: If a request fails, or VariantValidator is
+                                                  rate limiting or unavailable (429 or 5xx)
+    """
+    vv_url = VARIANTVALIDATOR_URL.format(build=GENOME_BUILD, variants="|".join(descriptions), transcript=transcript)
+    response = get_with_retries(session, vv_url, bucket, timeout=30 + 5 * (len(descriptions) - 1))
+    
+    # A temporary failure is an error, not an answer that the variant wasn't found
+    if response.status_code in RETRY_STATUS_CODES:
+        response.raise_for_status()
+    if response.status_code != 200:
+        if len(descriptions) > 1:
+            logger.info(f"  → Batch of {len(descriptions)} rejected (status {response.status_code}), "
+                        f"querying one by one")
+            results = {}
+            for hgvs_transcript in descriptions:
+                if bucket is None:
+                    time.sleep(0.25)
+                results.update(query_exonic_positions_batch([hgvs_transcript], transcript, session, bucket))
+            return results
+        return {descriptions[0]: (None, f"Not found in VariantValidator (status {response.status_code})")}
+    
+    response_data = response.json()
+    return {hgvs_transcript: exonic_positions_from_response(response_data, hgvs_transcript)
+            for hgvs_transcript in descriptions}
+
+
+def batch_descriptions(descriptions, batch_size=DEFAULT_BATCH_SIZE, max_url_length=MAX_BATCH_URL_LENGTH):
+    """
+    Split the descriptions of one transcript into batches for query_exonic_positions_batch.
+
+    :param descriptions: List of HGVS transcript descriptions
+    :param batch_size: Maximum number of descriptions per request
+    :param max_url_length: Maximum length of the URL-encoded, pipe-separated descriptions
+    :return: List of lists of descriptions
+    """
+    batches = []
+    current = []
+    length = 0
+    for hgvs_transcript in descriptions:
+        encoded = len(quote(hgvs_transcript)) + len(quote("|"))
+        if current and (len(current) >= batch_size or length + encoded > max_url_length):
+            batches.append(current)
+            current = []
+            length = 0
+        current.append(hgvs_transcript)
+        length += encoded
+    if current:
+        batches.append(current)
+    return batches
+
+
+def prefetch_exonic_positions(descriptions, session, batch_size=DEFAULT_BATCH_SIZE, vv_cache=None, workers=1):
+    """
+    Query VariantValidator in batches for many variants, grouped by transcript.
+
+    :param descriptions: Iterable of HGVS transcript descriptions
+    :param session: Requests session object
+    :param batch_size: Maximum number of descriptions per request
+    :param vv_cache: Optional VariantValidatorCache that answers are stored in
+    :param workers: Number of concurrent requests (1 = sequential with a 0.25s delay)
+    :return: Dict mapping descriptions to (variant_exonic_positions dict or None, reason or None) tuples
+             (descriptions of failed requests are left out)
+    """
+    by_transcript = {}
+    for hgvs_transcript in dict.fromkeys(descriptions):
+        by_transcript.setdefault(hgvs_transcript.split(":")[0], []).append(hgvs_transcript)
+    
+    batches = [(transcript, batch) for transcript, transcript_descriptions in by_transcript.items()
+               for batch in batch_descriptions(transcript_descriptions, batch_size)]
+    logger.info(f"Querying VariantValidator for {sum(len(batch) for _, batch in batches)} variants "
+                f"in {len(batches)} batched requests")
+    
+    results = {}
+    
+    def record(i, transcript, batch, answers):
+        # The cache is written from this thread only (SQLite connections aren't shared)
+        if vv_cache is not None:
+            vv_cache.put_many(answers)
+        results.update(answers)
+        logger.info(f"  ✓ Batch {i}/{len(batches)}: {len(batch)} variants on {transcript}")
+    
+    if workers > 1:
+        bucket = TokenBucket(VV_RATE_LIMIT)
+        
+        def fetch(transcript, batch):
+            return query_exonic_positions_batch(batch, transcript, session, bucket)
+        
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(fetch, transcript, batch): (i, transcript, batch)
+                       for i, (transcript, batch) in enumerate(batches, start=1)}
+            for future in as_completed(futures):
+                i, transcript, batch = futures[future]
+                try:
+                    record(i, transcript, batch, future.result())
+                except requests.exceptions.Timeout:
+                    logger.error(f"  ✗ Batch {i}/{len(batches)} on {transcript}: Timeout")
+                except requests.exceptions.RequestException as e:
+                    logger.error(f"  ✗ Batch {i}/{len(batches)} on {transcript}: API Error: {str(e)[:100]}")
+                except Exception as e:
+                    logger.error(f"  ✗ Batch {i}/{len(batches)} on {transcript}: Unexpected error: {str(e)[:100]}")
+        return results
+    
+    for i, (transcript, batch) in enumerate(batches, start=1):
+        try:
+            record(i, transcript, batch, query_exonic_positions_batch(batch, transcript, session))
+        except requests.exceptions.Timeout:
+            logger.error(f"  ✗ Batch {i}/{len(batches)} on {transcript}: Timeout")
+        except requests.exceptions.RequestException as e:
+            logger.error(f"  ✗ Batch {i}/{len(batches)} on {transcript}: API Error: {str(e)[:100]}")
+        except Exception as e:
+            logger.error(f"  ✗ Batch {i}/{len(batches)} on {transcript}: Unexpected error: {str(e)[:100]}")
+        
+        # Rate limiting: VariantValidator recommends max 4 requests per second
+        time.sleep(0.25)
+    
+    return results
+
+
+def apply_exon_result(session, lead_url, row, pos_data, reason=None, test_mode=True, overwrite_all=False,
+                      clear_not_found=False):
+    """
+    Write the exon/intron result of one variant to the database.
+
+    :param session: Authenticated requests session
+    :param lead_url: Base URL of the API
+    :param row: Database variant row
+    :param pos_data: Exon/intron positions dict, or None if not found
+    :param reason: Why the variant wasn't found (logged when pos_data is None)
+    :param test_mode: If True, logs what would be updated without making PATCH requests
+    :param overwrite_all: If True, existing exon/intron data is being overwritten
+    :param clear_not_found: If True, clear existing exon/intron when not found (only with overwrite_all)
+    :return: 'updated', 'not_found', or 'cleared' (not found and existing exon/intron cleared)
+    :raises requests.exceptions.RequestException: If the database update fails
+    """
+    db_variant_id = row.get('id')
+    current_exon = row.get('exon')
+    current_intron = row.get('intron')
+    
+    new_exon_value, new_intron_value = format_exon_intron(pos_data)
+    
+    # Check if we found anything
+    if not new_exon_value and not new_intron_value:
+        logger.info(f"  → {reason or 'No exon or intron data found'}")
+        
+        # Clear existing exon/intron if clear_not_found flag is set
+        if clear_not_found and overwrite_all and (current_exon or current_intron):
+            logger.info(f"  → Clearing existing exon/intron: {current_exon}/{current_intron}")
+            if not test_mode:
+                update_url = f"{lead_url}/variant/{db_variant_id}"
+                clear_data = {"exon": None, "intron": None}
+                update_response = session.patch(update_url, json=clear_data, timeout=10)
+                update_response.raise_for_status()
+                logger.info(f"  ✓ Cleared exon/intron in database")
+            else:
+                logger.info(f"  ✓ TEST MODE: Would clear exon/intron")
+            return 'cleared'
+        return 'not_found'
+    
+    logger.info(f"  ✓ Found - Exon: {new_exon_value}, Intron: {new_intron_value}")
+    
+    # Update database with PATCH request
+    if not test_mode:
+        update_url = f"{lead_url}/variant/{db_variant_id}"
+        update_data = {}
+        if new_exon_value:
+            update_data["exon"] = new_exon_value
+        if new_intron_value:
+            update_data["intron"] = new_intron_value
+        
+        update_response = session.patch(update_url, json=update_data, timeout=10)
+        update_response.raise_for_status()
+        logger.info(f"  ✓ Updated in database")
+    else:
+        logger.info(f"  ✓ TEST MODE: Would update with exon={new_exon_value}, intron={new_intron_value}")
+    return 'updated'
+
+
+def load_exon_structures(transcripts, session, structure_cache=None):
+    """
+    Get the exon structures of transcripts, fetching the ones that aren't cached.
+
+    gene2transcripts returns every transcript of the gene, so one request usually covers
+    several of the transcripts. Transcripts it doesn't return are recorded in the cache as
+    not found and aren't requested again until the entry expires.
+
+    :param transcripts: Iterable of transcript IDs (with version)
+    :param session: Requests session object
+    :param structure_cache: Optional ExonStructureCache
+    :return: Dict mapping transcript IDs to structure dicts (transcripts that weren't found are left out)
+    """
+    transcripts = sorted(set(transcripts))
+    structures = structure_cache.get_many(transcripts) if structure_cache is not None else {}
+    not_found = structure_cache.get_not_found(set(transcripts) - set(structures)) if structure_cache is not None else set()
+    if structures or not_found:
+        logger.info(f"Exon structures: {len(structures)} of {len(transcripts)} transcripts cached"
+                    f"{f', {len(not_found)} known to have none' if not_found else ''}")
+    
+    for transcript in transcripts:
+        if transcript in structures or transcript in not_found:
+            continue
+        try:
+            fetched = fetch_exon_structures(transcript, session)
+        except requests.exceptions.RequestException as e:
+            logger.error(f"  ✗ {transcript}: exon structure API Error: {str(e)[:100]}")
+            continue
+        if structure_cache is not None and fetched:
+            structure_cache.put_many(fetched)
+        structures.update(fetched)
+        if transcript in fetched:
+            logger.info(f"  ✓ Fetched exon structure of {transcript} ({len(fetched[transcript]['exons'])} exons)")
+        else:
+            logger.warning(f"  ✗ No exon structure for {transcript}")
+            if structure_cache is not None:
+                structure_cache.put_not_found([transcript])
+        
+        # Rate limiting: VariantValidator recommends max 4 requests per second
+        time.sleep(0.25)
+    
+    return {transcript: structures[transcript] for transcript in transcripts if transcript in structures}
+
+
+def has_exon_intron(row):
+    """
+    Whether a database variant row already has exon or intron data.
+    """
+    current_exon = row.get('exon')
+    current_intron = row.get('intron')
+    return bool((not pd.isna(current_exon) and current_exon) or (not pd.isna(current_intron) and current_intron))
+
+
+def annotate_exons_introns(variants, session, lead_url, test_mode=True, overwrite_all=False, clear_not_found=False,
+                           local_structures=False, structure_cache=None, exon_index=None,
+                           batch_size=DEFAULT_BATCH_SIZE, vv_cache=None, workers=1):
     """
     Annotate variants with exon and intron numbers from VariantValidator.
 
+    With local_structures, the exon structure of each transcript is fetched once (see
+    exon_structures.py) and exon/intron numbers are computed locally. Variants whose
+    transcript has no structure, or whose description can't be mapped, are still sent
+    to VariantValidator one by one.
+
+    With an exon_index (see refseq_gff.py), exon/intron numbers are computed from the
+    hgvs_transcript description, or from the GRCh38 coordinates when the description can't
+    be mapped. Variants that can't be placed either way on a transcript of the index are
+    reported as not found; variants whose transcript (or version) isn't in the index are skipped.
+
+    With a batch_size above 1, the variants that need VariantValidator are queried before the
+    loop, several descriptions of the same transcript per request.
+
+    With a vv_cache (see vv_cache.py), answers already known for the current VariantValidator
+    release are replayed from disk, including negative ones, and new answers are stored.
+
+    With workers > 1, the variants are checked first and the remaining VariantValidator
+    lookups then run in a thread pool, started at 4 requests per second with several in
+    flight, and results are written to the database in the order they complete.
+
     :param variants: Pandas DataFrame containing variants to annotate
     :param session: Authenticated requests session
     :param lead_url: Base URL of the API
     :param test_mode: If True, logs what would be updated without making PATCH requests
     :param overwrite_all: If True, update all variants; if False, only update variants without exon/intron data
     :param clear_not_found: If True, clear existing exon/intron when not found in VariantValidator (only with overwrite_all)
+    :param local_structures: If True, compute exon/intron numbers from cached transcript exon structures
+    :param structure_cache: Optional ExonStructureCache for local_structures
+    :param exon_index: Optional exon index built from a RefSeq GFF3 (no VariantValidator requests are made)
+    :param batch_size: Maximum number of descriptions per VariantValidator request
+    :param vv_cache: Optional VariantValidatorCache of VariantValidator answers
+    :param workers: Number of concurrent VariantValidator requests (1 = sequential with a 0.25s delay)
     :return: Updated variants DataFrame
     """
-    updated_count = 0
     skipped_count = 0
-    not_found_count = 0
-    cleared_count = 0
+    
+    # Outcome counts ('updated', 'not_found', 'cleared', 'failed', 'local' for locally computed results,
+    # 'cached' for answers replayed from the VariantValidator cache and 'batch_failed' for variants of failed batches)
+    counts = Counter()
+    
+    # Exon/intron positions computed locally for the whole table in one pass, by index label
+    local_positions = {}
+    structures = {}
+    if local_structures or exon_index is not None:
+        transcripts = [str(hgvs).split(":")[0] for hgvs in variants['hgvs_transcript'].dropna() if hgvs]
+        if exon_index is not None:
+            structures = exon_index.get_many(transcripts)
+            logger.info(f"Exon index: {len(structures)} of {len(set(transcripts))} transcripts found")
+        else:
+            structures = load_exon_structures(transcripts, session, structure_cache)
+        mapped = map_exonic_positions(variants['hgvs_transcript'], structures)
+        local_positions = mapped.to_dict(orient='index')
+        if exon_index is not None:
+            unmapped = variants[~variants.index.isin(mapped.index)]
+            from_coordinates = map_genomic_positions(unmapped, structures).to_dict(orient='index')
+            local_positions.update(from_coordinates)
+            logger.info(f"Mapped {len(from_coordinates)} variants from their GRCh38 coordinates")
+        logger.info(f"Mapped {len(local_positions)} of {len(variants)} variants to exons/introns locally")
+    
+    # VariantValidator answers of the remaining variants known before the loop (cached, or
+    # fetched in batches) and received during it, by HGVS description
+    vv_answers = {}
+    cached_descriptions = set()
+    if exon_index is None and (vv_cache is not None or batch_size > 1):
+        pending = [row['hgvs_transcript'] for idx, row in variants.iterrows()
+                   if isinstance(row.get('hgvs_transcript'), str) and row['hgvs_transcript']
+                   and (overwrite_all or not has_exon_intron(row)) and idx not in local_positions]
+        if vv_cache is not None and pending:
+            vv_answers = vv_cache.get_many(pending)
+            cached_descriptions = set(vv_answers)
+            logger.info(f"VariantValidator cache: {len(vv_answers)} of {len(set(pending))} variants found in "
+                        f"{vv_cache.path} (release {vv_cache.release})")
+            pending = [hgvs_transcript for hgvs_transcript in pending if hgvs_transcript not in vv_answers]
+        if batch_size > 1 and pending:
+            vv_answers.update(prefetch_exonic_positions(pending, session, batch_size, vv_cache, workers))
+            # Variants of failed batches are queried on their own in the loop below
+            counts['batch_failed'] = len(set(pending) - set(vv_answers))
+    
+    # Rows waiting for a worker-pool lookup, by HGVS description
+    queued = {}
     
     for idx, row in variants.iterrows():
         # Get variant ID and HGVS transcript
@@ -107,7 +547,7 @@ def annotate_exons_introns(variants, session, lead_url, test_mode=True, overwrit
             continue
         
         # Skip if already has exon/intron data (unless overwrite_all is True)
-        if not overwrite_all and ((not pd.isna(current_exon) and current_exon) or (not pd.isna(current_intron) and current_intron)):
+        if not overwrite_all and has_exon_intron(row):
             logger.info(f"  ⊘ Skipping - already has exon/intron: {current_exon}/{current_intron}")
             skipped_count += 1
             continue
@@ -117,167 +557,144 @@ def annotate_exons_introns(variants, session, lead_url, test_mode=True, overwrit
             transcript = hgvs_transcript.split(":")[0]
         except Exception as e:
             logger.error(f"  ✗ Could not parse HGVS transcript: {hgvs_transcript}")
-            not_found_count += 1
+            counts['not_found'] += 1
             continue
         
-        # Query VariantValidator API
-        vv_url = f"https://rest.variantvalidator.org/VariantValidator/variantvalidator/GRCh38/{hgvs_transcript}/{transcript}"
+        # Use the exon/intron computed locally from the cached transcript structure
+        if idx in local_positions:
+            try:
+                outcome = apply_exon_result(session, lead_url, row, local_positions[idx], None,
+                                            test_mode, overwrite_all, clear_not_found)
+                counts[outcome] += 1
+                counts['local'] += 1
+            except requests.exceptions.RequestException as e:
+                logger.error(f"  ✗ API Error: {str(e)[:100]}")
+                counts['failed'] += 1
+            continue
+        if exon_index is not None:
+            # A transcript missing from the GFF3 (e.g. not in MANE) says nothing about the variant
+            if transcript not in structures:
+                logger.info(f"  ⊘ Skipping - {transcript} not in the exon index")
+                skipped_count += 1
+                continue
+            try:
+                outcome = apply_exon_result(session, lead_url, row, None, "Not placed on any exon or intron of the GFF3",
+                                            test_mode, overwrite_all, clear_not_found)
+                counts[outcome] += 1
+            except requests.exceptions.RequestException as e:
+                logger.error(f"  ✗ API Error: {str(e)[:100]}")
+                counts['failed'] += 1
+            continue
+        if hgvs_transcript in vv_answers:
+            positions, reason = vv_answers[hgvs_transcript]
+            pos_data = latest_exonic_positions(positions) if positions else None
+            try:
+                outcome = apply_exon_result(session, lead_url, row, pos_data, reason,
+                                            test_mode, overwrite_all, clear_not_found)
+                counts[outcome] += 1
+                if hgvs_transcript in cached_descriptions:
+                    counts['cached'] += 1
+            except requests.exceptions.RequestException as e:
+                logger.error(f"  ✗ API Error: {str(e)[:100]}")
+                counts['failed'] += 1
+            continue
+        if local_structures:
+            logger.info(f"  → Can't map {hgvs_transcript} locally, querying VariantValidator")
         
+        # In worker-pool mode, lookups run concurrently once every variant has been checked
+        if workers > 1:
+            queued.setdefault(hgvs_transcript, []).append(row)
+            continue
+        
+        # Query VariantValidator API
         try:
-            response = session.get(vv_url, timeout=30)
-            
-            if response.status_code != 200:
-                logger.info(f"  → Not found in VariantValidator (status {response.status_code})")
-                not_found_count += 1
-                
-                # Clear existing exon/intron if clear_not_found flag is set
-                if clear_not_found and overwrite_all and (current_exon or current_intron):
-                    logger.info(f"  → Clearing existing exon/intron: {current_exon}/{current_intron}")
-                    if not test_mode:
-                        update_url = f"{lead_url}/variant/{db_variant_id}"
-                        clear_data = {"exon": None, "intron": None}
-                        update_response = session.patch(update_url, json=clear_data, timeout=10)
-                        update_response.raise_for_status()
-                        logger.info(f"  ✓ Cleared exon/intron in database")
-                        cleared_count += 1
-                    else:
-                        logger.info(f"  ✓ TEST MODE: Would clear exon/intron")
-                        cleared_count += 1
-                continue
-            
-            response_data = response.json()
-            
-            if hgvs_transcript not in response_data:
-                logger.info(f"  → HGVS transcript not in response")
-                not_found_count += 1
-                
-                # Clear existing exon/intron if clear_not_found flag is set
-                if clear_not_found and overwrite_all and (current_exon or current_intron):
-                    logger.info(f"  → Clearing existing exon/intron: {current_exon}/{current_intron}")
-                    if not test_mode:
-                        update_url = f"{lead_url}/variant/{db_variant_id}"
-                        clear_data = {"exon": None, "intron": None}
-                        update_response = session.patch(update_url, json=clear_data, timeout=10)
-                        update_response.raise_for_status()
-                        logger.info(f"  ✓ Cleared exon/intron in database")
-                        cleared_count += 1
-                    else:
-                        logger.info(f"  ✓ TEST MODE: Would clear exon/intron")
-                        cleared_count += 1
-                continue
-            
-            variant_data = response_data[hgvs_transcript]
-            variant_exonic_positions = variant_data.get("variant_exonic_positions", {})
-            
-            if not variant_exonic_positions:
-                logger.info(f"  → No exonic positions found")
-                not_found_count += 1
-                
-                # Clear existing exon/intron if clear_not_found flag is set
-                if clear_not_found and overwrite_all and (current_exon or current_intron):
-                    logger.info(f"  → Clearing existing exon/intron: {current_exon}/{current_intron}")
-                    if not test_mode:
-                        update_url = f"{lead_url}/variant/{db_variant_id}"
-                        clear_data = {"exon": None, "intron": None}
-                        update_response = session.patch(update_url, json=clear_data, timeout=10)
-                        update_response.raise_for_status()
-                        logger.info(f"  ✓ Cleared exon/intron in database")
-                        cleared_count += 1
-                    else:
-                        logger.info(f"  ✓ TEST MODE: Would clear exon/intron")
-                        cleared_count += 1
-                continue
-            
-            # Get the latest GRCh38 version (highest NC_*.{version})
-            start_exon = None
-            end_exon = None
-            start_intron = None
-            end_intron = None
-            latest_version = 0
-            
-            for key in variant_exonic_positions.keys():
-                if key.startswith("NC"):
-                    try:
-                        version = int(key.split(".")[1])
-                        if version > latest_version:
-                            latest_version = version
-                            pos_data = variant_exonic_positions[key]
-                            start_exon = pos_data.get("start_exon")
-                            end_exon = pos_data.get("end_exon")
-                            start_intron = pos_data.get("start_intron")
-                            end_intron = pos_data.get("end_intron")
-                    except (IndexError, ValueError):
-                        continue
-            
-            # Format exon and intron values
-            new_exon_value = None
-            new_intron_value = None
-            
-            if start_exon and end_exon:
-                if start_exon == end_exon:
-                    new_exon_value = str(start_exon)
-                else:
-                    new_exon_value = f"{start_exon}-{end_exon}"
-            
-            if start_intron and end_intron:
-                if start_intron == end_intron:
-                    new_intron_value = str(start_intron)
-                else:
-                    new_intron_value = f"{start_intron}-{end_intron}"
-            
-            # Check if we found anything
-            if not new_exon_value and not new_intron_value:
-                logger.info(f"  → No exon or intron data found")
-                not_found_count += 1
-                
-                # Clear existing exon/intron if clear_not_found flag is set
-                if clear_not_found and overwrite_all and (current_exon or current_intron):
-                    logger.info(f"  → Clearing existing exon/intron: {current_exon}/{current_intron}")
-                    if not test_mode:
-                        update_url = f"{lead_url}/variant/{db_variant_id}"
-                        clear_data = {"exon": None, "intron": None}
-                        update_response = session.patch(update_url, json=clear_data, timeout=10)
-                        update_response.raise_for_status()
-                        logger.info(f"  ✓ Cleared exon/intron in database")
-                        cleared_count += 1
-                    else:
-                        logger.info(f"  ✓ TEST MODE: Would clear exon/intron")
-                        cleared_count += 1
-                continue
-            
-            logger.info(f"  ✓ Found - Exon: {new_exon_value}, Intron: {new_intron_value}")
-            
-            # Update database with PATCH request
-            if not test_mode:
-                update_url = f"{lead_url}/variant/{db_variant_id}"
-                update_data = {}
-                if new_exon_value:
-                    update_data["exon"] = new_exon_value
-                if new_intron_value:
-                    update_data["intron"] = new_intron_value
-                
-                update_response = session.patch(update_url, json=update_data, timeout=10)
-                update_response.raise_for_status()
-                logger.info(f"  ✓ Updated in database")
-                updated_count += 1
-            else:
-                logger.info(f"  ✓ TEST MODE: Would update with exon={new_exon_value}, intron={new_intron_value}")
-                updated_count += 1
+            positions, reason = query_exonic_positions(hgvs_transcript, transcript, session)
+            vv_answers[hgvs_transcript] = (positions, reason)
+            if vv_cache is not None:
+                vv_cache.put_many({hgvs_transcript: (positions, reason)})
+            pos_data = latest_exonic_positions(positions) if positions else None
+            outcome = apply_exon_result(session, lead_url, row, pos_data, reason,
+                                        test_mode, overwrite_all, clear_not_found)
+            counts[outcome] += 1
                 
         except requests.exceptions.Timeout:
             logger.error(f"  ✗ Timeout (30s)")
+            counts['failed'] += 1
         except requests.exceptions.RequestException as e:
             logger.error(f"  ✗ API Error: {str(e)[:100]}")
+            counts['failed'] += 1
         except Exception as e:
             logger.error(f"  ✗ Unexpected error: {str(e)[:100]}")
+            counts['failed'] += 1
         
         # Rate limiting: VariantValidator recommends max 4 requests per second
         time.sleep(0.25)
     
+    if queued:
+        logger.info(f"Querying VariantValidator for {len(queued)} unique HGVS descriptions with {workers} workers "
+                    f"({VV_RATE_LIMIT} requests/s)")
+        bucket = TokenBucket(VV_RATE_LIMIT)
+        
+        def lookup(hgvs_transcript):
+            return query_exonic_positions(hgvs_transcript, hgvs_transcript.split(":")[0], session, bucket)
+        
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(lookup, hgvs_transcript): hgvs_transcript for hgvs_transcript in queued}
+            # Results are written as they arrive, while the workers keep querying VariantValidator
+            for future in as_completed(futures):
+                hgvs_transcript = futures[future]
+                try:
+                    positions, reason = future.result()
+                except requests.exceptions.Timeout:
+                    logger.error(f"  ✗ {hgvs_transcript}: Timeout (30s)")
+                    counts['failed'] += len(queued[hgvs_transcript])
+                    continue
+                except requests.exceptions.RequestException as e:
+                    logger.error(f"  ✗ {hgvs_transcript}: API Error: {str(e)[:100]}")
+                    counts['failed'] += len(queued[hgvs_transcript])
+                    continue
+                except Exception as e:
+                    logger.error(f"  ✗ {hgvs_transcript}: Unexpected error: {str(e)[:100]}")
+                    counts['failed'] += len(queued[hgvs_transcript])
+                    continue
+                
+                # The cache is written from this thread only (SQLite connections aren't shared)
+                if vv_cache is not None:
+                    vv_cache.put_many({hgvs_transcript: (positions, reason)})
+                pos_data = latest_exonic_positions(positions) if positions else None
+                for row in queued[hgvs_transcript]:
+                    logger.info(f"Variant {row.get('id')}: {hgvs_transcript}")
+                    try:
+                        outcome = apply_exon_result(session, lead_url, row, pos_data, reason,
+                                                    test_mode, overwrite_all, clear_not_found)
+                        counts[outcome] += 1
+                    except requests.exceptions.Timeout:
+                        logger.error(f"  ✗ Timeout (10s)")
+                        counts['failed'] += 1
+                    except requests.exceptions.RequestException as e:
+                        logger.error(f"  ✗ API Error: {str(e)[:100]}")
+                        counts['failed'] += 1
+                    except Exception as e:
+                        logger.error(f"  ✗ Unexpected error: {str(e)[:100]}")
+                        counts['failed'] += 1
+    
+    updated_count = counts['updated']
+    not_found_count = counts['not_found'] + counts['cleared']
+    cleared_count = counts['cleared']
+    
     logger.info("=" * 80)
     summary = f"Summary: {updated_count} variants updated, {skipped_count} skipped, {not_found_count} not found"
     if clear_not_found and cleared_count > 0:
         summary += f", {cleared_count} exon/intron records cleared"
+    if counts['failed']:
+        summary += f", {counts['failed']} failed"
+    if counts['local']:
+        source = "the GFF3 exon index" if exon_index is not None else "cached exon structures"
+        summary += f" ({counts['local']} computed from {source})"
+    if counts['cached']:
+        summary += f" ({counts['cached']} replayed from the VariantValidator cache)"
+    if counts['batch_failed']:
+        summary += f" ({counts['batch_failed']} queried one by one after a failed batch)"
     logger.info(summary)
     logger.info("=" * 80)
     
@@ -308,6 +725,22 @@ Examples:
   
   # Use custom config file
   python annotate_exons.py --config my_config.json
+  
+  # Fetch each transcript's exon structure once and compute exon/intron numbers locally
+  python annotate_exons.py --local-exons --structure-cache exon_structures.sqlite
+  
+  # Offline - index a RefSeq GFF3 once, then number exons/introns without VariantValidator
+  python annotate_exons.py --gff GCF_000001405.40_GRCh38.p14_genomic.gff.gz
+  
+  # Send up to 10 variants of the same transcript per VariantValidator request
+  python annotate_exons.py --batch-size 10
+  
+  # Cache VariantValidator answers; reruns only query new or changed HGVS strings
+  python annotate_exons.py --cache-db
+  python annotate_exons.py --cache-db --overwrite-all --clear-not-found
+  
+  # Keep several VariantValidator requests in flight (still started at 4 per second)
+  python annotate_exons.py --workers 4
         """
     )
     parser.add_argument(
@@ -325,6 +758,55 @@ Examples:
         action='store_true',
         help='Clear existing exon/intron when not found in VariantValidator (only works with --overwrite-all)'
     )
+    parser.add_argument(
+        '--local-exons',
+        action='store_true',
+        help='Compute exon/intron numbers locally from each transcript\'s exon structure (fetched once per gene)'
+    )
+    parser.add_argument(
+        '--structure-cache',
+        default=DEFAULT_STRUCTURE_CACHE_PATH,
+        metavar='PATH',
+        help=f'SQLite file caching transcript exon structures for --local-exons (default: {DEFAULT_STRUCTURE_CACHE_PATH})'
+    )
+    parser.add_argument(
+        '--gff',
+        metavar='PATH',
+        help='RefSeq GFF3 (plain or gzipped) to compute exon/intron numbers offline, without VariantValidator; '
+             'indexed on first use'
+    )
+    parser.add_argument(
+        '--exon-index',
+        metavar='PATH',
+        help='Exon index built from the --gff file (default: next to the GFF3; can be used without --gff once built)'
+    )
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        default=DEFAULT_BATCH_SIZE,
+        metavar='N',
+        help=f'Variants of the same transcript sent per VariantValidator request, pipe-separated '
+             f'(default: {DEFAULT_BATCH_SIZE})'
+    )
+    parser.add_argument(
+        '--cache-db',
+        nargs='?',
+        const=DEFAULT_CACHE_PATH,
+        metavar='PATH',
+        help=f'Cache VariantValidator answers (including "not found") in a SQLite file (default path: {DEFAULT_CACHE_PATH})'
+    )
+    parser.add_argument(
+        '--vv-release',
+        metavar='LABEL',
+        help='VariantValidator release label to key cached answers by (default: read from VariantValidator)'
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=1,
+        help=f'Number of concurrent VariantValidator requests (default: 1, sequential); requests are started '
+             f'at no more than {VV_RATE_LIMIT}/s'
+    )
     parser.add_argument(
         '--limit',
         type=int,
@@ -380,6 +862,13 @@ Examples:
         logger.error("--clear-not-found requires --overwrite-all to be set")
         logger.error("Use: python annotate_exons.py --overwrite-all --clear-not-found")
         raise ValueError("--clear-not-found requires --overwrite-all")
+    if args.local_exons and (args.gff or args.exon_index):
+        logger.error("--local-exons and --gff/--exon-index are alternatives, use one of them")
+        raise ValueError("--local-exons can't be combined with --gff/--exon-index")
+    if args.batch_size < 1:
+        raise ValueError("--batch-size must be at least 1")
+    if args.workers < 1:
+        raise ValueError("--workers must be at least 1")
 
     try:
         # Authenticate and fetch variants
@@ -388,9 +877,19 @@ Examples:
         logger.info(f"Overwrite existing: {'YES' if args.overwrite_all else 'NO (only update variants without exon/intron data)'}")
         if args.clear_not_found:
             logger.info(f"Clear not found: YES (will clear exon/intron not found in VariantValidator)")
+        if args.local_exons:
+            logger.info(f"Local exons: YES (exon structures cached in {args.structure_cache})")
+        if args.gff or args.exon_index:
+            logger.info(f"Offline exons: YES (from {args.gff or args.exon_index}, no VariantValidator requests)")
+        if args.batch_size > 1:
+            logger.info(f"Batch size: {args.batch_size} variants per VariantValidator request")
+        if args.cache_db:
+            logger.info(f"VariantValidator cache: {args.cache_db}")
+        if args.workers > 1:
+            logger.info(f"Worker pool: YES ({args.workers} workers, {VV_RATE_LIMIT} requests/s)")
         
         logger.info(f"Connecting to: {lead_url}")
-        session = login(lead_url, email, password)
+        session = login(lead_url, email, password, pool_maxsize=max(DEFAULT_POOL_MAXSIZE, args.workers))
         
         logger.info("Fetching variants from database...")
         variants = get_variants(lead_url, session)
@@ -407,15 +906,44 @@ Examples:
         if args.limit:
             logger.info(f"Processing only first {args.limit} variants")
         
+        structure_cache = ExonStructureCache(args.structure_cache) if args.local_exons else None
+        exon_index = open_exon_index(args.gff, args.exon_index) if args.gff or args.exon_index else None
+        vv_cache = None
+        if args.cache_db and not exon_index:
+            vv_release = args.vv_release or fetch_vv_release(session)
+            vv_cache = VariantValidatorCache(args.cache_db, vv_release)
+            if vv_release:
+                logger.info(f"VariantValidator release: {vv_release}")
+            else:
+                latest_release = vv_cache.latest_release()
+                logger.warning("VariantValidator release unknown, cached answers won't be replayed or stored")
+                if latest_release:
+                    logger.warning(f"To replay the latest cached release, pass --vv-release '{latest_release}'")
+                vv_cache.close()
+                vv_cache = None
+        
         annotate_exons_introns(
             variants_to_process,
             session,
             lead_url,
             test_mode=args.test_mode,
             overwrite_all=args.overwrite_all,
-            clear_not_found=args.clear_not_found
+            clear_not_found=args.clear_not_found,
+            local_structures=args.local_exons,
+            structure_cache=structure_cache,
+            exon_index=exon_index,
+            batch_size=args.batch_size,
+            vv_cache=vv_cache,
+            workers=args.workers
         )
         
+        if structure_cache:
+            structure_cache.close()
+        if exon_index:
+            exon_index.close()
+        if vv_cache:
+            vv_cache.close()
+        
         logger.info("=" * 80)
         logger.info(f"ANNOTATION COMPLETE")
         logger.info("=" * 80)
@@ -17,11 +17,123 @@ import pandas as pd
 import time
 import logging
 import argparse
+import asyncio
+import functools
+import os
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from variant_regions import DEFAULT_MAX_SPAN, group_variants_by_locus, normalize_chromosome
+from vcf_index import read_regions
+from gnomad_cache import DEFAULT_CACHE_PATH, DEFAULT_NOT_FOUND_TTL_DAYS, GNOMAD_RELEASE, GnomadCache
+from population_matrix import PopulationMatrix
+from hgvs_genomic import fill_coordinates_from_hgvs
+from reference_genome import ReferenceGenome, normalize_variant
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# gnomAD v4 GraphQL API
+GNOMAD_API_URL = "https://gnomad.broadinstitute.org/api"
+GNOMAD_DATASET = "gnomad_r4"
+
+# Rate limiting: gnomAD allows 10 requests per 60 seconds
+GNOMAD_REQUEST_DELAY = 6.5
+
+# Pipelined mode starts requests on a fixed schedule instead: 10 per 60 seconds, measured from request start
+GNOMAD_RATE_LIMIT = 10
+GNOMAD_RATE_WINDOW = 60
+
+# Number of database PATCH requests the pipelined mode runs at the same time
+DEFAULT_PIPELINE_WORKERS = 4
+
+# Large variants (>1000 bp) often cause 413 Request Entity Too Large errors
+MAX_ALLELE_LENGTH = 1000
+
+# Batched queries are split so that each POST body stays below this size (bytes)
+DEFAULT_MAX_PAYLOAD_BYTES = 64 * 1024
+
+# gnomAD v4 genetic ancestry groups, as used in the sites VCF INFO fields (AC_<id>, AN_<id>)
+GNOMAD_V4_ANCESTRIES = ['afr', 'ami', 'amr', 'asj', 'eas', 'fin', 'mid', 'nfe', 'remaining', 'sas']
+
+# Population IDs read from sites VCFs - the same set the GraphQL API returns for gnomad_r4
+VCF_POPULATION_IDS = (
+    GNOMAD_V4_ANCESTRIES +
+    [f"{ancestry}_{sex}" for ancestry in GNOMAD_V4_ANCESTRIES for sex in ('XX', 'XY')] +
+    ['XX', 'XY']
+)
+
+# Padding (bp) around each locus when indexing offline VCFs, so nearby new variants reuse the index
+OFFLINE_INDEX_PADDING = 25000
+
+# Frequency changes (absolute MAF difference) at or below this are ignored in delta mode
+DEFAULT_DELTA_TOLERANCE = 1e-4
+
+# Which gnomAD data sets are combined into the annotated frequencies
+FREQUENCY_SOURCES = {
+    'joint': ('exome', 'genome'),
+    'exome': ('exome',),
+    'genome': ('genome',)
+}
+
+# gnomAD v4 superpopulation codes
+GNOMAD_POPULATIONS = [
+    'gnomad_all',   # All populations combined
+    'gnomad_afr',   # African/African American
+    'gnomad_amr',   # Admixed American
+    'gnomad_asj',   # Ashkenazi Jewish
+    'gnomad_eas',   # East Asian
+    'gnomad_fin',   # Finnish
+    'gnomad_nfe',   # Non-Finnish European
+    'gnomad_oth',   # Other (population not assigned)
+    'gnomad_sas'    # South Asian
+]
+
+# Fields requested for every variant - both exome and genome data are queried
+# Many coding variants are exome-only, which are reliable for blood group genes
+VARIANT_FIELDS = """
+            variant_id
+            exome {
+              af
+              populations {
+                id
+                ac
+                an
+              }
+            }
+            genome {
+              af
+              populations {
+                id
+                ac
+                an
+              }
+            }
+"""
+
+# Region variant lists only expose counts, which is all the MAF calculation needs
+REGION_VARIANT_FIELDS = """
+          variant_id
+          exome {
+            ac
+            an
+            populations {
+              id
+              ac
+              an
+            }
+          }
+          genome {
+            ac
+            an
+            populations {
+              id
+              ac
+              an
+            }
+          }
+"""
 
 
 def login(lead_url, email, password):
@@ -87,7 +199,742 @@ def calculate_maf(af):
     return af if af <= 0.5 else (1 - af)
 
 
-def annotate_gnomad_frequencies(variants, session, lead_url, test_mode=True, overwrite_all=False, clear_not_found=False):
+def get_gnomad_variant_id(row, reference=None):
+    """
+    Build the normalized gnomAD variant ID (chrom-pos-ref-alt) for a variant row.
+
+    The chromosome prefix is dropped and alleles are upper-cased, so rows that describe the
+    same GRCh38 change map to the same ID. With a reference genome, REF is also checked
+    against the reference and the variant is left-aligned and trimmed.
+
+    :param row: Variant row with GRCh38 coordinates
+    :param reference: Optional ReferenceGenome used to validate and normalize the variant
+    :return: Tuple of (gnomAD variant ID or None, reason the variant can't be queried or None)
+    """
+    chrom = row.get('grch38_chr')
+    pos = row.get('grch38_pos')
+    ref = row.get('grch38_ref')
+    alt = row.get('grch38_alt')
+
+    if pd.isna(chrom) or pd.isna(pos) or pd.isna(ref) or pd.isna(alt):
+        rsid = row.get('rsid')
+        if pd.notna(rsid) and rsid:
+            return None, f"Missing GRCh38 coordinates (has {rsid}, fill with annotate_rsid.py --fill-coordinates)"
+        return None, "Missing GRCh38 coordinates"
+
+    # Skip if REF or ALT alleles are too long (gnomAD API has size limits)
+    if len(str(ref)) > MAX_ALLELE_LENGTH or len(str(alt)) > MAX_ALLELE_LENGTH:
+        return None, f"REF or ALT allele too long (REF:{len(str(ref))} bp, ALT:{len(str(alt))} bp)"
+
+    pos = int(float(pos))
+    ref = str(ref).strip().upper()
+    alt = str(alt).strip().upper()
+
+    if reference is not None:
+        pos, ref, alt, error = normalize_variant(reference, chrom, pos, ref, alt)
+        if error:
+            return None, error
+
+    return f"{normalize_chromosome(chrom)}-{pos}-{ref}-{alt}", None
+
+
+def parse_gnomad_variant_id(gnomad_variant_id):
+    """
+    Split a gnomAD variant ID into its coordinates.
+
+    :param gnomad_variant_id: gnomAD variant ID (chrom-pos-ref-alt)
+    :return: Tuple of (chrom, pos, ref, alt)
+    """
+    chrom, pos, ref, alt = gnomad_variant_id.split('-', 3)
+    return chrom, int(pos), ref, alt
+
+
+def pending_coordinates(pending):
+    """
+    GRCh38 coordinates of pending lookups, as used for grouping them into loci.
+
+    Coordinates are taken from the (normalized) gnomAD variant IDs rather than the
+    database rows, so left-aligned variants are grouped by their normalized position.
+
+    :param pending: Dict mapping DataFrame index labels to gnomAD variant IDs
+    :return: Pandas DataFrame with grch38_chr, grch38_pos and grch38_ref columns
+    """
+    rows = {index: parse_gnomad_variant_id(gnomad_variant_id) for index, gnomad_variant_id in pending.items()}
+    return pd.DataFrame.from_dict(rows, orient='index', columns=['grch38_chr', 'grch38_pos', 'grch38_ref', 'grch38_alt'])
+
+
+def get_pending_lookups(variants, overwrite_all=False, reference=None):
+    """
+    Find the variants that need a gnomAD lookup.
+
+    :param variants: Pandas DataFrame containing variants with GRCh38 coordinates
+    :param overwrite_all: If True, include variants that already have gnomAD data
+    :param reference: Optional ReferenceGenome used to validate and normalize variants
+    :return: Dict mapping DataFrame index labels to gnomAD variant IDs
+    """
+    pending = {}
+    for index, row in variants.iterrows():
+        if not overwrite_all and pd.notna(row.get('gnomad_all')):
+            continue
+        gnomad_variant_id, _ = get_gnomad_variant_id(row, reference)
+        if gnomad_variant_id:
+            pending[index] = gnomad_variant_id
+    return pending
+
+
+def query_gnomad_variant(gnomad_variant_id, dataset_id=GNOMAD_DATASET):
+    """
+    Query the gnomAD GraphQL API for a single variant.
+
+    :param gnomad_variant_id: gnomAD variant ID (chrom-pos-ref-alt)
+    :param dataset_id: gnomAD dataset to query
+    :return: Variant data dict, or None if the variant is not found in gnomAD
+    """
+    query = """
+    query GnomadVariant($variantId: String!, $datasetId: DatasetId!) {
+      variant(variantId: $variantId, dataset: $datasetId) {%s}
+    }
+    """ % VARIANT_FIELDS
+
+    variables = {
+        "variantId": gnomad_variant_id,
+        "datasetId": dataset_id
+    }
+
+    response = requests.post(
+        GNOMAD_API_URL,
+        json={"query": query, "variables": variables},
+        headers={"Content-Type": "application/json"},
+        timeout=30
+    )
+    response.raise_for_status()
+    data = response.json()
+
+    # GraphQL errors are returned for variants that don't exist in gnomAD
+    if 'errors' in data:
+        logger.info(f"  → Not found in gnomAD (GraphQL error)")
+        return None
+
+    return (data.get('data') or {}).get('variant')
+
+
+def build_batch_query(gnomad_variant_ids, dataset_id=GNOMAD_DATASET):
+    """
+    Build a single GraphQL document that looks up several variants using field aliases.
+
+    Each variant is queried as alias ``v<i>`` with its ID passed as variable ``$v<i>``.
+
+    :param gnomad_variant_ids: List of gnomAD variant IDs
+    :param dataset_id: gnomAD dataset to query
+    :return: Request payload dict with "query" and "variables"
+    """
+    declarations = ["$datasetId: DatasetId!"]
+    selections = []
+    variables = {"datasetId": dataset_id}
+
+    for i, gnomad_variant_id in enumerate(gnomad_variant_ids):
+        declarations.append(f"$v{i}: String!")
+        selections.append(f"v{i}: variant(variantId: $v{i}, dataset: $datasetId) {{{VARIANT_FIELDS}}}")
+        variables[f"v{i}"] = gnomad_variant_id
+
+    query = f"query GnomadVariantBatch({', '.join(declarations)}) {{\n" + "\n".join(selections) + "\n}"
+    return {"query": query, "variables": variables}
+
+
+def payload_size(payload):
+    """
+    Size in bytes of a GraphQL payload once serialised for the POST body.
+    """
+    return len(json.dumps(payload).encode('utf-8'))
+
+
+def split_into_batches(gnomad_variant_ids, batch_size, max_payload_bytes, dataset_id=GNOMAD_DATASET):
+    """
+    Split variant IDs into batches of at most batch_size variants whose payload stays under max_payload_bytes.
+
+    A single variant is always placed in its own batch, even if it exceeds the payload limit on its own.
+
+    :param gnomad_variant_ids: List of gnomAD variant IDs
+    :param batch_size: Maximum number of variants per batch
+    :param max_payload_bytes: Maximum POST body size in bytes
+    :param dataset_id: gnomAD dataset to query
+    :return: List of lists of variant IDs
+    """
+    batches = []
+    current = []
+
+    for gnomad_variant_id in gnomad_variant_ids:
+        candidate = current + [gnomad_variant_id]
+        if current and (len(candidate) > batch_size or
+                        payload_size(build_batch_query(candidate, dataset_id)) > max_payload_bytes):
+            batches.append(current)
+            current = [gnomad_variant_id]
+        else:
+            current = candidate
+
+    if current:
+        batches.append(current)
+
+    return batches
+
+
+def query_gnomad_batch(gnomad_variant_ids, dataset_id=GNOMAD_DATASET):
+    """
+    Query the gnomAD GraphQL API for several variants in a single request.
+
+    :param gnomad_variant_ids: List of gnomAD variant IDs
+    :param dataset_id: gnomAD dataset to query
+    :return: Dict mapping each resolved variant ID to its variant data (None if not found in gnomAD)
+    """
+    response = requests.post(
+        GNOMAD_API_URL,
+        json=build_batch_query(gnomad_variant_ids, dataset_id),
+        headers={"Content-Type": "application/json"},
+        timeout=60
+    )
+    response.raise_for_status()
+    data = response.json()
+
+    # Per-variant errors null out only their own alias; if there is no data at all the
+    # whole document failed and none of the variants can be resolved from this response
+    batch_data = data.get('data')
+    if not batch_data:
+        errors = data.get('errors', [])
+        message = errors[0].get('message', '') if errors else 'empty response'
+        logger.error(f"  ✗ Batch query failed: {str(message)[:100]}")
+        return {}
+
+    results = {}
+    for i, gnomad_variant_id in enumerate(gnomad_variant_ids):
+        alias = f"v{i}"
+        if alias in batch_data:
+            results[gnomad_variant_id] = batch_data[alias]
+
+    return results
+
+
+def prefetch_gnomad_batches(gnomad_variant_ids, batch_size=25, max_payload_bytes=DEFAULT_MAX_PAYLOAD_BYTES,
+                            dataset_id=GNOMAD_DATASET):
+    """
+    Look up many variants using batched GraphQL queries.
+
+    Batches are sized to stay under max_payload_bytes. If gnomAD still responds with
+    413 Request Entity Too Large, the payload limit is halved and the batch is split again.
+    Every POST is followed by the standard rate-limit delay.
+
+    :param gnomad_variant_ids: List of gnomAD variant IDs
+    :param batch_size: Maximum number of variants per request
+    :param max_payload_bytes: Initial maximum POST body size in bytes
+    :param dataset_id: gnomAD dataset to query
+    :return: Dict mapping resolved variant IDs to variant data (None if not found in gnomAD).
+             Variants that could not be resolved (request errors) are left out.
+    """
+    unique_ids = list(dict.fromkeys(gnomad_variant_ids))
+    pending = split_into_batches(unique_ids, batch_size, max_payload_bytes, dataset_id)
+    results = {}
+    request_count = 0
+
+    logger.info(f"Batch mode: {len(unique_ids)} variants in {len(pending)} gnomAD requests")
+
+    while pending:
+        batch = pending.pop(0)
+        request_count += 1
+        logger.info(f"[batch {request_count}] Querying gnomAD API for {len(batch)} variants")
+
+        try:
+            batch_results = query_gnomad_batch(batch, dataset_id)
+            results.update(batch_results)
+            found = sum(1 for variant_data in batch_results.values() if variant_data)
+            logger.info(f"  ✓ {found} found, {len(batch_results) - found} not found in gnomAD")
+        except requests.exceptions.HTTPError as e:
+            if e.response is not None and e.response.status_code == 413:
+                if len(batch) > 1:
+                    max_payload_bytes = max(1, payload_size(build_batch_query(batch, dataset_id)) // 2)
+                    batch_size = max(1, len(batch) // 2)
+                    logger.warning(f"  ✗ Payload too large (413), reducing limit to {max_payload_bytes} bytes")
+                    pending = split_into_batches(batch, batch_size, max_payload_bytes, dataset_id) + pending
+                else:
+                    logger.warning(f"  ✗ Payload too large (413) for single variant {batch[0]}, skipping")
+            else:
+                logger.error(f"  ✗ API Error: {str(e)[:100]}")
+        except requests.exceptions.Timeout:
+            logger.error(f"  ✗ Timeout (60s)")
+        except requests.exceptions.RequestException as e:
+            logger.error(f"  ✗ API Error: {str(e)[:100]}")
+
+        # Rate limiting applies to every request, including failed ones
+        time.sleep(GNOMAD_REQUEST_DELAY)
+
+    return results
+
+
+def query_gnomad_region(chrom, start, stop, dataset_id=GNOMAD_DATASET):
+    """
+    Fetch every gnomAD variant in a GRCh38 region with its exome/genome population counts.
+
+    :param chrom: Chromosome (without 'chr' prefix)
+    :param start: Region start (1-based, inclusive)
+    :param stop: Region end (1-based, inclusive)
+    :param dataset_id: gnomAD dataset to query
+    :return: Dict mapping gnomAD variant ID to variant data
+    """
+    query = """
+    query GnomadRegion($chrom: String!, $start: Int!, $stop: Int!, $datasetId: DatasetId!) {
+      region(chrom: $chrom, start: $start, stop: $stop, reference_genome: GRCh38) {
+        variants(dataset: $datasetId) {%s}
+      }
+    }
+    """ % REGION_VARIANT_FIELDS
+
+    variables = {
+        "chrom": chrom,
+        "start": int(start),
+        "stop": int(stop),
+        "datasetId": dataset_id
+    }
+
+    response = requests.post(
+        GNOMAD_API_URL,
+        json={"query": query, "variables": variables},
+        headers={"Content-Type": "application/json"},
+        timeout=120
+    )
+    response.raise_for_status()
+    data = response.json()
+
+    region_data = (data.get('data') or {}).get('region')
+    if 'errors' in data or region_data is None:
+        errors = data.get('errors', [])
+        message = errors[0].get('message', '') if errors else 'no region data'
+        raise ValueError(f"Region query failed: {message}")
+
+    return {variant['variant_id']: variant for variant in region_data.get('variants') or []}
+
+
+def prefetch_gnomad_regions(pending, max_span=DEFAULT_MAX_SPAN, dataset_id=GNOMAD_DATASET):
+    """
+    Look up variants by fetching the full gnomAD variant list of each locus once.
+
+    The variants that need a lookup are grouped into loci of nearby positions and every
+    locus is fetched with a single region query. The returned variants form an in-memory
+    chrom-pos-ref-alt lookup table. Pending variants that fall inside a fetched region but
+    are missing from it are recorded as not found.
+
+    :param pending: Dict mapping DataFrame index labels to gnomAD variant IDs (see get_pending_lookups)
+    :param max_span: Maximum size (bp) of a region query
+    :param dataset_id: gnomAD dataset to query
+    :return: Dict mapping gnomAD variant IDs to variant data (None if not found in gnomAD)
+    """
+    loci = group_variants_by_locus(pending_coordinates(pending), max_span=max_span)
+    results = {}
+
+    logger.info(f"Region prefetch: {len(set(pending.values()))} variants in {len(loci)} gnomAD region requests")
+
+    for i, locus in enumerate(loci, start=1):
+        region = f"{locus['chrom']}:{locus['start']}-{locus['stop']}"
+        logger.info(f"[region {i}/{len(loci)}] Fetching gnomAD variants in {region}")
+
+        try:
+            region_variants = query_gnomad_region(locus['chrom'], locus['start'], locus['stop'], dataset_id)
+            results.update(region_variants)
+
+            # Region listings are complete, so anything not returned is not in gnomAD
+            locus_ids = {pending[index] for index in locus['index']}
+            missing = [gnomad_variant_id for gnomad_variant_id in locus_ids if gnomad_variant_id not in region_variants]
+            for gnomad_variant_id in missing:
+                results[gnomad_variant_id] = None
+
+            logger.info(f"  ✓ {len(region_variants)} gnomAD variants, {len(locus_ids) - len(missing)}/{len(locus_ids)} requested variants found")
+        except requests.exceptions.Timeout:
+            logger.error(f"  ✗ Timeout (120s)")
+        except (requests.exceptions.RequestException, ValueError) as e:
+            logger.error(f"  ✗ API Error: {str(e)[:100]}")
+
+        # Rate limiting applies to every request, including failed ones
+        time.sleep(GNOMAD_REQUEST_DELAY)
+
+    return results
+
+
+def parse_offline_vcf_sources(paths):
+    """
+    Work out whether each offline gnomAD VCF holds exome or genome data.
+
+    Paths can be given as 'exome:PATH' or 'genome:PATH'. Otherwise the source is taken
+    from the file name (e.g. gnomad.exomes.v4.1.sites.chr1.vcf.bgz).
+
+    :param paths: List of VCF paths
+    :return: List of (source, path) tuples, where source is 'exome' or 'genome'
+    :raises ValueError: If the source of a path can't be determined
+    """
+    sources = []
+    for path in paths:
+        prefix, _, rest = path.partition(':')
+        if prefix in ('exome', 'genome') and rest:
+            sources.append((prefix, rest))
+            continue
+
+        name = os.path.basename(path).lower()
+        if 'exome' in name:
+            sources.append(('exome', path))
+        elif 'genome' in name:
+            sources.append(('genome', path))
+        else:
+            raise ValueError(f"Can't tell if {path} is an exome or genome VCF, use exome:PATH or genome:PATH")
+    return sources
+
+
+def parse_gnomad_vcf_record(line, wanted_ids):
+    """
+    Parse a gnomAD sites VCF record into the same shape as the GraphQL exome/genome data.
+
+    :param line: VCF record line (bytes)
+    :param wanted_ids: Set of gnomAD variant IDs to parse; other records are ignored
+    :return: List of (gnomAD variant ID, {'ac', 'an', 'populations'}) tuples
+    """
+    fields = line.decode().split('\t', 8)
+    chrom, pos, _, ref, alts, _, _, info = fields[:8]
+    chrom = normalize_chromosome(chrom)
+
+    matches = [(i, f"{chrom}-{pos}-{ref}-{alt}") for i, alt in enumerate(alts.split(','))]
+    matches = [(i, gnomad_variant_id) for i, gnomad_variant_id in matches if gnomad_variant_id in wanted_ids]
+    if not matches:
+        return []
+
+    values = {}
+    for entry in info.split(';'):
+        key, _, value = entry.partition('=')
+        if key.startswith('AC') or key.startswith('AN'):
+            values[key] = value
+
+    def count(key, allele_index=0):
+        # AC fields have one value per ALT allele, AN fields a single value
+        value = values.get(key)
+        if value is None or value == '.':
+            return None
+        parts = value.split(',')
+        return int(parts[allele_index] if len(parts) > allele_index else parts[0])
+
+    records = []
+    for allele_index, gnomad_variant_id in matches:
+        populations = []
+        for pop_id in VCF_POPULATION_IDS:
+            ac = count(f"AC_{pop_id}", allele_index)
+            an = count(f"AN_{pop_id}")
+            if ac is not None and an is not None:
+                populations.append({'id': pop_id, 'ac': ac, 'an': an})
+
+        records.append((gnomad_variant_id, {
+            'ac': count('AC', allele_index),
+            'an': count('AN'),
+            'populations': populations
+        }))
+    return records
+
+
+def prefetch_gnomad_offline(pending, vcf_sources, index_dir=None):
+    """
+    Look up variants in local bgzipped gnomAD sites VCFs instead of the GraphQL API.
+
+    The variants are grouped by locus and only the records inside those loci are read,
+    using the persisted region index of each VCF (see vcf_index.py).
+
+    :param pending: Dict mapping DataFrame index labels to gnomAD variant IDs (see get_pending_lookups)
+    :param vcf_sources: List of (source, path) tuples (see parse_offline_vcf_sources)
+    :param index_dir: Directory for region index files (default: next to each VCF)
+    :return: Dict mapping gnomAD variant IDs to variant data (None if not found in gnomAD).
+             Variants in loci without any VCF records (e.g. missing chromosome files) are left out.
+    """
+    loci = group_variants_by_locus(pending_coordinates(pending), padding=OFFLINE_INDEX_PADDING)
+    wanted_ids = set(pending.values())
+    results = {}
+    covered = set()
+
+    logger.info(f"Offline mode: {len(wanted_ids)} variants in {len(loci)} loci from {len(vcf_sources)} VCFs")
+
+    for source, path in vcf_sources:
+        logger.info(f"Reading {source} VCF: {path}")
+        for locus_number, (locus, lines) in enumerate(read_regions(path, loci, index_dir)):
+            if lines:
+                covered.add(locus_number)
+            for line in lines:
+                for gnomad_variant_id, source_data in parse_gnomad_vcf_record(line, wanted_ids):
+                    if gnomad_variant_id not in results:
+                        results[gnomad_variant_id] = {'variant_id': gnomad_variant_id, 'exome': None, 'genome': None}
+                    results[gnomad_variant_id][source] = source_data
+
+    for locus_number, locus in enumerate(loci):
+        region = f"{locus['chrom']}:{locus['start']}-{locus['stop']}"
+        if locus_number not in covered:
+            logger.warning(f"  ✗ No VCF records in {region} - is the VCF for chromosome {locus['chrom']} missing?")
+            continue
+        for index in locus['index']:
+            results.setdefault(pending[index], None)
+
+    found = sum(1 for variant_data in results.values() if variant_data)
+    logger.info(f"  ✓ {found} variants found in offline gnomAD VCFs")
+    return results
+
+
+def combine_populations(variant_data, sources=FREQUENCY_SOURCES['joint']):
+    """
+    Combine exome and genome population counts for a gnomAD variant.
+
+    gnomAD v4.1 provides joint allele numbers - when a variant is in both datasets,
+    combined frequencies are calculated by summing AC and AN across both.
+    Sex-specific and sub-population entries (those with ':' or '_XX'/'_XY') are skipped.
+
+    :param variant_data: Variant data dict from the gnomAD API
+    :param sources: gnomAD data sets to combine ('exome' and/or 'genome')
+    :return: Dict mapping population ID to {'ac': int, 'an': int}
+    """
+    combined_pops = {}
+
+    for source in sources:
+        source_data = variant_data.get(source)
+        if not source_data:
+            continue
+        for pop in source_data.get('populations', []):
+            pop_id = pop['id']
+            if ':' in pop_id or '_XX' in pop_id or '_XY' in pop_id:
+                continue
+            if pop_id not in combined_pops:
+                combined_pops[pop_id] = {'ac': 0, 'an': 0}
+            combined_pops[pop_id]['ac'] += pop.get('ac', 0)
+            combined_pops[pop_id]['an'] += pop.get('an', 0)
+
+    return combined_pops
+
+
+def calculate_gnomad_frequencies(combined_pops):
+    """
+    Calculate MAF values for the database gnomAD fields from combined population counts.
+
+    :param combined_pops: Dict mapping population ID to {'ac': int, 'an': int}
+    :return: Dict mapping database gnomAD fields to MAF values
+    """
+    # Calculate MAF for each population from combined AC/AN
+    # This gives us joint exome+genome frequencies as recommended by gnomAD v4.1
+    pop_mafs = {}
+    for pop_id, counts in combined_pops.items():
+        ac = counts['ac']
+        an = counts['an']
+
+        if an > 0:
+            af = ac / an
+            pop_mafs[pop_id] = calculate_maf(af)
+        else:
+            pop_mafs[pop_id] = None
+
+    # Calculate overall MAF from combined AC/AN across all populations
+    # This ensures we always use joint exome+genome frequencies
+    total_ac = sum(counts['ac'] for counts in combined_pops.values() if counts['an'] > 0)
+    total_an = sum(counts['an'] for counts in combined_pops.values() if counts['an'] > 0)
+    overall_af = total_ac / total_an if total_an > 0 else None
+    overall_maf = calculate_maf(overall_af)
+
+    # Map gnomAD population IDs to database fields
+    # Note: gnomAD v4 uses 'remaining' for "Other" population
+    # Use explicit None check to preserve 0 values (0 is a valid MAF)
+    remaining_maf = pop_mafs.get('remaining')
+    return {
+        'gnomad_all': overall_maf,
+        'gnomad_afr': pop_mafs.get('afr'),
+        'gnomad_amr': pop_mafs.get('amr'),
+        'gnomad_asj': pop_mafs.get('asj'),
+        'gnomad_eas': pop_mafs.get('eas'),
+        'gnomad_fin': pop_mafs.get('fin'),
+        'gnomad_nfe': pop_mafs.get('nfe'),
+        'gnomad_oth': remaining_maf if remaining_maf is not None else pop_mafs.get('oth'),  # gnomAD v4 uses 'remaining'
+        'gnomad_sas': pop_mafs.get('sas')
+    }
+
+
+def clear_gnomad_frequencies(session, lead_url, db_variant_id, test_mode=True):
+    """
+    Clear all gnomAD frequency fields for a variant in the database.
+
+    :param session: Authenticated session for database updates
+    :param lead_url: Base URL of the API
+    :param db_variant_id: Database ID of the variant
+    :param test_mode: If True, logs what would be cleared without making PATCH requests
+    """
+    logger.info(f"  → Clearing existing gnomAD frequencies")
+    if not test_mode:
+        update_url = f"{lead_url}/variant/{db_variant_id}"
+        clear_data = {pop: None for pop in GNOMAD_POPULATIONS}
+        update_response = session.patch(update_url, json=clear_data, timeout=10)
+        update_response.raise_for_status()
+        logger.info(f"  ✓ Cleared gnomAD data in database")
+    else:
+        logger.info(f"  ✓ TEST MODE: Would clear gnomAD data")
+
+
+def apply_gnomad_result(session, lead_url, row, variant_data, gnomad_freqs=None, sources=FREQUENCY_SOURCES['joint'],
+                        test_mode=True, overwrite_all=False, clear_not_found=False):
+    """
+    Write the gnomAD result of one variant to the database.
+
+    :param session: Authenticated session for database updates
+    :param lead_url: Base URL of the API
+    :param row: Database variant row
+    :param variant_data: gnomAD variant data, or None if the variant is not found in gnomAD
+    :param gnomad_freqs: Precomputed database gnomAD fields (computed from variant_data if None)
+    :param sources: gnomAD data sets to combine
+    :param test_mode: If True, logs what would be updated without making PATCH requests
+    :param overwrite_all: If True, existing gnomAD data is being overwritten
+    :param clear_not_found: If True, clear existing gnomAD data when not found in gnomAD (only with overwrite_all)
+    :return: 'updated', 'not_found', or 'cleared' (not found and existing data cleared)
+    :raises requests.exceptions.RequestException: If the database update fails
+    """
+    db_variant_id = row.get('id')
+
+    # Extract exome and genome data from GraphQL response
+    exome_data = variant_data.get('exome') if variant_data and 'exome' in sources else None
+    genome_data = variant_data.get('genome') if variant_data and 'genome' in sources else None
+
+    # Check if variant exists in gnomAD and has any data (exome or genome)
+    if not exome_data and not genome_data:
+        if variant_data:
+            logger.info(f"  → Found but no exome or genome data available")
+        else:
+            logger.info(f"  → Not found in gnomAD")
+
+        # Clear existing gnomAD data if clear_not_found flag is set
+        if clear_not_found and overwrite_all and pd.notna(row.get('gnomad_all')):
+            clear_gnomad_frequencies(session, lead_url, db_variant_id, test_mode)
+            return 'cleared'
+        return 'not_found'
+
+    # Determine data source for logging
+    data_source = []
+    if exome_data:
+        data_source.append('exome')
+    if genome_data:
+        data_source.append('genome')
+    data_source_str = '+'.join(data_source)
+
+    if gnomad_freqs is None:
+        gnomad_freqs = calculate_gnomad_frequencies(combine_populations(variant_data, sources))
+    overall_maf = gnomad_freqs['gnomad_all']
+    maf_str = f"{overall_maf:.6f}" if overall_maf is not None else "n/a"
+    logger.info(f"  ✓ Found in gnomAD [{data_source_str}] (MAF: {maf_str})")
+
+    # Update database with PATCH request (only gnomAD fields)
+    if not test_mode:
+        update_url = f"{lead_url}/variant/{db_variant_id}"
+        update_response = session.patch(update_url, json=gnomad_freqs)
+        update_response.raise_for_status()
+        logger.info(f"  ✓ Updated in database")
+    else:
+        logger.info(f"  ✓ TEST MODE: Would update with MAF data")
+    return 'updated'
+
+
+async def run_gnomad_pipeline(rows_by_id, prefetched, prefetched_freqs, session, lead_url, test_mode=True,
+                              overwrite_all=False, clear_not_found=False, sources=FREQUENCY_SOURCES['joint'],
+                              cache=None, received=None, workers=DEFAULT_PIPELINE_WORKERS):
+    """
+    Look up gnomAD results and write them to the database with queries and updates overlapping.
+
+    gnomAD queries start on a fixed schedule of GNOMAD_RATE_LIMIT per GNOMAD_RATE_WINDOW
+    seconds, measured from request start, so response parsing and PATCH latency no longer
+    stretch each cycle. Every result is written to its database variants on separate tasks
+    while the next query waits for its slot. Variants that are already in prefetched are
+    written straight away.
+
+    The blocking requests calls run in thread pools; cache writes stay on the event loop
+    thread, since SQLite connections can't be shared between threads.
+
+    :param rows_by_id: Dict mapping gnomAD variant IDs to lists of database variant rows
+    :param prefetched: Dict of known results keyed by gnomAD variant ID (None = not found); updated with new results
+    :param prefetched_freqs: Dict of precomputed database gnomAD fields keyed by gnomAD variant ID
+    :param session: Authenticated session for database updates
+    :param lead_url: Base URL of the API
+    :param test_mode: If True, logs what would be updated without making PATCH requests
+    :param overwrite_all: If True, existing gnomAD data is being overwritten
+    :param clear_not_found: If True, clear existing gnomAD data when not found in gnomAD (only with overwrite_all)
+    :param sources: gnomAD data sets to combine
+    :param cache: GnomadCache for raw population counts (None to disable caching)
+    :param received: Dict collecting the variant data of every found variant (for export_matrix)
+    :param workers: Number of concurrent database updates
+    :return: Counter of outcomes per database variant ('updated', 'not_found', 'cleared', 'failed')
+    """
+    loop = asyncio.get_running_loop()
+    outcomes = Counter()
+    interval = GNOMAD_RATE_WINDOW / GNOMAD_RATE_LIMIT
+
+    def write_variant(row, gnomad_variant_id, variant_data):
+        logger.info(f"Variant {row.get('id')} ({gnomad_variant_id})")
+        return apply_gnomad_result(session, lead_url, row, variant_data, prefetched_freqs.get(gnomad_variant_id),
+                                   sources, test_mode, overwrite_all, clear_not_found)
+
+    with ThreadPoolExecutor(max_workers=GNOMAD_RATE_LIMIT) as query_executor, \
+            ThreadPoolExecutor(max_workers=workers) as patch_executor:
+
+        async def write_rows(gnomad_variant_id, variant_data):
+            async def write_row(row):
+                try:
+                    outcome = await loop.run_in_executor(
+                        patch_executor, functools.partial(write_variant, row, gnomad_variant_id, variant_data)
+                    )
+                    outcomes[outcome] += 1
+                except requests.exceptions.RequestException as e:
+                    logger.error(f"  ✗ Variant {row.get('id')}: API Error: {str(e)[:100]}")
+                    outcomes['failed'] += 1
+
+            await asyncio.gather(*(write_row(row) for row in rows_by_id[gnomad_variant_id]))
+
+        async def lookup(gnomad_variant_id):
+            try:
+                variant_data = await loop.run_in_executor(query_executor, query_gnomad_variant, gnomad_variant_id)
+            except requests.exceptions.Timeout:
+                logger.error(f"  ✗ {gnomad_variant_id}: Timeout (30s)")
+                outcomes['failed'] += len(rows_by_id[gnomad_variant_id])
+                return
+            except requests.exceptions.RequestException as e:
+                logger.error(f"  ✗ {gnomad_variant_id}: API Error: {str(e)[:100]}")
+                outcomes['failed'] += len(rows_by_id[gnomad_variant_id])
+                return
+
+            if cache and variant_data:
+                cache.put_many({gnomad_variant_id: variant_data})
+            elif cache:
+                cache.put_not_found([gnomad_variant_id])
+            prefetched[gnomad_variant_id] = variant_data
+            if variant_data and received is not None:
+                received[gnomad_variant_id] = variant_data
+
+            await write_rows(gnomad_variant_id, variant_data)
+
+        tasks = [
+            asyncio.create_task(write_rows(gnomad_variant_id, prefetched[gnomad_variant_id]))
+            for gnomad_variant_id in rows_by_id if gnomad_variant_id in prefetched
+        ]
+
+        to_query = [gnomad_variant_id for gnomad_variant_id in rows_by_id if gnomad_variant_id not in prefetched]
+        if to_query:
+            logger.info(f"Pipeline: querying {len(to_query)} variants, one request every {interval:.1f}s")
+
+        start = loop.time()
+        for i, gnomad_variant_id in enumerate(to_query):
+            # Request i starts exactly i intervals after the first, however long earlier ones took
+            await asyncio.sleep(max(0, start + i * interval - loop.time()))
+            logger.info(f"→ Querying gnomAD API: {gnomad_variant_id} ({i + 1}/{len(to_query)})")
+            tasks.append(asyncio.create_task(lookup(gnomad_variant_id)))
+
+        await asyncio.gather(*tasks)
+
+    return outcomes
+
+
+def annotate_gnomad_frequencies(variants, session, lead_url, test_mode=True, overwrite_all=False, clear_not_found=False,
+                                batch_size=None, max_payload_bytes=DEFAULT_MAX_PAYLOAD_BYTES,
+                                prefetch_regions=False, max_region_span=DEFAULT_MAX_SPAN,
+                                offline_vcfs=None, offline_index_dir=None,
+                                cache=None, refresh_cache=False, cache_only=False, frequency_sources='joint',
+                                not_found_ttl_days=DEFAULT_NOT_FOUND_TTL_DAYS, export_matrix=None, reference=None,
+                                pipeline=False, pipeline_workers=DEFAULT_PIPELINE_WORKERS):
     """
     Fetch gnomAD v4 frequencies for variants using GRCh38 coordinates and update the database.
     
@@ -98,34 +945,129 @@ def annotate_gnomad_frequencies(variants, session, lead_url, test_mode=True, ove
     
     Updates are made via PATCH requests containing only gnomAD frequency fields.
 
+    Rows with the same normalized gnomAD variant ID (e.g. one change attached to several
+    alleles) share a single lookup, and the result is applied to every matching row.
+
+    With a reference genome, REF is checked against GRCh38 and variants are left-aligned and
+    trimmed before any lookup; variants that can't be valid are skipped without a request.
+
+    In batch mode (batch_size set), lookups for all variants that need annotating are packed
+    into aliased multi-variant GraphQL queries first, and each result is then applied to its
+    database variant. Variants the batches could not resolve fall back to single queries.
+
+    With prefetch_regions, the variants are grouped by locus and each locus's full gnomAD
+    variant list is fetched once; every per-variant lookup is then answered from that table.
+
+    With offline_vcfs, lookups are answered from local gnomAD sites VCFs and the gnomAD API
+    is never queried.
+
+    With a cache, the raw exome/genome population counts of every variant received from
+    gnomAD are stored on disk, and cached variants are recomputed locally on later runs.
+    Variants gnomAD reported as not found for the cache's release are skipped until the
+    entry is older than not_found_ttl_days.
+
+    Frequencies of all prefetched or cached variants are computed together in one vectorized
+    pass (see population_matrix.py) before the per-variant loop.
+
+    With pipeline, the per-variant loop only decides which variants need writing; gnomAD queries
+    then run on a fixed 10-per-60-seconds schedule while database updates happen concurrently
+    (see run_gnomad_pipeline).
+
     :param variants: Pandas DataFrame containing variants with GRCh38 coordinates
     :param session: Authenticated session for database updates
     :param lead_url: Base URL of the API
     :param test_mode: If True, logs what would be updated without making PATCH requests
     :param overwrite_all: If True, updates all variants even if they have existing gnomAD data
     :param clear_not_found: If True, clear existing gnomAD data when not found in gnomAD (only with overwrite_all)
+    :param batch_size: If set, query gnomAD for up to this many variants per request
+    :param max_payload_bytes: Maximum POST body size for batched queries
+    :param prefetch_regions: If True, fetch gnomAD variants per locus before annotating
+    :param max_region_span: Maximum size (bp) of a prefetched region
+    :param offline_vcfs: List of (source, path) tuples of local gnomAD sites VCFs (see parse_offline_vcf_sources)
+    :param offline_index_dir: Directory for offline VCF region index files (default: next to each VCF)
+    :param cache: GnomadCache for raw population counts (None to disable caching)
+    :param refresh_cache: If True, re-query gnomAD for cached variants and update the cache
+    :param cache_only: If True, only annotate from the cache and never query gnomAD
+    :param frequency_sources: 'joint' (exome+genome), 'exome' or 'genome' frequencies
+    :param not_found_ttl_days: Days before a cached "not found" result is queried again (None for no expiry)
+    :param export_matrix: If set, write the per-population AC/AN of every annotated variant to this CSV file
+    :param reference: Optional ReferenceGenome used to validate and normalize variants before lookups
+    :param pipeline: If True, overlap rate-limited gnomAD queries with concurrent database updates
+    :param pipeline_workers: Number of concurrent database updates in pipeline mode
     :return: Pandas DataFrame (unchanged)
     """
-    # gnomAD v4 superpopulation codes
-    gnomad_populations = [
-        'gnomad_all',   # All populations combined
-        'gnomad_afr',   # African/African American
-        'gnomad_amr',   # Admixed American
-        'gnomad_asj',   # Ashkenazi Jewish
-        'gnomad_eas',   # East Asian
-        'gnomad_fin',   # Finnish
-        'gnomad_nfe',   # Non-Finnish European
-        'gnomad_oth',   # Other (population not assigned)
-        'gnomad_sas'    # South Asian
-    ]
-    
     updated_count = 0
     skipped_count = 0
     not_found_count = 0
     cleared_count = 0
+    failed_count = 0
     processed_count = 0
 
     total_variants = len(variants)
+
+    sources = FREQUENCY_SOURCES[frequency_sources]
+
+    # Results that are already known, keyed by gnomAD variant ID (None = not found in gnomAD)
+    prefetched = {}
+
+    # Results received from gnomAD during this run (written to the cache)
+    fetched = {}
+
+    # Frequencies computed in one vectorized pass for all prefetched variants
+    prefetched_freqs = {}
+
+    # Variant data of every variant used during this run (for export_matrix)
+    received = {}
+
+    # gnomAD variant IDs whose lookup failed during this run
+    failed_lookups = set()
+
+    # Rows left to the pipeline, keyed by gnomAD variant ID
+    pipelined = {}
+
+    # Rows sharing the same coordinates are looked up once and the result applied to each of them
+    pending = get_pending_lookups(variants, overwrite_all, reference)
+    lookup_ids = set(pending.values())
+    if len(lookup_ids) < len(pending):
+        logger.info(f"Deduplication: {len(pending)} variants share {len(lookup_ids)} unique gnomAD variant IDs")
+
+    if cache or offline_vcfs or prefetch_regions or batch_size:
+        if cache and not refresh_cache and pending:
+            cached = cache.get_many(pending.values())
+            prefetched.update(cached)
+            logger.info(f"Cache: {len(cached)} of {len(set(pending.values()))} variants found in {cache.path} (release {cache.release})")
+            pending = {index: gnomad_variant_id for index, gnomad_variant_id in pending.items() if gnomad_variant_id not in cached}
+
+            known_not_found = cache.get_not_found(pending.values(), not_found_ttl_days)
+            if known_not_found:
+                prefetched.update({gnomad_variant_id: None for gnomad_variant_id in known_not_found})
+                logger.info(f"Cache: {len(known_not_found)} variants already known to be absent from gnomAD, skipping lookups")
+                pending = {index: gnomad_variant_id for index, gnomad_variant_id in pending.items() if gnomad_variant_id not in known_not_found}
+
+        if cache_only:
+            pending = {}
+
+        if offline_vcfs:
+            if pending:
+                fetched.update(prefetch_gnomad_offline(pending, offline_vcfs, offline_index_dir))
+        else:
+            if prefetch_regions and pending:
+                fetched.update(prefetch_gnomad_regions(pending, max_region_span))
+
+            if batch_size:
+                pending_ids = [gnomad_variant_id for gnomad_variant_id in pending.values() if gnomad_variant_id not in fetched]
+                fetched.update(prefetch_gnomad_batches(pending_ids, batch_size, max_payload_bytes))
+
+        prefetched.update(fetched)
+        if cache and fetched:
+            cache.put_many(fetched)
+            cache.put_not_found([gnomad_variant_id for gnomad_variant_id, variant_data in fetched.items() if variant_data is None])
+
+        matrix = PopulationMatrix.from_variant_data({
+            gnomad_variant_id: prefetched[gnomad_variant_id]
+            for gnomad_variant_id in lookup_ids if gnomad_variant_id in prefetched
+        })
+        prefetched_freqs = matrix.gnomad_frequencies(sources)
     
     for index, row in variants.iterrows():
         processed_count += 1
@@ -140,246 +1082,244 @@ def annotate_gnomad_frequencies(variants, session, lead_url, test_mode=True, ove
             continue
         
         # Use GRCh38/hg38 coordinates
-        chrom = row.get('grch38_chr')
-        pos = row.get('grch38_pos')
-        ref = row.get('grch38_ref')
-        alt = row.get('grch38_alt')
-        
-        # Skip if any required field is missing
-        if pd.isna(chrom) or pd.isna(pos) or pd.isna(ref) or pd.isna(alt):
-            logger.warning(f"  → Missing GRCh38 coordinates, skipping")
+        gnomad_variant_id, skip_reason = get_gnomad_variant_id(row, reference)
+        if skip_reason:
+            logger.warning(f"  → {skip_reason}, skipping")
             skipped_count += 1
             continue
-        
-        # Skip if REF or ALT alleles are too long (gnomAD API has size limits)
-        # Large variants (>1000 bp) often cause 413 Request Entity Too Large errors
-        max_allele_length = 1000
-        if len(str(ref)) > max_allele_length or len(str(alt)) > max_allele_length:
-            logger.warning(f"  → REF or ALT allele too long (REF:{len(str(ref))} bp, ALT:{len(str(alt))} bp), skipping")
+
+        queried = gnomad_variant_id not in prefetched
+
+        if queried and offline_vcfs:
+            logger.warning(f"  → Not covered by offline gnomAD VCFs, skipping")
             skipped_count += 1
             continue
 
-        # gnomAD v4 GraphQL API
-        gnomad_api_url = "https://gnomad.broadinstitute.org/api"
-        gnomad_variant_id = f"{chrom}-{pos}-{ref}-{alt}"  # gnomAD variant ID format
-        
-        # GraphQL query for gnomAD v4.1
-        # Query both exome and genome data - will combine/prioritize as needed
-        # Many coding variants are exome-only, which are reliable for blood group genes
-        query = """
-        query GnomadVariant($variantId: String!, $datasetId: DatasetId!) {
-          variant(variantId: $variantId, dataset: $datasetId) {
-            variant_id
-            exome {
-              af
-              populations {
-                id
-                ac
-                an
-              }
-            }
-            genome {
-              af
-              populations {
-                id
-                ac
-                an
-              }
-            }
-          }
-        }
-        """
-        
-        variables = {
-            "variantId": gnomad_variant_id,
-            "datasetId": "gnomad_r4"
-        }
-        
-        logger.info(f"  → Querying gnomAD API: {gnomad_variant_id}")
+        if queried and cache_only:
+            logger.info(f"  → Not in gnomAD cache, skipping")
+            skipped_count += 1
+            continue
+
+        if gnomad_variant_id in failed_lookups:
+            logger.warning(f"  → gnomAD lookup for {gnomad_variant_id} already failed in this run, skipping")
+            failed_count += 1
+            continue
+
+        if pipeline:
+            logger.info(f"  → Queued for pipelined {'lookup' if queried else 'update'}: {gnomad_variant_id}")
+            if not queried and prefetched[gnomad_variant_id]:
+                received[gnomad_variant_id] = prefetched[gnomad_variant_id]
+            pipelined.setdefault(gnomad_variant_id, []).append(row)
+            continue
 
         try:
-            response = requests.post(
-                gnomad_api_url,
-                json={"query": query, "variables": variables},
-                headers={"Content-Type": "application/json"},
-                timeout=30  # Add 30 second timeout
-            )
-            response.raise_for_status()
-            data = response.json()
-            
-            # Check for GraphQL errors
-            if 'errors' in data:
-                logger.info(f"  → Not found in gnomAD (GraphQL error)")
-                not_found_count += 1
-                
-                # Clear existing gnomAD data if clear_not_found flag is set
-                if clear_not_found and overwrite_all and pd.notna(row.get('gnomad_all')):
-                    logger.info(f"  → Clearing existing gnomAD frequencies")
-                    if not test_mode:
-                        update_url = f"{lead_url}/variant/{db_variant_id}"
-                        clear_data = {pop: None for pop in gnomad_populations}
-                        update_response = session.patch(update_url, json=clear_data)
-                        update_response.raise_for_status()
-                        logger.info(f"  ✓ Cleared gnomAD data in database")
-                        cleared_count += 1
-                    else:
-                        logger.info(f"  ✓ TEST MODE: Would clear gnomAD data")
-                        cleared_count += 1
-                continue
-            
-            # Check if variant exists in gnomAD
-            variant_data = data.get('data', {}).get('variant')
-            if not variant_data:
-                logger.info(f"  → Not found in gnomAD")
-                not_found_count += 1
-                
-                # Clear existing gnomAD data if clear_not_found flag is set
-                if clear_not_found and overwrite_all and pd.notna(row.get('gnomad_all')):
-                    logger.info(f"  → Clearing existing gnomAD frequencies")
-                    if not test_mode:
-                        update_url = f"{lead_url}/variant/{db_variant_id}"
-                        clear_data = {pop: None for pop in gnomad_populations}
-                        update_response = session.patch(update_url, json=clear_data)
-                        update_response.raise_for_status()
-                        logger.info(f"  ✓ Cleared gnomAD data in database")
-                        cleared_count += 1
-                    else:
-                        logger.info(f"  ✓ TEST MODE: Would clear gnomAD data")
-                        cleared_count += 1
-                continue
-            
-            # Extract exome and genome data from GraphQL response
-            exome_data = variant_data.get('exome')
-            genome_data = variant_data.get('genome')
-            
-            # Check if we have any data (exome or genome)
-            if not exome_data and not genome_data:
-                logger.info(f"  → Found but no exome or genome data available")
-                not_found_count += 1
-                
-                # Clear existing gnomAD data if clear_not_found flag is set
-                if clear_not_found and overwrite_all and pd.notna(row.get('gnomad_all')):
-                    logger.info(f"  → Clearing existing gnomAD frequencies")
-                    if not test_mode:
-                        update_url = f"{lead_url}/variant/{db_variant_id}"
-                        clear_data = {pop: None for pop in gnomad_populations}
-                        update_response = session.patch(update_url, json=clear_data)
-                        update_response.raise_for_status()
-                        logger.info(f"  ✓ Cleared gnomAD data in database")
-                        cleared_count += 1
-                    else:
-                        logger.info(f"  ✓ TEST MODE: Would clear gnomAD data")
-                        cleared_count += 1
-                continue
-            
-            # Determine data source for logging
-            data_source = []
-            if exome_data:
-                data_source.append('exome')
-            if genome_data:
-                data_source.append('genome')
-            data_source_str = '+'.join(data_source)
-            
-            # Combine populations from both exome and genome
-            # gnomAD v4.1 provides joint allele numbers - when variant is in both datasets,
-            # we calculate combined frequencies by summing AC and AN across both
-            combined_pops = {}
-            
-            # Process exome populations
-            if exome_data:
-                for pop in exome_data.get('populations', []):
-                    pop_id = pop['id']
-                    # Skip sex-specific and sub-population variants (those with ':' or '_XX'/'_XY')
-                    if ':' in pop_id or '_XX' in pop_id or '_XY' in pop_id:
-                        continue
-                    ac = pop.get('ac', 0)
-                    an = pop.get('an', 0)
-                    if pop_id not in combined_pops:
-                        combined_pops[pop_id] = {'ac': 0, 'an': 0}
-                    combined_pops[pop_id]['ac'] += ac
-                    combined_pops[pop_id]['an'] += an
-            
-            # Process genome populations
-            if genome_data:
-                for pop in genome_data.get('populations', []):
-                    pop_id = pop['id']
-                    # Skip sex-specific and sub-population variants
-                    if ':' in pop_id or '_XX' in pop_id or '_XY' in pop_id:
-                        continue
-                    ac = pop.get('ac', 0)
-                    an = pop.get('an', 0)
-                    if pop_id not in combined_pops:
-                        combined_pops[pop_id] = {'ac': 0, 'an': 0}
-                    combined_pops[pop_id]['ac'] += ac
-                    combined_pops[pop_id]['an'] += an
-            
-            # Calculate MAF for each population from combined AC/AN
-            # This gives us joint exome+genome frequencies as recommended by gnomAD v4.1
-            pop_mafs = {}
-            for pop_id, counts in combined_pops.items():
-                ac = counts['ac']
-                an = counts['an']
-                
-                if an > 0:
-                    af = ac / an
-                    pop_mafs[pop_id] = calculate_maf(af)
-                else:
-                    pop_mafs[pop_id] = None
-            
-            # Calculate overall MAF from combined AC/AN across all populations
-            # This ensures we always use joint exome+genome frequencies
-            total_ac = sum(counts['ac'] for counts in combined_pops.values() if counts['an'] > 0)
-            total_an = sum(counts['an'] for counts in combined_pops.values() if counts['an'] > 0)
-            overall_af = total_ac / total_an if total_an > 0 else None
-            overall_maf = calculate_maf(overall_af)
-            
-            # Map gnomAD population IDs to database fields
-            # Note: gnomAD v4 uses 'remaining' for "Other" population
-            # Use explicit None check to preserve 0 values (0 is a valid MAF)
-            remaining_maf = pop_mafs.get('remaining')
-            gnomad_freqs = {
-                'gnomad_all': overall_maf,
-                'gnomad_afr': pop_mafs.get('afr'),
-                'gnomad_amr': pop_mafs.get('amr'),
-                'gnomad_asj': pop_mafs.get('asj'),
-                'gnomad_eas': pop_mafs.get('eas'),
-                'gnomad_fin': pop_mafs.get('fin'),
-                'gnomad_nfe': pop_mafs.get('nfe'),
-                'gnomad_oth': remaining_maf if remaining_maf is not None else pop_mafs.get('oth'),  # gnomAD v4 uses 'remaining'
-                'gnomad_sas': pop_mafs.get('sas')
-            }
-            
-            logger.info(f"  ✓ Found in gnomAD [{data_source_str}] (MAF: {overall_maf:.6f})")
-            
-            # Update database with PATCH request (only gnomAD fields)
-            if not test_mode:
-                update_url = f"{lead_url}/variant/{db_variant_id}"
-                update_response = session.patch(update_url, json=gnomad_freqs)
-                update_response.raise_for_status()
-                logger.info(f"  ✓ Updated in database")
-                updated_count += 1
+            if queried:
+                logger.info(f"  → Querying gnomAD API: {gnomad_variant_id}")
+                variant_data = query_gnomad_variant(gnomad_variant_id)
+                if cache and variant_data:
+                    cache.put_many({gnomad_variant_id: variant_data})
+                elif cache:
+                    cache.put_not_found([gnomad_variant_id])
+
+                # Later rows with the same coordinates reuse this result
+                prefetched[gnomad_variant_id] = variant_data
             else:
-                logger.info(f"  ✓ TEST MODE: Would update with MAF data")
+                logger.info(f"  → Using prefetched gnomAD result: {gnomad_variant_id}")
+                variant_data = prefetched[gnomad_variant_id]
+
+            if variant_data:
+                received[gnomad_variant_id] = variant_data
+
+            outcome = apply_gnomad_result(session, lead_url, row, variant_data, prefetched_freqs.get(gnomad_variant_id),
+                                          sources, test_mode, overwrite_all, clear_not_found)
+            if outcome == 'updated':
                 updated_count += 1
+            else:
+                not_found_count += 1
+                if outcome == 'cleared':
+                    cleared_count += 1
             
         except requests.exceptions.Timeout:
             logger.error(f"  ✗ Timeout (30s)")
+            failed_count += 1
         except requests.exceptions.RequestException as e:
             logger.error(f"  ✗ API Error: {str(e)[:100]}")
+            failed_count += 1
+
+        if queried and gnomad_variant_id not in prefetched:
+            failed_lookups.add(gnomad_variant_id)
         
         # Rate limiting: gnomAD allows 10 requests per 60 seconds, so wait 6.5 seconds between requests
         # This runs for ALL requests (success or failure) since failed requests also count against the limit
-        time.sleep(6.5)
+        if queried:
+            time.sleep(GNOMAD_REQUEST_DELAY)
+
+    if pipelined:
+        outcomes = asyncio.run(run_gnomad_pipeline(
+            pipelined, prefetched, prefetched_freqs, session, lead_url,
+            test_mode=test_mode, overwrite_all=overwrite_all, clear_not_found=clear_not_found,
+            sources=sources, cache=cache, received=received, workers=pipeline_workers
+        ))
+        updated_count += outcomes['updated']
+        not_found_count += outcomes['not_found'] + outcomes['cleared']
+        cleared_count += outcomes['cleared']
+        failed_count += outcomes['failed']
+
+    if export_matrix:
+        # Keep every population, including sex-specific and sub-populations
+        matrix = PopulationMatrix.from_variant_data(received, population_filter=None)
+        matrix.to_frame().to_csv(export_matrix, index=False)
+        logger.info(f"Exported AC/AN matrix for {len(matrix.variant_ids)} variants to {export_matrix}")
 
     logger.info("=" * 80)
     summary = f"Summary: {updated_count} variants updated, {skipped_count} skipped (already have data), {not_found_count} not found in gnomAD"
     if clear_not_found and cleared_count > 0:
         summary += f", {cleared_count} gnomAD records cleared"
+    if failed_count:
+        summary += f", {failed_count} failed"
     logger.info(summary)
     logger.info("=" * 80)
     
     return variants
 
+def load_cache_snapshot(cache, gnomad_variant_ids, release):
+    """
+    Read a gnomAD release snapshot from the raw count cache.
+
+    :param cache: GnomadCache
+    :param gnomad_variant_ids: Iterable of gnomAD variant IDs
+    :param release: gnomAD release label to read
+    :return: Dict mapping gnomAD variant IDs to variant data (None if recorded as not found);
+             variants with no entry for the release are left out
+    """
+    gnomad_variant_ids = list(gnomad_variant_ids)
+    snapshot = {gnomad_variant_id: None for gnomad_variant_id in cache.get_not_found(gnomad_variant_ids, None, release)}
+    snapshot.update(cache.get_many(gnomad_variant_ids, release))
+    return snapshot
+
+
+def frequencies_changed(old_freqs, new_freqs, tolerance=DEFAULT_DELTA_TOLERANCE):
+    """
+    Whether any gnomAD frequency field differs between two releases by more than tolerance.
+
+    A field that is missing in one release but present in the other always counts as changed.
+
+    :param old_freqs: Dict of database gnomAD fields from the old release
+    :param new_freqs: Dict of database gnomAD fields from the new release
+    :param tolerance: Maximum absolute MAF difference that is ignored
+    :return: True if the frequencies changed
+    """
+    for field in GNOMAD_POPULATIONS:
+        old_value = old_freqs.get(field)
+        new_value = new_freqs.get(field)
+        if old_value is None and new_value is None:
+            continue
+        if old_value is None or new_value is None or abs(old_value - new_value) > tolerance:
+            return True
+    return False
+
+
+def annotate_gnomad_release_delta(variants, session, lead_url, old_snapshot, new_snapshot, test_mode=True,
+                                  clear_not_found=False, tolerance=DEFAULT_DELTA_TOLERANCE,
+                                  frequency_sources='joint', reference=None):
+    """
+    Update only the variants whose gnomAD frequencies changed between two releases.
+
+    Both snapshots are local (cached AC/AN counts or offline VCF extracts), so no gnomAD
+    requests are made. Frequencies of both releases are computed in one vectorized pass each
+    and compared per variant; only variants that changed by more than tolerance, that are
+    new in the new release, or that have no gnomAD frequencies in the database yet, are PATCHed.
+
+    :param variants: Pandas DataFrame containing variants with GRCh38 coordinates
+    :param session: Authenticated session for database updates
+    :param lead_url: Base URL of the API
+    :param old_snapshot: Dict mapping gnomAD variant IDs to variant data for the old release (None = not found)
+    :param new_snapshot: Dict mapping gnomAD variant IDs to variant data for the new release (None = not found)
+    :param test_mode: If True, logs what would be updated without making PATCH requests
+    :param clear_not_found: If True, clear gnomAD data of variants that are no longer in the new release
+    :param tolerance: Maximum absolute MAF difference that is ignored
+    :param frequency_sources: 'joint' (exome+genome), 'exome' or 'genome' frequencies
+    :param reference: Optional ReferenceGenome used to validate and normalize variants
+    :return: Pandas DataFrame (unchanged)
+    """
+    sources = FREQUENCY_SOURCES[frequency_sources]
+    old_freqs = PopulationMatrix.from_variant_data(old_snapshot).gnomad_frequencies(sources)
+    new_freqs = PopulationMatrix.from_variant_data(new_snapshot).gnomad_frequencies(sources)
+
+    updated_count = 0
+    unchanged_count = 0
+    skipped_count = 0
+    cleared_count = 0
+    failed_count = 0
+    processed_count = 0
+
+    total_variants = len(variants)
+
+    for index, row in variants.iterrows():
+        processed_count += 1
+        db_variant_id = row.get('id')
+        # Rows without stored frequencies (new, or an earlier update failed) are filled even if the releases agree
+        missing_in_db = pd.isna(row.get('gnomad_all'))
+
+        gnomad_variant_id, skip_reason = get_gnomad_variant_id(row, reference)
+        if skip_reason:
+            skipped_count += 1
+            continue
+
+        if gnomad_variant_id not in new_snapshot:
+            skipped_count += 1
+            continue
+
+        old_values = old_freqs.get(gnomad_variant_id)
+        new_values = new_freqs.get(gnomad_variant_id)
+
+        try:
+            if new_values is None:
+                if old_values is not None and clear_not_found and pd.notna(row.get('gnomad_all')):
+                    logger.info(f"[{processed_count}/{total_variants}] Variant {db_variant_id} ({gnomad_variant_id}) no longer in gnomAD")
+                    clear_gnomad_frequencies(session, lead_url, db_variant_id, test_mode)
+                    cleared_count += 1
+                else:
+                    unchanged_count += 1
+                continue
+
+            if (old_values is not None and not missing_in_db and
+                    not frequencies_changed(old_values, new_values, tolerance)):
+                unchanged_count += 1
+                continue
+
+            old_maf = old_values.get('gnomad_all') if old_values else None
+            new_maf = new_values['gnomad_all']
+            old_str = f"{old_maf:.6f}" if old_maf is not None else "n/a"
+            new_str = f"{new_maf:.6f}" if new_maf is not None else "n/a"
+            change = "missing from the database" if missing_in_db else "changed"
+            logger.info(f"[{processed_count}/{total_variants}] Variant {db_variant_id} ({gnomad_variant_id}) {change} (MAF: {old_str} → {new_str})")
+
+            if not test_mode:
+                update_url = f"{lead_url}/variant/{db_variant_id}"
+                update_response = session.patch(update_url, json=new_values, timeout=10)
+                update_response.raise_for_status()
+                logger.info(f"  ✓ Updated in database")
+            else:
+                logger.info(f"  ✓ TEST MODE: Would update with MAF data")
+            updated_count += 1
+
+        except requests.exceptions.RequestException as e:
+            logger.error(f"  ✗ API Error: {str(e)[:100]}")
+            failed_count += 1
+
+    logger.info("=" * 80)
+    summary = f"Summary: {updated_count} variants updated, {unchanged_count} unchanged, {skipped_count} skipped (not in new snapshot)"
+    if clear_not_found and cleared_count > 0:
+        summary += f", {cleared_count} gnomAD records cleared"
+    if failed_count:
+        summary += f", {failed_count} failed"
+    logger.info(summary)
+    logger.info("=" * 80)
+
+    return variants
+
+
 if __name__ == "__main__":
     # Parse command-line arguments
     parser = argparse.ArgumentParser(
@@ -404,6 +1344,34 @@ Examples:
   
   # Test overwrite mode
   python annotate_gnomad.py --test-mode --overwrite-all
+  
+  # Batch mode - look up 25 variants per gnomAD request
+  python annotate_gnomad.py --batch-size 25
+  
+  # Fetch each locus's gnomAD variants once and annotate from the lookup table
+  python annotate_gnomad.py --prefetch-regions
+  
+  # Offline mode - read local gnomAD v4 sites VCFs instead of the API
+  python annotate_gnomad.py --offline-vcf gnomad.exomes.v4.1.sites.chr*.vcf.bgz gnomad.genomes.v4.1.sites.chr*.vcf.bgz
+  
+  # Pipelined mode - query gnomAD on a fixed 10-per-minute schedule while database updates run concurrently
+  python annotate_gnomad.py --pipeline
+  
+  # Check REF and left-align/trim variants against a local GRCh38 FASTA before querying
+  python annotate_gnomad.py --reference-fasta GRCh38.fa
+  
+  # Also annotate variants without GRCh38 coordinate fields, using their hgvs_genomic_grch38 description
+  python annotate_gnomad.py --reference-fasta GRCh38.fa --hgvs-coordinates
+  
+  # Release upgrade - PATCH only variants whose cached frequencies changed between releases
+  python annotate_gnomad.py --cache-db gnomad_cache.sqlite --gnomad-release v4.2 --delta-from v4.1
+  
+  # Release upgrade from two sets of offline VCFs
+  python annotate_gnomad.py --offline-vcf gnomad.exomes.v4.2.sites.chr*.vcf.bgz --delta-old-vcf gnomad.exomes.v4.1.sites.chr*.vcf.bgz
+  
+  # Cache raw AC/AN counts, then recompute exome-only MAFs from the cache without querying gnomAD
+  python annotate_gnomad.py --cache-db gnomad_cache.sqlite
+  python annotate_gnomad.py --cache-db gnomad_cache.sqlite --cache-only --overwrite-all --frequency-sources exome
         """
     )
     parser.add_argument(
@@ -421,6 +1389,117 @@ Examples:
         action='store_true',
         help='Clear existing gnomAD data when not found in gnomAD (only works with --overwrite-all)'
     )
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        help='Query gnomAD for up to this many variants per request using aliased GraphQL queries'
+    )
+    parser.add_argument(
+        '--max-payload-bytes',
+        type=int,
+        default=DEFAULT_MAX_PAYLOAD_BYTES,
+        help=f'Maximum POST body size for batched queries, reduced automatically on 413 errors (default: {DEFAULT_MAX_PAYLOAD_BYTES})'
+    )
+    parser.add_argument(
+        '--prefetch-regions',
+        action='store_true',
+        help='Group variants by locus and fetch each region\'s gnomAD variants once'
+    )
+    parser.add_argument(
+        '--max-region-span',
+        type=int,
+        default=DEFAULT_MAX_SPAN,
+        help=f'Maximum size in bp of a prefetched region (default: {DEFAULT_MAX_SPAN})'
+    )
+    parser.add_argument(
+        '--pipeline',
+        action='store_true',
+        help=f'Start gnomAD queries on a fixed schedule ({GNOMAD_RATE_LIMIT} per {GNOMAD_RATE_WINDOW}s) and write results to the database concurrently'
+    )
+    parser.add_argument(
+        '--pipeline-workers',
+        type=int,
+        default=DEFAULT_PIPELINE_WORKERS,
+        help=f'Number of concurrent database updates in pipeline mode (default: {DEFAULT_PIPELINE_WORKERS})'
+    )
+    parser.add_argument(
+        '--offline-vcf',
+        nargs='+',
+        metavar='VCF',
+        help='Annotate from local bgzipped gnomAD sites VCFs instead of the API (exome:PATH / genome:PATH, '
+             'or file names containing "exome"/"genome")'
+    )
+    parser.add_argument(
+        '--offline-index-dir',
+        help='Directory for offline VCF region index files (default: next to each VCF)'
+    )
+    parser.add_argument(
+        '--cache-db',
+        nargs='?',
+        const=DEFAULT_CACHE_PATH,
+        help=f'Store raw gnomAD AC/AN counts in a local SQLite cache and reuse them (default path: {DEFAULT_CACHE_PATH})'
+    )
+    parser.add_argument(
+        '--gnomad-release',
+        default=GNOMAD_RELEASE,
+        help=f'gnomAD release label that cached counts are stored under (default: {GNOMAD_RELEASE})'
+    )
+    parser.add_argument(
+        '--not-found-ttl',
+        type=float,
+        default=DEFAULT_NOT_FOUND_TTL_DAYS,
+        metavar='DAYS',
+        help=f'Days before a cached "not found" result is queried again (default: {DEFAULT_NOT_FOUND_TTL_DAYS})'
+    )
+    parser.add_argument(
+        '--refresh-cache',
+        action='store_true',
+        help='Re-query gnomAD for cached variants and update the cache (requires --cache-db)'
+    )
+    parser.add_argument(
+        '--cache-only',
+        action='store_true',
+        help='Annotate only from the cache, without querying gnomAD (requires --cache-db)'
+    )
+    parser.add_argument(
+        '--frequency-sources',
+        choices=sorted(FREQUENCY_SOURCES),
+        default='joint',
+        help='Use joint exome+genome, exome-only or genome-only frequencies (default: joint)'
+    )
+    parser.add_argument(
+        '--export-matrix',
+        metavar='CSV',
+        help='Write the per-population exome/genome AC/AN of every annotated variant to a CSV file'
+    )
+    parser.add_argument(
+        '--delta-from',
+        metavar='RELEASE',
+        help='Release upgrade mode: compare cached counts of this release with --gnomad-release and update only changed variants (requires --cache-db)'
+    )
+    parser.add_argument(
+        '--delta-old-vcf',
+        nargs='+',
+        metavar='VCF',
+        help='Release upgrade mode: compare these old-release VCFs with --offline-vcf and update only changed variants'
+    )
+    parser.add_argument(
+        '--delta-tolerance',
+        type=float,
+        default=DEFAULT_DELTA_TOLERANCE,
+        help=f'Ignore MAF changes up to this absolute difference in release upgrade mode (default: {DEFAULT_DELTA_TOLERANCE})'
+    )
+    parser.add_argument(
+        '--reference-fasta',
+        metavar='FASTA',
+        help='Local GRCh38 FASTA used to check REF and left-align/trim variants before querying gnomAD'
+    )
+    parser.add_argument(
+        '--hgvs-coordinates',
+        action='store_true',
+        help='Derive missing GRCh38 coordinates from hgvs_genomic_grch38 locally (in memory; '
+             'indels need --reference-fasta)'
+    )
     parser.add_argument(
         '--limit',
         type=int,
@@ -471,11 +1550,38 @@ Examples:
             logger.error(f"Missing required configuration key: {e}")
             raise
 
+    offline_vcfs = parse_offline_vcf_sources(args.offline_vcf) if args.offline_vcf else None
+
+    # Validate flag combination
+    if (args.refresh_cache or args.cache_only) and not args.cache_db:
+        logger.error("--refresh-cache and --cache-only require --cache-db to be set")
+        raise ValueError("--refresh-cache and --cache-only require --cache-db")
+    if args.delta_from and not args.cache_db:
+        logger.error("--delta-from requires --cache-db to be set")
+        raise ValueError("--delta-from requires --cache-db")
+    if args.delta_old_vcf and not offline_vcfs:
+        logger.error("--delta-old-vcf requires --offline-vcf with the new release VCFs")
+        raise ValueError("--delta-old-vcf requires --offline-vcf")
+
     try:
         # Authenticate and fetch variants
         logger.info("Starting gnomAD annotation process")
         logger.info(f"Mode: {'TEST MODE (no updates)' if args.test_mode else 'PRODUCTION MODE (will update database)'}")
         logger.info(f"Overwrite existing: {'YES' if args.overwrite_all else 'NO (only update variants without gnomAD data)'}")
+        if args.batch_size:
+            logger.info(f"Batch mode: YES ({args.batch_size} variants per request)")
+        if args.prefetch_regions:
+            logger.info(f"Region prefetch: YES (regions up to {args.max_region_span} bp)")
+        if args.pipeline:
+            logger.info(f"Pipeline mode: YES ({GNOMAD_RATE_LIMIT} requests per {GNOMAD_RATE_WINDOW}s, {args.pipeline_workers} concurrent updates)")
+        if offline_vcfs:
+            logger.info(f"Offline mode: YES ({len(offline_vcfs)} local gnomAD VCFs, no API requests)")
+        if args.cache_db:
+            logger.info(f"Cache: {args.cache_db} (release {args.gnomad_release}{', cache only' if args.cache_only else ''})")
+        if args.frequency_sources != 'joint':
+            logger.info(f"Frequency sources: {args.frequency_sources} only")
+        if args.hgvs_coordinates:
+            logger.info(f"HGVS coordinates: YES (missing GRCh38 coordinates derived from hgvs_genomic_grch38)")
         
         logger.info(f"Connecting to: {lead_url}")
         session = login(lead_url, email, password)
@@ -495,13 +1601,64 @@ Examples:
         if args.limit:
             logger.info(f"Processing only first {args.limit} variants")
         
-        annotate_gnomad_frequencies(
-            variants_to_process, 
-            session, 
-            lead_url, 
-            test_mode=args.test_mode,
-            overwrite_all=args.overwrite_all
-        )
+        cache = GnomadCache(args.cache_db, args.gnomad_release) if args.cache_db else None
+        reference = ReferenceGenome(args.reference_fasta) if args.reference_fasta else None
+        if args.hgvs_coordinates:
+            variants_to_process = fill_coordinates_from_hgvs(variants_to_process, reference)
+        
+        if args.delta_from or args.delta_old_vcf:
+            # Release upgrade: compare two local snapshots and update only changed variants
+            pending = get_pending_lookups(variants_to_process, overwrite_all=True, reference=reference)
+            if args.delta_from:
+                logger.info(f"Release upgrade: comparing cached {args.delta_from} with {args.gnomad_release}")
+                old_snapshot = load_cache_snapshot(cache, pending.values(), args.delta_from)
+                new_snapshot = load_cache_snapshot(cache, pending.values(), args.gnomad_release)
+            else:
+                logger.info("Release upgrade: comparing old and new offline gnomAD VCFs")
+                old_snapshot = prefetch_gnomad_offline(pending, parse_offline_vcf_sources(args.delta_old_vcf), args.offline_index_dir)
+                new_snapshot = prefetch_gnomad_offline(pending, offline_vcfs, args.offline_index_dir)
+            
+            annotate_gnomad_release_delta(
+                variants_to_process,
+                session,
+                lead_url,
+                old_snapshot,
+                new_snapshot,
+                test_mode=args.test_mode,
+                clear_not_found=args.clear_not_found,
+                tolerance=args.delta_tolerance,
+                frequency_sources=args.frequency_sources,
+                reference=reference
+            )
+        else:
+            annotate_gnomad_frequencies(
+                variants_to_process, 
+                session, 
+                lead_url, 
+                test_mode=args.test_mode,
+                overwrite_all=args.overwrite_all,
+                clear_not_found=args.clear_not_found,
+                batch_size=args.batch_size,
+                max_payload_bytes=args.max_payload_bytes,
+                prefetch_regions=args.prefetch_regions,
+                max_region_span=args.max_region_span,
+                offline_vcfs=offline_vcfs,
+                offline_index_dir=args.offline_index_dir,
+                cache=cache,
+                refresh_cache=args.refresh_cache,
+                cache_only=args.cache_only,
+                frequency_sources=args.frequency_sources,
+                not_found_ttl_days=args.not_found_ttl,
+                export_matrix=args.export_matrix,
+                reference=reference,
+                pipeline=args.pipeline,
+                pipeline_workers=args.pipeline_workers
+            )
+        
+        if cache:
+            cache.close()
+        if reference:
+            reference.close()
         
         logger.info("=" * 80)
         logger.info(f"ANNOTATION COMPLETE")
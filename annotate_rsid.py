@@ -6,7 +6,16 @@ This script:
 2. Queries NCBI Variation API for rsIDs using chromosome, position, ref, and alt alleles
 3. Updates the database with PATCH requests (only for variants without existing rsIDs)
 
-Rate Limit: NCBI allows 3 requests per second without API key (script uses 2 req/sec to be safe)
+With --dbsnp-vcf, rsIDs are looked up in a local binary index of the dbSNP GRCh38 VCF
+records inside the blood group loci instead (see dbsnp_index.py), without calling NCBI.
+With --position-filter, variants at positions without any dbSNP record are reported as not
+found without a request (see dbsnp_positions.py).
+With --fill-coordinates, missing GRCh38 coordinates are filled in from the dbSNP placement
+of the variant's existing rsID instead.
+
+Rate Limit: NCBI allows 3 requests per second without API key (script uses 2 req/sec to be safe).
+In worker-pool mode, requests are spread over several threads under a token bucket of
+3 req/sec, or 10 req/sec with an NCBI API key.
 
 Author: Nick Gleadall
 Date: November 2025
@@ -18,14 +27,46 @@ import pandas as pd
 import time
 import logging
 import argparse
+import os
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from functools import wraps
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
+
+from dbsnp_index import DbsnpIndex, build_dbsnp_index, get_index_path
+from dbsnp_positions import PositionFilter, build_position_filter, get_filter_path
+from hgvs_genomic import fill_coordinates_from_hgvs
+from http_client import (DEFAULT_POOL_MAXSIZE, TokenBucket, configure_session, disable_transport_retries,
+                         log_connection_stats)
+from reference_genome import (EMPTY_ALLELES, GRCH38_ACCESSIONS, GRCH38_CHROMOSOMES, ReferenceGenome,
+                              canonicalize_spdi, normalize_variant)
+from rsid_cache import DBSNP_BUILD, DEFAULT_CACHE_PATH, DEFAULT_NOT_FOUND_TTL_DAYS, RsidCache
+from variant_regions import group_variants_by_locus, normalize_chromosome
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# NCBI E-utilities/Variation API limits, in requests per second
+NCBI_RATE_LIMIT = 3
+NCBI_API_KEY_RATE_LIMIT = 10
+
+# Padding (bp) around each locus when indexing the dbSNP VCF, so nearby new variants are covered
+DBSNP_INDEX_PADDING = 25000
+
+# Merged rsIDs are followed at most this many times when resolving the current rsID
+MAX_MERGE_HOPS = 5
+
+# E-utilities summary endpoint, which returns the GRCh38 SPDI placements of many rsIDs per request
+ESUMMARY_URL = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esummary.fcgi"
+
+# rsIDs per E-utilities request (NCBI asks for POST above ~200 IDs)
+REFSNP_BATCH_SIZE = 100
+
+COORDINATE_FIELDS = ['grch38_chr', 'grch38_pos', 'grch38_ref', 'grch38_alt']
+
+# NCBI hosts, whose requests are retried by retry_with_backoff rather than by the session
+NCBI_URL_PREFIXES = ('https://api.ncbi.nlm.nih.gov/', 'https://eutils.ncbi.nlm.nih.gov/')
+
 
 # Retry decorator
 def retry_with_backoff(retries=3, backoff_factor=0.3):
@@ -33,6 +74,11 @@ def retry_with_backoff(retries=3, backoff_factor=0.3):
     A decorator that implements a retry mechanism with exponential backoff
     while preserving the authenticated session.
 
+    The session is used as-is, so its kept-alive connections are reused across calls.
+    NCBI requests have no transport-level retries (see login), so each attempt here is one
+    HTTP request. Pass bucket=TokenBucket to the decorated function to take a token before
+    every attempt, retries included.
+
     :param retries: Number of retries before giving up
     :param backoff_factor: Factor to increase delay between retries
     :return: Decorated function
@@ -44,25 +90,11 @@ def retry_with_backoff(retries=3, backoff_factor=0.3):
             session = kwargs.get("session")
             if session is None:
                 raise ValueError("Session must be provided")
-
-            # Create a new session with the same cookies and headers
-            retry_session = requests.Session()
-            retry_session.cookies.update(session.cookies)
-            retry_session.headers.update(session.headers)
-
-            # Set up retry strategy
-            retry_strategy = Retry(
-                total=retries,
-                backoff_factor=backoff_factor,
-                status_forcelist=[429, 500, 502, 503, 504],
-                allowed_methods=["HEAD", "GET", "OPTIONS", "POST", "PATCH"],
-            )
-            retry_session.mount("https://", HTTPAdapter(max_retries=retry_strategy))
-
-            # Replace the original session with the retry-enabled session
-            kwargs["session"] = retry_session
+            bucket = kwargs.pop("bucket", None)
 
             for attempt in range(retries + 1):
+                if bucket is not None:
+                    bucket.acquire()
                 try:
                     return func(*args, **kwargs)
                 except requests.exceptions.RequestException as e:
@@ -80,20 +112,24 @@ def retry_with_backoff(retries=3, backoff_factor=0.3):
     return decorator
 
 
-def login(lead_url, email, password):
+def login(lead_url, email, password, pool_maxsize=DEFAULT_POOL_MAXSIZE):
     """
     Authenticate with the blood group database.
 
     :param lead_url: Base URL of the API
     :param email: User's email for authentication
     :param password: User's password for authentication
-    :return: Authenticated session object
+    :param pool_maxsize: Maximum number of kept-alive connections per host
+    :return: Authenticated session object, with retries and pooled keep-alive connections
     """
     login_url = f"{lead_url}/auth/login"
     login_data = {"email": email, "password": password}
 
     try:
-        session = requests.Session()
+        # One session per run, shared by the database and NCBI requests
+        session = configure_session(requests.Session(), retries=5, backoff_factor=0.5, pool_maxsize=pool_maxsize)
+        # NCBI lookups are retried by retry_with_backoff, under the worker pool's rate limit
+        disable_transport_retries(session, NCBI_URL_PREFIXES, pool_maxsize=pool_maxsize)
         login_response = session.post(login_url, data=login_data)
         login_response.raise_for_status()
 
@@ -106,22 +142,56 @@ def login(lead_url, email, password):
         raise
 
 
-# GRCh38/hg38 chromosome to RefSeq accession mapping
-GRCH38_CHROMOSOMES = {
-    '1': 'NC_000001.11', '2': 'NC_000002.12', '3': 'NC_000003.12',
-    '4': 'NC_000004.12', '5': 'NC_000005.10', '6': 'NC_000006.12',
-    '7': 'NC_000007.14', '8': 'NC_000008.11', '9': 'NC_000009.12',
-    '10': 'NC_000010.11', '11': 'NC_000011.10', '12': 'NC_000012.12',
-    '13': 'NC_000013.11', '14': 'NC_000014.9', '15': 'NC_000015.10',
-    '16': 'NC_000016.10', '17': 'NC_000017.11', '18': 'NC_000018.10',
-    '19': 'NC_000019.10', '20': 'NC_000020.11', '21': 'NC_000021.9',
-    '22': 'NC_000022.11', 'X': 'NC_000023.11', 'Y': 'NC_000024.10',
-    'MT': 'NC_012920.1', 'M': 'NC_012920.1'
-}
+def get_spdi(chromosome, position, ref, alt):
+    """
+    Build the SPDI string of a variant using GRCh38 RefSeq accessions.
+
+    :param chromosome: Chromosome number (1-22, X, Y, MT)
+    :param position: Genomic position (1-based)
+    :param ref: Reference allele
+    :param alt: Alternate allele
+    :return: SPDI string, or None for unknown chromosomes
+    """
+    # Convert chromosome to RefSeq accession
+    chrom_accession = GRCH38_CHROMOSOMES.get(str(chromosome))
+    if not chrom_accession:
+        logger.warning(f"Unknown chromosome: {chromosome}")
+        return None
+    
+    # NCBI SPDI uses 0-based coordinates, so subtract 1 from position
+    spdi_position = int(float(position)) - 1
+    return f"{chrom_accession}:{spdi_position}:{ref}:{alt}"
 
 
 @retry_with_backoff(retries=5, backoff_factor=0.5)
-def get_rsid(chromosome, position, ref, alt, session=None):
+def query_spdi_rsid(spdi, session=None, api_key=None):
+    """
+    Query the NCBI Variation API for the rsID of an SPDI.
+
+    :param spdi: SPDI string (see get_spdi)
+    :param session: Requests session object
+    :param api_key: Optional NCBI API key (raises the NCBI rate limit to 10 requests/s)
+    :return: rsID if found, None if dbSNP has no rsID for the SPDI
+    :raises requests.exceptions.RequestException: If the request fails for any other reason
+    """
+    # Query NCBI Variation API using SPDI format
+    rsid_url = f"https://api.ncbi.nlm.nih.gov/variation/v0/spdi/{spdi}/rsids"
+    
+    params = {"api_key": api_key} if api_key else None
+    rsid_response = session.get(rsid_url, params=params, timeout=30)
+    # 400/404 are answers about the SPDI itself (invalid or unknown), not failed requests
+    if rsid_response.status_code in (400, 404):
+        return None
+    rsid_response.raise_for_status()
+    rsid_json = rsid_response.json()
+
+    if not rsid_json.get("data", {}).get("rsids"):
+        return None
+
+    return rsid_json["data"]["rsids"][0]
+
+
+def get_rsid(chromosome, position, ref, alt, session=None, api_key=None):
     """
     Fetch the rsID for a given genomic variant using GRCh38 coordinates.
 
@@ -130,34 +200,124 @@ def get_rsid(chromosome, position, ref, alt, session=None):
     :param ref: Reference allele
     :param alt: Alternate allele
     :param session: Requests session object
-    :return: rsID if found, None otherwise
+    :param api_key: Optional NCBI API key (raises the NCBI rate limit to 10 requests/s)
+    :return: rsID if found, None otherwise (including failed requests)
     """
+    spdi = get_spdi(chromosome, position, ref, alt)
+    if not spdi:
+        return None
+
     try:
-        # Convert chromosome to RefSeq accession
-        chrom_accession = GRCH38_CHROMOSOMES.get(str(chromosome))
-        if not chrom_accession:
-            logger.warning(f"Unknown chromosome: {chromosome}")
-            return None
-        
-        # NCBI SPDI uses 0-based coordinates, so subtract 1 from position
-        spdi_position = int(position) - 1
-        
-        # Query NCBI Variation API using SPDI format
-        rsid_url = f"https://api.ncbi.nlm.nih.gov/variation/v0/spdi/{chrom_accession}:{spdi_position}:{ref}:{alt}/rsids"
-        
-        rsid_response = session.get(rsid_url, timeout=30)
-        rsid_response.raise_for_status()
-        rsid_json = rsid_response.json()
+        return query_spdi_rsid(spdi, session=session, api_key=api_key)
+    except requests.exceptions.RequestException as e:
+        return None
 
-        if not rsid_json.get("data", {}).get("rsids"):
-            return None
 
-        rsid = rsid_json["data"]["rsids"][0]
-        return rsid
+def spdi_to_vcf(spdi):
+    """
+    Convert a GRCh38 SPDI string to database coordinates.
 
-    except requests.exceptions.RequestException as e:
+    Shared trailing and leading bases are trimmed down to one anchor base, so NCBI's fully
+    justified indel alleles become a single VCF-style representation. Alleles that end up
+    empty (SPDI insertions without context) are written as '-', with pos the base after the
+    insertion point.
+
+    :param spdi: SPDI string (e.g. 'NC_000009.12:133257520:T:TC')
+    :return: Tuple of (chrom, pos, ref, alt), or None for sequences other than GRCh38 chromosomes
+    """
+    accession, position, deleted, inserted = spdi.split(':')
+    chrom = GRCH38_ACCESSIONS.get(accession)
+    if chrom is None:
         return None
 
+    pos = int(position) + 1
+    while len(deleted) > 1 and len(inserted) > 1 and deleted[-1] == inserted[-1]:
+        deleted, inserted = deleted[:-1], inserted[:-1]
+    while len(deleted) > 1 and len(inserted) > 1 and deleted[0] == inserted[0]:
+        deleted, inserted = deleted[1:], inserted[1:]
+        pos += 1
+    return chrom, pos, deleted or '-', inserted or '-'
+
+
+def parse_rsid(value):
+    """
+    Parse a stored rsID value.
+
+    :param value: rsID as stored in the database (e.g. 'rs8176719')
+    :return: rsID number, or None if the value isn't an rsID
+    """
+    value = str(value).strip().lower()
+    if value.startswith('rs') and value[2:].isdigit():
+        return int(value[2:])
+    return None
+
+
+@retry_with_backoff(retries=5, backoff_factor=0.5)
+def query_refsnp_status(rsid, session=None, api_key=None):
+    """
+    Look up the current dbSNP status of an rsID in the NCBI Variation API.
+
+    :param rsid: rsID number (without 'rs' prefix)
+    :param session: Requests session object
+    :param api_key: Optional NCBI API key
+    :return: Tuple of (status, merged_into). status is 'current', 'merged', 'withdrawn',
+             'unsupported', 'no_position' or 'not_found'; merged_into is the rsID number
+             it was merged into (None unless merged)
+    :raises requests.exceptions.RequestException: If the request fails
+    """
+    refsnp_url = f"https://api.ncbi.nlm.nih.gov/variation/v0/refsnp/{rsid}"
+    params = {"api_key": api_key} if api_key else None
+    response = session.get(refsnp_url, params=params, timeout=30)
+    if response.status_code == 404:
+        return 'not_found', None
+    response.raise_for_status()
+    refsnp = response.json()
+
+    # Exactly one *_snapshot_data key is present, depending on the rsID's status
+    if refsnp.get('merged_snapshot_data') is not None:
+        merged_into = refsnp['merged_snapshot_data'].get('merged_into') or []
+        return 'merged', int(merged_into[0]) if merged_into else None
+    if refsnp.get('withdrawn_snapshot_data') is not None:
+        return 'withdrawn', None
+    if refsnp.get('unsupported_snapshot_data') is not None:
+        return 'unsupported', None
+    if refsnp.get('nosnppos_snapshot_data') is not None:
+        return 'no_position', None
+    return 'current', None
+
+
+@retry_with_backoff(retries=5, backoff_factor=0.5)
+def query_refsnp_placements(rsids, session=None, api_key=None):
+    """
+    Look up the GRCh38 SPDI placements of a batch of rsIDs with one E-utilities request.
+
+    :param rsids: List of rsID numbers (without 'rs' prefix)
+    :param session: Requests session object
+    :param api_key: Optional NCBI API key
+    :return: Dict mapping rsID numbers to lists of GRCh38 chromosome SPDI strings (one per ALT allele;
+             empty if dbSNP has no placement). rsIDs missing from the response are left out.
+    :raises requests.exceptions.RequestException: If the request fails
+    """
+    params = {"db": "snp", "id": ','.join(str(rsid) for rsid in rsids), "retmode": "json"}
+    if api_key:
+        params["api_key"] = api_key
+    response = session.get(ESUMMARY_URL, params=params, timeout=60)
+    response.raise_for_status()
+    result = response.json().get('result') or {}
+
+    placements = {}
+    for rsid in rsids:
+        docsum = result.get(str(rsid))
+        if docsum is None:
+            continue
+        if docsum.get('error'):
+            placements[rsid] = []
+            continue
+        spdis = [spdi for spdi in (docsum.get('spdi') or '').split(',')
+                 if spdi and spdi.split(':')[0] in GRCH38_ACCESSIONS]
+        placements[rsid] = spdis
+    return placements
+
 
 @retry_with_backoff(retries=5, backoff_factor=0.5)
 def get_variants(lead_url, session=None):
@@ -184,22 +344,187 @@ def get_variants(lead_url, session=None):
         raise
 
 
-def annotate_rsids(variants, session, lead_url, test_mode=True, overwrite_all=False, clear_not_found=False):
+def load_dbsnp_index(variants, vcf_path=None, index_path=None):
+    """
+    Open the offline dbSNP index, building or extending it from the dbSNP VCF when needed.
+
+    The index is rebuilt when the VCF has changed or when variants fall outside the indexed
+    regions; the new index covers the old regions plus the loci of all variants.
+
+    :param variants: Pandas DataFrame containing variants with GRCh38 coordinates
+    :param vcf_path: Path to the bgzipped NCBI dbSNP GRCh38 VCF (None to use an existing index only)
+    :param index_path: Path of the index file (default: next to the VCF)
+    :return: DbsnpIndex
+    """
+    index_path = index_path or get_index_path(vcf_path)
+    loci = group_variants_by_locus(variants, padding=DBSNP_INDEX_PADDING)
+
+    regions = []
+    if os.path.exists(index_path):
+        dbsnp_index = DbsnpIndex(index_path)
+        if vcf_path is None:
+            return dbsnp_index
+        uncovered = [locus for locus in loci
+                     if not (dbsnp_index.covers(locus['chrom'], locus['start']) and
+                             dbsnp_index.covers(locus['chrom'], locus['stop']))]
+        if dbsnp_index.is_current(vcf_path) and not uncovered:
+            return dbsnp_index
+        if dbsnp_index.is_current(vcf_path):
+            logger.info(f"Extending dbSNP index with {len(uncovered)} new regions")
+            regions = dbsnp_index.regions
+            loci = uncovered
+        else:
+            logger.info(f"dbSNP VCF changed since index was built, rebuilding: {vcf_path}")
+        dbsnp_index.close()
+    elif vcf_path is None:
+        raise FileNotFoundError(f"dbSNP index not found: {index_path}")
+
+    logger.info(f"Indexing dbSNP VCF records in {len(regions) + len(loci)} regions: {vcf_path}")
+    build_dbsnp_index(vcf_path, regions + loci, index_path, contig_names=GRCH38_CHROMOSOMES)
+    return DbsnpIndex(index_path)
+
+
+def load_position_filter(variants, vcf_path=None, filter_path=None):
+    """
+    Open the dbSNP position filter, building or extending it from a dbSNP VCF when needed.
+
+    :param variants: Pandas DataFrame containing variants with GRCh38 coordinates
+    :param vcf_path: Path to a bgzipped dbSNP GRCh38 VCF or extract (None to use an existing filter only)
+    :param filter_path: Path of the filter file (default: next to the VCF)
+    :return: PositionFilter
+    """
+    filter_path = filter_path or get_filter_path(vcf_path)
+    loci = group_variants_by_locus(variants, padding=DBSNP_INDEX_PADDING)
+
+    regions = []
+    if os.path.exists(filter_path):
+        position_filter = PositionFilter(filter_path)
+        if vcf_path is None:
+            return position_filter
+        uncovered = [locus for locus in loci
+                     if not position_filter.covers(locus['chrom'], locus['start'], locus['stop'])]
+        if position_filter.is_current(vcf_path) and not uncovered:
+            return position_filter
+        if position_filter.is_current(vcf_path):
+            logger.info(f"Extending dbSNP position filter with {len(uncovered)} new regions")
+            regions = position_filter.regions
+            loci = uncovered
+        else:
+            logger.info(f"dbSNP VCF changed since position filter was built, rebuilding: {vcf_path}")
+        position_filter.close()
+    elif vcf_path is None:
+        raise FileNotFoundError(f"dbSNP position filter not found: {filter_path}")
+
+    logger.info(f"Building dbSNP position filter for {len(regions) + len(loci)} regions: {vcf_path}")
+    build_position_filter(vcf_path, regions + loci, filter_path, contig_names=GRCH38_CHROMOSOMES)
+    return PositionFilter(filter_path)
+
+
+def apply_rsid_result(session, lead_url, row, rsid, test_mode=True, overwrite_all=False, clear_not_found=False):
+    """
+    Write the dbSNP result of one variant to the database.
+
+    :param session: Authenticated requests session
+    :param lead_url: Base URL of the API
+    :param row: Database variant row
+    :param rsid: rsID number from dbSNP, or None if not found
+    :param test_mode: If True, logs what would be updated without making PATCH requests
+    :param overwrite_all: If True, existing rsIDs are being overwritten
+    :param clear_not_found: If True, clear existing rsID when not found in dbSNP (only with overwrite_all)
+    :return: 'updated', 'not_found', or 'cleared' (not found and existing rsID cleared)
+    :raises requests.exceptions.RequestException: If the database update fails
+    """
+    db_variant_id = row.get('id')
+    current_rsid = row.get('rsid')
+    
+    if rsid is None:
+        logger.info(f"  → Not found in dbSNP")
+        
+        # Clear existing rsID if clear_not_found flag is set and overwrite_all is enabled
+        if clear_not_found and overwrite_all and current_rsid:
+            logger.info(f"  → Clearing existing rsID: {current_rsid}")
+            if not test_mode:
+                update_url = f"{lead_url}/variant/{db_variant_id}"
+                update_data = {"rsid": None}
+                update_response = session.patch(update_url, json=update_data, timeout=10)
+                update_response.raise_for_status()
+                logger.info(f"  ✓ Cleared rsID in database")
+            else:
+                logger.info(f"  ✓ TEST MODE: Would clear rsID")
+            return 'cleared'
+        return 'not_found'
+    
+    # Format rsID with 'rs' prefix
+    rsid_formatted = f"rs{rsid}"
+    logger.info(f"  ✓ Found rsID: {rsid_formatted}")
+    
+    # Update database with PATCH request
+    if not test_mode:
+        update_url = f"{lead_url}/variant/{db_variant_id}"
+        update_data = {"rsid": rsid_formatted}
+        update_response = session.patch(update_url, json=update_data, timeout=10)
+        update_response.raise_for_status()
+        logger.info(f"  ✓ Updated in database")
+    else:
+        logger.info(f"  ✓ TEST MODE: Would update with rsID: {rsid_formatted}")
+    return 'updated'
+
+
+def annotate_rsids(variants, session, lead_url, test_mode=True, overwrite_all=False, clear_not_found=False,
+                   reference=None, workers=1, api_key=None, dbsnp_index=None, position_filter=None,
+                   rsid_cache=None, refresh_cache=False, not_found_ttl_days=DEFAULT_NOT_FOUND_TTL_DAYS):
     """
     Annotate variants with rsIDs from dbSNP using GRCh38 coordinates.
 
+    With a reference genome, REF is checked against GRCh38 and variants are left-aligned and
+    trimmed before querying dbSNP; variants that can't be valid are skipped without a request.
+    Indels are then queried by NCBI's canonical SPDI, so every way of writing the same indel
+    in a repeat shares one lookup and one cache entry.
+
+    Variants with the same SPDI are looked up once per run and the answer applied to each of them.
+
+    With a dbsnp_index, rsIDs are looked up locally and NCBI is never queried; variants
+    outside the indexed regions are skipped.
+
+    With a position_filter, variants whose span doesn't touch any dbSNP record are counted as
+    "not found" without a request and never clear an existing rsID. Variants outside the
+    filtered regions are queried as usual. Without a reference, indels can't be left-aligned,
+    so only substitutions are answered by the filter and indels are queried as usual.
+
+    With an rsid_cache, every dbSNP answer (including "no rsID") is stored by SPDI and dbSNP
+    build, and variants with a cached answer are not queried again. A failed request is
+    reported as an error rather than as "not found", so it never clears an existing rsID.
+
+    With workers > 1, the variants are checked first and then looked up by a thread pool
+    under a token bucket (3 requests/s, or 10 with an NCBI API key), so a slow response no
+    longer holds up the next variant. Results are written to the database as they arrive.
+
     :param variants: Pandas DataFrame containing variants to annotate
     :param session: Authenticated requests session
     :param lead_url: Base URL of the API
     :param test_mode: If True, logs what would be updated without making PATCH requests
     :param overwrite_all: If True, update all variants; if False, only update variants without rsIDs
     :param clear_not_found: If True, clear existing rsID when not found in dbSNP (only with overwrite_all)
+    :param reference: Optional ReferenceGenome used to validate and normalize variants before lookups
+    :param workers: Number of concurrent dbSNP lookups (1 = sequential with a 0.5s delay)
+    :param api_key: Optional NCBI API key
+    :param dbsnp_index: Optional DbsnpIndex for offline lookups (see load_dbsnp_index)
+    :param position_filter: Optional PositionFilter of dbSNP-occupied positions (see load_position_filter)
+    :param rsid_cache: Optional RsidCache of SPDI to rsID answers
+    :param refresh_cache: If True, re-query NCBI for cached variants and update the cache
+    :param not_found_ttl_days: Days before a cached "no rsID" answer is queried again (None for no expiry)
     :return: Updated variants DataFrame
     """
-    updated_count = 0
     skipped_count = 0
-    not_found_count = 0
-    cleared_count = 0
+    
+    # Outcome counts ('updated', 'not_found', 'cleared', 'failed', and 'prefiltered' for position filter answers)
+    counts = Counter()
+    
+    # Lookups left to the worker pool: rows keyed by SPDI
+    queued = {}
+    
+    # dbSNP answers received during this run, keyed by SPDI
+    answered = {}
     
     for idx, row in variants.iterrows():
         # Get variant ID and coordinates
@@ -215,7 +540,10 @@ def annotate_rsids(variants, session, lead_url, test_mode=True, overwrite_all=Fa
         
         # Skip if missing required coordinates
         if pd.isna(chrom) or pd.isna(pos) or pd.isna(ref) or pd.isna(alt):
-            logger.info(f"  ⊘ Skipping - missing GRCh38 coordinates")
+            if not pd.isna(current_rsid) and current_rsid:
+                logger.info(f"  ⊘ Skipping - missing GRCh38 coordinates (has {current_rsid}, see --fill-coordinates)")
+            else:
+                logger.info(f"  ⊘ Skipping - missing GRCh38 coordinates")
             skipped_count += 1
             continue
         
@@ -240,63 +568,478 @@ def annotate_rsids(variants, session, lead_url, test_mode=True, overwrite_all=Fa
         # Normalize chromosome format (remove 'chr' prefix if present)
         chrom_normalized = str(chrom).replace('chr', '').replace('Chr', '').replace('CHR', '')
         
+        # Check REF against the reference and left-align/trim before spending a request
+        if reference is not None:
+            norm_pos, norm_ref, norm_alt, error = normalize_variant(reference, chrom_normalized, pos, ref, alt)
+            if error:
+                logger.info(f"  ⊘ Skipping - {error}")
+                skipped_count += 1
+                continue
+            if (norm_pos, norm_ref, norm_alt) != (int(float(pos)), str(ref), str(alt)):
+                logger.info(f"  → Normalized to {chrom_normalized}:{norm_pos} {norm_ref}>{norm_alt}")
+            pos, ref, alt = norm_pos, norm_ref, norm_alt
+        
+        # Offline mode: answer from the local dbSNP index without rate limiting
+        if dbsnp_index is not None:
+            if not dbsnp_index.covers(chrom_normalized, pos):
+                logger.info(f"  ⊘ Skipping - not covered by the offline dbSNP index")
+                skipped_count += 1
+                continue
+            try:
+                rsid = dbsnp_index.lookup(chrom_normalized, pos, ref, alt)
+                outcome = apply_rsid_result(session, lead_url, row, rsid, test_mode, overwrite_all, clear_not_found)
+                counts[outcome] += 1
+            except requests.exceptions.RequestException as e:
+                logger.error(f"  ✗ API Error: {str(e)[:100]}")
+                counts['failed'] += 1
+            continue
+        
+        if reference is not None:
+            spdi_pos, deleted, inserted = canonicalize_spdi(reference, chrom_normalized, pos, ref, alt)[:3]
+        else:
+            spdi_pos, deleted, inserted = pos, ref, alt
+        spdi = get_spdi(chrom_normalized, spdi_pos, deleted, inserted)
+        if not spdi:
+            logger.info(f"  ⊘ Skipping - no GRCh38 RefSeq accession for chromosome {chrom_normalized}")
+            skipped_count += 1
+            continue
+        
+        # Answer from this run or the cache when dbSNP has already been asked about this SPDI
+        known = answered
+        if rsid_cache is not None and not refresh_cache and spdi not in answered:
+            known = rsid_cache.get_many([spdi], not_found_ttl_days)
+        if spdi in known:
+            logger.info(f"  → Using {'earlier' if spdi in answered else 'cached'} dbSNP answer: {spdi}")
+            try:
+                outcome = apply_rsid_result(session, lead_url, row, known[spdi], test_mode, overwrite_all, clear_not_found)
+                counts[outcome] += 1
+            except requests.exceptions.RequestException as e:
+                logger.error(f"  ✗ API Error: {str(e)[:100]}")
+                counts['failed'] += 1
+            continue
+        
+        # No dbSNP record touches the variant (or the base on either side), so it can't have an rsID.
+        # Without the reference an indel isn't left-aligned and may sit further along a repeat
+        # than its dbSNP record, so only substitutions are answered by the filter then
+        substitution = (str(deleted) not in EMPTY_ALLELES and str(inserted) not in EMPTY_ALLELES and
+                        len(str(deleted)) == len(str(inserted)))
+        if position_filter is not None and (reference is not None or substitution):
+            span_start = int(float(spdi_pos)) - 1
+            span_stop = int(float(spdi_pos)) + (0 if str(deleted) in EMPTY_ALLELES else len(str(deleted)))
+            if (position_filter.covers(chrom_normalized, span_start, span_stop) and
+                    not position_filter.has_record(chrom_normalized, span_start, span_stop)):
+                # Not a dbSNP answer, so an existing rsID is left alone even with --clear-not-found
+                logger.info(f"  → No dbSNP record at {chrom_normalized}:{int(float(spdi_pos))} (position filter)")
+                counts['not_found'] += 1
+                counts['prefiltered'] += 1
+                continue
+        
+        # In worker-pool mode, lookups run concurrently once every variant has been checked
+        if workers > 1:
+            queued.setdefault(spdi, []).append(row)
+            continue
+        
         # Query dbSNP for rsID
         try:
-            rsid = get_rsid(chrom_normalized, pos, ref, alt, session=session)
-            
-            if rsid is None:
-                logger.info(f"  → Not found in dbSNP")
-                not_found_count += 1
-                
-                # Clear existing rsID if clear_not_found flag is set and overwrite_all is enabled
-                if clear_not_found and overwrite_all and current_rsid:
-                    logger.info(f"  → Clearing existing rsID: {current_rsid}")
-                    if not test_mode:
-                        update_url = f"{lead_url}/variant/{db_variant_id}"
-                        update_data = {"rsid": None}
-                        update_response = session.patch(update_url, json=update_data, timeout=10)
-                        update_response.raise_for_status()
-                        logger.info(f"  ✓ Cleared rsID in database")
-                        cleared_count += 1
-                    else:
-                        logger.info(f"  ✓ TEST MODE: Would clear rsID")
-                        cleared_count += 1
-                continue
-            
-            # Format rsID with 'rs' prefix
-            rsid_formatted = f"rs{rsid}"
-            logger.info(f"  ✓ Found rsID: {rsid_formatted}")
-            
-            # Update database with PATCH request
-            if not test_mode:
-                update_url = f"{lead_url}/variant/{db_variant_id}"
-                update_data = {"rsid": rsid_formatted}
-                update_response = session.patch(update_url, json=update_data, timeout=10)
-                update_response.raise_for_status()
-                logger.info(f"  ✓ Updated in database")
-                updated_count += 1
-            else:
-                logger.info(f"  ✓ TEST MODE: Would update with rsID: {rsid_formatted}")
-                updated_count += 1
+            rsid = query_spdi_rsid(spdi, session=session, api_key=api_key)
+            answered[spdi] = rsid
+            if rsid_cache is not None:
+                rsid_cache.put_many({spdi: rsid})
+            outcome = apply_rsid_result(session, lead_url, row, rsid, test_mode, overwrite_all, clear_not_found)
+            counts[outcome] += 1
                 
         except requests.exceptions.Timeout:
             logger.error(f"  ✗ Timeout (10s)")
+            counts['failed'] += 1
         except requests.exceptions.RequestException as e:
             logger.error(f"  ✗ API Error: {str(e)[:100]}")
+            counts['failed'] += 1
         
         # Rate limiting: NCBI allows 3 requests/second without API key, so wait 0.5s between requests
         time.sleep(0.5)
     
+    if queued:
+        rate = NCBI_API_KEY_RATE_LIMIT if api_key else NCBI_RATE_LIMIT
+        logger.info(f"Looking up {len(queued)} unique SPDIs with {workers} workers ({rate} requests/s)")
+        bucket = TokenBucket(rate)
+        
+        def lookup(spdi):
+            return query_spdi_rsid(spdi, session=session, api_key=api_key, bucket=bucket)
+        
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(lookup, spdi): spdi for spdi in queued}
+            # Results are written as they arrive, while the workers keep querying dbSNP
+            for future in as_completed(futures):
+                spdi = futures[future]
+                try:
+                    rsid = future.result()
+                except requests.exceptions.RequestException as e:
+                    logger.error(f"  ✗ {spdi}: API Error: {str(e)[:100]}")
+                    counts['failed'] += len(queued[spdi])
+                    continue
+                
+                # The cache is written from this thread only (SQLite connections aren't shared)
+                if rsid_cache is not None:
+                    rsid_cache.put_many({spdi: rsid})
+                for row in queued[spdi]:
+                    logger.info(f"Variant {row.get('id')}: {spdi}")
+                    try:
+                        outcome = apply_rsid_result(session, lead_url, row, rsid,
+                                                    test_mode, overwrite_all, clear_not_found)
+                        counts[outcome] += 1
+                    except requests.exceptions.Timeout:
+                        logger.error(f"  ✗ Timeout (10s)")
+                        counts['failed'] += 1
+                    except requests.exceptions.RequestException as e:
+                        logger.error(f"  ✗ API Error: {str(e)[:100]}")
+                        counts['failed'] += 1
+    
+    updated_count = counts['updated']
+    not_found_count = counts['not_found'] + counts['cleared']
+    cleared_count = counts['cleared']
+    
     logger.info("=" * 80)
     summary = f"Summary: {updated_count} variants updated, {skipped_count} skipped, {not_found_count} not found in dbSNP"
     if clear_not_found and cleared_count > 0:
         summary += f", {cleared_count} rsIDs cleared"
+    if counts['failed']:
+        summary += f", {counts['failed']} failed"
+    if counts['prefiltered']:
+        summary += f" ({counts['prefiltered']} answered by the position filter without a request)"
     logger.info(summary)
     logger.info("=" * 80)
     
     return variants
 
 
+def fetch_refsnp_statuses(rsids, session, workers=1, api_key=None, rsid_cache=None, refresh_cache=False):
+    """
+    Get the dbSNP status of many rsIDs, from the cache or with rate-limited concurrent requests.
+
+    :param rsids: Iterable of rsID numbers
+    :param session: Requests session object
+    :param workers: Number of concurrent requests
+    :param api_key: Optional NCBI API key
+    :param rsid_cache: Optional RsidCache for statuses
+    :param refresh_cache: If True, re-query NCBI for cached rsIDs
+    :return: Dict mapping rsID numbers to (status, merged_into) tuples (rsIDs whose request failed are left out)
+    """
+    rsids = set(rsids)
+    statuses = {}
+    if rsid_cache is not None and not refresh_cache:
+        statuses.update(rsid_cache.get_refsnp_status(rsids))
+        if statuses:
+            logger.info(f"Cache: {len(statuses)} of {len(rsids)} rsID statuses found in {rsid_cache.path}")
+
+    pending = sorted(rsids - set(statuses))
+    if not pending:
+        return statuses
+
+    rate = NCBI_API_KEY_RATE_LIMIT if api_key else NCBI_RATE_LIMIT
+    logger.info(f"Checking {len(pending)} rsIDs in dbSNP with {workers} workers ({rate} requests/s)")
+    bucket = TokenBucket(rate)
+
+    def lookup(rsid):
+        return query_refsnp_status(rsid, session=session, api_key=api_key, bucket=bucket)
+
+    fetched = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(lookup, rsid): rsid for rsid in pending}
+        for future in as_completed(futures):
+            rsid = futures[future]
+            try:
+                fetched[rsid] = future.result()
+            except requests.exceptions.RequestException as e:
+                logger.error(f"  ✗ rs{rsid}: API Error: {str(e)[:100]}")
+
+    if rsid_cache is not None and fetched:
+        rsid_cache.put_refsnp_status(fetched)
+    statuses.update(fetched)
+    return statuses
+
+
+def validate_existing_rsids(variants, session, lead_url, test_mode=True, workers=1, api_key=None,
+                            rsid_cache=None, refresh_cache=False):
+    """
+    Check stored rsIDs against dbSNP merge and withdrawal history.
+
+    Each unique stored rsID is checked once (NCBI's refsnp endpoint takes one rsID per
+    request, so the checks run on the rate-limited worker pool and are cached per dbSNP build).
+    Merged rsIDs are followed to their current rsID, and only rows whose rsID changed are
+    PATCHed. Withdrawn and unknown rsIDs are reported but left unchanged.
+
+    :param variants: Pandas DataFrame containing variants with an rsid column
+    :param session: Authenticated requests session
+    :param lead_url: Base URL of the API
+    :param test_mode: If True, logs what would be updated without making PATCH requests
+    :param workers: Number of concurrent dbSNP requests
+    :param api_key: Optional NCBI API key
+    :param rsid_cache: Optional RsidCache for rsID statuses
+    :param refresh_cache: If True, re-query NCBI for cached rsIDs
+    :return: Updated variants DataFrame
+    """
+    stored = {}
+    invalid_count = 0
+    for idx, row in variants.iterrows():
+        current_rsid = row.get('rsid')
+        if pd.isna(current_rsid) or not current_rsid:
+            continue
+        rsid = parse_rsid(current_rsid)
+        if rsid is None:
+            logger.warning(f"Variant {row.get('id')}: '{current_rsid}' is not an rsID, skipping")
+            invalid_count += 1
+            continue
+        stored[idx] = rsid
+
+    logger.info(f"Validating {len(stored)} stored rsIDs ({len(set(stored.values()))} unique)")
+    statuses = fetch_refsnp_statuses(stored.values(), session, workers, api_key, rsid_cache, refresh_cache)
+
+    # Follow merges until every chain ends at an rsID with a known status
+    for hop in range(MAX_MERGE_HOPS):
+        targets = {merged_into for status, merged_into in statuses.values()
+                   if status == 'merged' and merged_into and merged_into not in statuses}
+        if not targets:
+            break
+        statuses.update(fetch_refsnp_statuses(targets, session, workers, api_key, rsid_cache, refresh_cache))
+
+    counts = Counter()
+    for idx, rsid in stored.items():
+        row = variants.loc[idx]
+        db_variant_id = row.get('id')
+        if rsid not in statuses:
+            counts['failed'] += 1
+            continue
+
+        current = rsid
+        status, merged_into = statuses[current]
+        for hop in range(MAX_MERGE_HOPS):
+            if status != 'merged' or not merged_into or merged_into not in statuses:
+                break
+            current = merged_into
+            status, merged_into = statuses[current]
+
+        if current == rsid:
+            if status != 'current':
+                logger.warning(f"Variant {db_variant_id}: rs{rsid} is {status.replace('_', ' ')} in dbSNP")
+            counts[status] += 1
+            continue
+
+        if status != 'current':
+            logger.warning(f"Variant {db_variant_id}: rs{rsid} was merged into rs{current}, which is {status.replace('_', ' ')}")
+            counts['merged_unresolved'] += 1
+            continue
+
+        logger.info(f"Variant {db_variant_id}: rs{rsid} was merged into rs{current}")
+        try:
+            if not test_mode:
+                update_url = f"{lead_url}/variant/{db_variant_id}"
+                update_response = session.patch(update_url, json={"rsid": f"rs{current}"}, timeout=10)
+                update_response.raise_for_status()
+                logger.info(f"  ✓ Updated in database")
+            else:
+                logger.info(f"  ✓ TEST MODE: Would update rsID to rs{current}")
+            counts['updated'] += 1
+        except requests.exceptions.RequestException as e:
+            logger.error(f"  ✗ API Error: {str(e)[:100]}")
+
+    logger.info("=" * 80)
+    summary = (f"Summary: {counts['updated']} merged rsIDs updated, {counts['current']} current, "
+               f"{counts['withdrawn']} withdrawn, {counts['not_found']} not found in dbSNP")
+    other = counts['unsupported'] + counts['no_position'] + counts['merged_unresolved'] + counts['failed']
+    if other:
+        summary += f", {other} unresolved"
+    if invalid_count:
+        summary += f", {invalid_count} invalid rsID values"
+    logger.info(summary)
+    logger.info("=" * 80)
+
+    return variants
+
+
+def fetch_refsnp_placements(rsids, session, workers=1, api_key=None, rsid_cache=None, refresh_cache=False,
+                            not_found_ttl_days=DEFAULT_NOT_FOUND_TTL_DAYS):
+    """
+    Get the GRCh38 SPDI placements of many rsIDs, from the cache or with batched, rate-limited requests.
+
+    :param rsids: Iterable of rsID numbers
+    :param session: Requests session object
+    :param workers: Number of concurrent requests
+    :param api_key: Optional NCBI API key
+    :param rsid_cache: Optional RsidCache for placements
+    :param refresh_cache: If True, re-query NCBI for cached rsIDs
+    :param not_found_ttl_days: Days before a cached "no placement" answer is queried again (None for no expiry)
+    :return: Dict mapping rsID numbers to lists of SPDI strings (rsIDs whose request failed are left out)
+    """
+    rsids = set(rsids)
+    placements = {}
+    if rsid_cache is not None and not refresh_cache:
+        placements.update(rsid_cache.get_placements(rsids, not_found_ttl_days))
+        if placements:
+            logger.info(f"Cache: {len(placements)} of {len(rsids)} rsID placements found in {rsid_cache.path}")
+
+    pending = sorted(rsids - set(placements))
+    if not pending:
+        return placements
+
+    batches = [pending[i:i + REFSNP_BATCH_SIZE] for i in range(0, len(pending), REFSNP_BATCH_SIZE)]
+    rate = NCBI_API_KEY_RATE_LIMIT if api_key else NCBI_RATE_LIMIT
+    logger.info(f"Looking up {len(pending)} rsID placements in {len(batches)} requests "
+                f"with {workers} workers ({rate} requests/s)")
+    bucket = TokenBucket(rate)
+
+    def lookup(batch):
+        return query_refsnp_placements(batch, session=session, api_key=api_key, bucket=bucket)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(lookup, batch): batch for batch in batches}
+        for future in as_completed(futures):
+            batch = futures[future]
+            try:
+                fetched = future.result()
+            except requests.exceptions.RequestException as e:
+                logger.error(f"  ✗ rs{batch[0]}..rs{batch[-1]}: API Error: {str(e)[:100]}")
+                continue
+            missing = len(batch) - len(fetched)
+            if missing:
+                logger.warning(f"  ✗ {missing} rsIDs missing from the dbSNP response, not cached")
+            # The cache is written from this thread only (SQLite connections aren't shared)
+            if rsid_cache is not None and fetched:
+                rsid_cache.put_placements(fetched)
+            placements.update(fetched)
+
+    return placements
+
+
+def fill_coordinates_from_rsids(variants, session, lead_url, test_mode=True, workers=1, api_key=None,
+                                reference=None, rsid_cache=None, refresh_cache=False,
+                                not_found_ttl_days=DEFAULT_NOT_FOUND_TTL_DAYS):
+    """
+    Fill in missing GRCh38 coordinates from the dbSNP placement of each variant's rsID.
+
+    Rows with an rsID but any of grch38_chr/pos/ref/alt missing are resolved with batched
+    E-utilities requests (REFSNP_BATCH_SIZE rsIDs each). Each ALT allele of the rsID is
+    converted to database coordinates (left-aligned with the reference FASTA, if given), and
+    alleles that contradict a coordinate the row already has are dropped. When exactly one
+    allele is left, its values are PATCHed into the missing fields; multi-allelic rsIDs that
+    can't be narrowed down are reported and left for curation.
+
+    Insertions and deletions get their anchor base from the reference FASTA. Without one (or
+    if it doesn't cover the placement), alleles that would be empty are never written as '-':
+    they are dropped, and rows left with only such alleles are skipped.
+
+    :param variants: Pandas DataFrame containing variants
+    :param session: Authenticated requests session
+    :param lead_url: Base URL of the API
+    :param test_mode: If True, logs what would be updated without making PATCH requests
+    :param workers: Number of concurrent E-utilities requests
+    :param api_key: Optional NCBI API key
+    :param reference: Optional ReferenceGenome used to normalize the placements
+    :param rsid_cache: Optional RsidCache for placements
+    :param refresh_cache: If True, re-query NCBI for cached rsIDs
+    :param not_found_ttl_days: Days before a cached "no placement" answer is queried again (None for no expiry)
+    :return: Updated variants DataFrame (filled coordinates are also set in memory)
+    """
+    missing_rows = {}
+    for idx, row in variants.iterrows():
+        if all(pd.notna(row.get(field)) and str(row.get(field)).strip() for field in COORDINATE_FIELDS):
+            continue
+        current_rsid = row.get('rsid')
+        rsid = parse_rsid(current_rsid) if pd.notna(current_rsid) and current_rsid else None
+        if rsid is not None:
+            missing_rows[idx] = rsid
+
+    logger.info(f"Found {len(missing_rows)} variants with an rsID but missing GRCh38 coordinates "
+                f"({len(set(missing_rows.values()))} unique rsIDs)")
+    placements = fetch_refsnp_placements(missing_rows.values(), session, workers, api_key,
+                                         rsid_cache, refresh_cache, not_found_ttl_days)
+
+    counts = Counter()
+    for idx, rsid in missing_rows.items():
+        row = variants.loc[idx]
+        db_variant_id = row.get('id')
+        logger.info(f"Variant {db_variant_id}: rs{rsid}")
+        if rsid not in placements:
+            counts['failed'] += 1
+            continue
+        if not placements[rsid]:
+            logger.info(f"  → No GRCh38 placement in dbSNP")
+            counts['not_found'] += 1
+            continue
+
+        candidates = []
+        unanchored = []
+        for spdi in placements[rsid]:
+            coordinates = spdi_to_vcf(spdi)
+            if coordinates and reference is not None:
+                chrom, pos, ref, alt = coordinates
+                norm_pos, norm_ref, norm_alt, error = normalize_variant(reference, chrom, pos, ref, alt)
+                if not error:
+                    coordinates = (chrom, norm_pos, norm_ref, norm_alt)
+            # An empty allele needs the reference base before it, which only the FASTA can provide
+            if coordinates and (coordinates[2] in EMPTY_ALLELES or coordinates[3] in EMPTY_ALLELES):
+                unanchored.append(spdi)
+                continue
+            if coordinates and coordinates not in candidates:
+                candidates.append(coordinates)
+
+        if unanchored and not candidates:
+            logger.warning(f"  ⊘ Indel placement can't be anchored without a reference base "
+                           f"({', '.join(unanchored)}), skipping")
+            counts['unanchored'] += 1
+            continue
+
+        # Keep the alleles that agree with the coordinates the row already has
+        existing = {field: row.get(field) for field in COORDINATE_FIELDS
+                    if pd.notna(row.get(field)) and str(row.get(field)).strip()}
+        if 'grch38_chr' in existing:
+            candidates = [c for c in candidates if c[0] == normalize_chromosome(existing['grch38_chr'])]
+        if 'grch38_pos' in existing:
+            candidates = [c for c in candidates if c[1] == int(float(existing['grch38_pos']))]
+        if 'grch38_ref' in existing:
+            candidates = [c for c in candidates if c[2] == str(existing['grch38_ref']).strip().upper()]
+        if 'grch38_alt' in existing:
+            candidates = [c for c in candidates if c[3] == str(existing['grch38_alt']).strip().upper()]
+
+        if not candidates:
+            logger.warning(f"  ✗ dbSNP placement doesn't match the existing coordinates "
+                           f"({', '.join(placements[rsid])}), leaving for curation")
+            counts['conflicting'] += 1
+            continue
+        if len(candidates) > 1:
+            alleles = ', '.join(f"{ref}>{alt}" for chrom, pos, ref, alt in candidates)
+            logger.warning(f"  ⊘ Multi-allelic rsID ({alleles}), leaving for curation")
+            counts['ambiguous'] += 1
+            continue
+
+        update = {field: value for field, value in zip(COORDINATE_FIELDS, candidates[0]) if field not in existing}
+        description = ', '.join(f"{field}={value}" for field, value in update.items())
+        try:
+            if not test_mode:
+                update_url = f"{lead_url}/variant/{db_variant_id}"
+                update_response = session.patch(update_url, json=update, timeout=10)
+                update_response.raise_for_status()
+                logger.info(f"  ✓ Updated in database: {description}")
+            else:
+                logger.info(f"  ✓ TEST MODE: Would update {description}")
+            for field, value in update.items():
+                variants.at[idx, field] = value
+            counts['updated'] += 1
+        except requests.exceptions.RequestException as e:
+            logger.error(f"  ✗ API Error: {str(e)[:100]}")
+
+    logger.info("=" * 80)
+    summary = (f"Summary: {counts['updated']} variants given GRCh38 coordinates, {counts['ambiguous']} multi-allelic, "
+               f"{counts['conflicting']} conflicting, {counts['not_found']} without a GRCh38 placement")
+    if counts['unanchored']:
+        summary += f", {counts['unanchored']} indels skipped without a reference base"
+    if counts['failed']:
+        summary += f", {counts['failed']} failed"
+    logger.info(summary)
+    logger.info("=" * 80)
+
+    return variants
+
+
 if __name__ == "__main__":
     # Parse command-line arguments
     parser = argparse.ArgumentParser(
@@ -322,6 +1065,31 @@ Examples:
   # Use custom config file
   python annotate_rsid.py --config my_config.json
   
+  # Check REF and left-align/trim variants against a local GRCh38 FASTA before querying
+  python annotate_rsid.py --reference-fasta GRCh38.fa
+  
+  # Also annotate variants without GRCh38 coordinate fields, using their hgvs_genomic_grch38 description
+  python annotate_rsid.py --reference-fasta GRCh38.fa --hgvs-coordinates
+  
+  # Check stored rsIDs for merges and withdrawals, updating merged ones to the current rsID
+  python annotate_rsid.py --validate-existing --workers 4 --cache-db rsid_cache.sqlite
+  
+  # Fill in missing GRCh38 coordinates from existing rsIDs (batched dbSNP lookups)
+  python annotate_rsid.py --fill-coordinates --reference-fasta GRCh38.fa --cache-db rsid_cache.sqlite
+  
+  # Cache dbSNP answers so reruns only query variants with no known answer
+  python annotate_rsid.py --cache-db rsid_cache.sqlite --overwrite-all --clear-not-found
+  
+  # Offline mode - index the dbSNP VCF records of the blood group loci once, then look up locally
+  python annotate_rsid.py --dbsnp-vcf GCF_000001405.40.gz
+  
+  # Skip NCBI for positions without any dbSNP record (filter built once from a dbSNP VCF extract)
+  python annotate_rsid.py --position-filter-vcf dbsnp_blood_group_loci.vcf.gz --position-filter dbsnp_positions.idx
+  python annotate_rsid.py --position-filter dbsnp_positions.idx --workers 4
+  
+  # Worker-pool mode - 8 concurrent lookups at up to 10 requests/s with an NCBI API key
+  python annotate_rsid.py --workers 8 --ncbi-api-key YOUR_KEY
+  
   # Specify credentials directly
   python annotate_rsid.py --url https://api.blooddatabase.org --email user@example.com --password mypass
         """
@@ -341,6 +1109,85 @@ Examples:
         action='store_true',
         help='Clear existing rsIDs when not found in dbSNP (only works with --overwrite-all)'
     )
+    parser.add_argument(
+        '--reference-fasta',
+        metavar='FASTA',
+        help='Local GRCh38 FASTA used to check REF and left-align/trim variants before querying dbSNP'
+    )
+    parser.add_argument(
+        '--hgvs-coordinates',
+        action='store_true',
+        help='Derive missing GRCh38 coordinates from hgvs_genomic_grch38 locally (in memory; '
+             'indels need --reference-fasta)'
+    )
+    parser.add_argument(
+        '--validate-existing',
+        action='store_true',
+        help='Check stored rsIDs against dbSNP merge/withdrawal history and update merged ones '
+             '(instead of coordinate lookups)'
+    )
+    parser.add_argument(
+        '--fill-coordinates',
+        action='store_true',
+        help='Fill in missing GRCh38 coordinates of variants that have an rsID from its dbSNP placement '
+             '(instead of rsID lookups)'
+    )
+    parser.add_argument(
+        '--cache-db',
+        nargs='?',
+        const=DEFAULT_CACHE_PATH,
+        metavar='PATH',
+        help=f'Cache dbSNP answers (including "no rsID") in a SQLite file (default path: {DEFAULT_CACHE_PATH})'
+    )
+    parser.add_argument(
+        '--dbsnp-build',
+        default=DBSNP_BUILD,
+        help=f'dbSNP build label that cached answers are stored under (default: {DBSNP_BUILD})'
+    )
+    parser.add_argument(
+        '--not-found-ttl',
+        type=int,
+        default=DEFAULT_NOT_FOUND_TTL_DAYS,
+        metavar='DAYS',
+        help=f'Days before a cached "no rsID" answer is queried again (default: {DEFAULT_NOT_FOUND_TTL_DAYS})'
+    )
+    parser.add_argument(
+        '--refresh-cache',
+        action='store_true',
+        help='Re-query NCBI for cached variants and update the cache (requires --cache-db)'
+    )
+    parser.add_argument(
+        '--dbsnp-vcf',
+        metavar='VCF',
+        help='Offline mode: look up rsIDs in a local bgzipped NCBI dbSNP GRCh38 VCF (indexed on first use) instead of the API'
+    )
+    parser.add_argument(
+        '--dbsnp-index',
+        metavar='PATH',
+        help='Path of the offline dbSNP index (default: next to --dbsnp-vcf); can be used without --dbsnp-vcf once built'
+    )
+    parser.add_argument(
+        '--position-filter',
+        metavar='PATH',
+        help='dbSNP position filter: variants at positions without any dbSNP record are not looked up '
+             '(default path: next to --position-filter-vcf)'
+    )
+    parser.add_argument(
+        '--position-filter-vcf',
+        metavar='VCF',
+        help='Bgzipped dbSNP GRCh38 VCF (or extract) to build the position filter from on first use'
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=1,
+        help='Number of concurrent dbSNP lookups (default: 1, sequential); requests are limited to '
+             f'{NCBI_RATE_LIMIT}/s, or {NCBI_API_KEY_RATE_LIMIT}/s with an NCBI API key'
+    )
+    parser.add_argument(
+        '--ncbi-api-key',
+        help='NCBI API key (default: "ncbi_api_key" in the config file or the NCBI_API_KEY environment variable)'
+    )
     parser.add_argument(
         '--limit',
         type=int,
@@ -367,6 +1214,7 @@ Examples:
     args = parser.parse_args()
     
     # Load configuration
+    api_key = args.ncbi_api_key or os.environ.get('NCBI_API_KEY')
     if args.url and args.email and args.password:
         # Use command-line arguments
         lead_url = args.url
@@ -382,6 +1230,7 @@ Examples:
             lead_url = args.url or config['lead_url']
             email = args.email or config['email']
             password = args.password or config['password']
+            api_key = api_key or config.get('ncbi_api_key')
             logger.info(f"Loaded configuration from {args.config}")
         except FileNotFoundError:
             logger.error(f"Config file '{args.config}' not found.")
@@ -396,6 +1245,9 @@ Examples:
         logger.error("--clear-not-found requires --overwrite-all to be set")
         logger.error("Use: python annotate_rsid.py --overwrite-all --clear-not-found")
         raise ValueError("--clear-not-found requires --overwrite-all")
+    if args.refresh_cache and not args.cache_db:
+        logger.error("--refresh-cache requires --cache-db to be set")
+        raise ValueError("--refresh-cache requires --cache-db")
 
     try:
         # Authenticate and fetch variants
@@ -404,9 +1256,24 @@ Examples:
         logger.info(f"Overwrite existing: {'YES' if args.overwrite_all else 'NO (only update variants without rsIDs)'}")
         if args.clear_not_found:
             logger.info(f"Clear not found: YES (will clear rsIDs not found in dbSNP)")
+        if args.validate_existing:
+            logger.info(f"Validate existing: YES (check stored rsIDs for merges and withdrawals)")
+        if args.fill_coordinates:
+            logger.info(f"Fill coordinates: YES (GRCh38 coordinates from the dbSNP placement of existing rsIDs)")
+        if args.cache_db:
+            logger.info(f"Cache: {args.cache_db} (dbSNP build {args.dbsnp_build}{', refreshing' if args.refresh_cache else ''})")
+        if args.dbsnp_vcf or args.dbsnp_index:
+            logger.info(f"Offline mode: YES (dbSNP index {args.dbsnp_index or get_index_path(args.dbsnp_vcf)}, no API requests)")
+        elif args.workers > 1:
+            rate = NCBI_API_KEY_RATE_LIMIT if api_key else NCBI_RATE_LIMIT
+            logger.info(f"Worker pool: YES ({args.workers} workers, {rate} requests/s{' with NCBI API key' if api_key else ''})")
+        if (args.position_filter or args.position_filter_vcf) and not (args.dbsnp_vcf or args.dbsnp_index):
+            logger.info(f"Position filter: YES ({args.position_filter or get_filter_path(args.position_filter_vcf)})")
+        if args.hgvs_coordinates:
+            logger.info(f"HGVS coordinates: YES (missing GRCh38 coordinates derived from hgvs_genomic_grch38)")
         
         logger.info(f"Connecting to: {lead_url}")
-        session = login(lead_url, email, password)
+        session = login(lead_url, email, password, pool_maxsize=max(DEFAULT_POOL_MAXSIZE, args.workers))
         
         logger.info("Fetching variants from database...")
         variants = get_variants(lead_url, session=session)
@@ -423,14 +1290,81 @@ Examples:
         if args.limit:
             logger.info(f"Processing only first {args.limit} variants")
         
-        annotate_rsids(
-            variants_to_process,
-            session,
-            lead_url,
-            test_mode=args.test_mode,
-            overwrite_all=args.overwrite_all,
-            clear_not_found=args.clear_not_found
-        )
+        reference = ReferenceGenome(args.reference_fasta) if args.reference_fasta else None
+        if args.hgvs_coordinates:
+            variants_to_process = fill_coordinates_from_hgvs(variants_to_process, reference)
+        
+        rsid_cache = RsidCache(args.cache_db, args.dbsnp_build) if args.cache_db else None
+        
+        dbsnp_index = None
+        position_filter = None
+        if args.validate_existing:
+            validate_existing_rsids(
+                variants_to_process,
+                session,
+                lead_url,
+                test_mode=args.test_mode,
+                workers=args.workers,
+                api_key=api_key,
+                rsid_cache=rsid_cache,
+                refresh_cache=args.refresh_cache
+            )
+        elif args.fill_coordinates:
+            fill_coordinates_from_rsids(
+                variants_to_process,
+                session,
+                lead_url,
+                test_mode=args.test_mode,
+                workers=args.workers,
+                api_key=api_key,
+                reference=reference,
+                rsid_cache=rsid_cache,
+                refresh_cache=args.refresh_cache,
+                not_found_ttl_days=args.not_found_ttl
+            )
+        else:
+            if args.dbsnp_vcf or args.dbsnp_index:
+                dbsnp_index = load_dbsnp_index(variants_to_process, args.dbsnp_vcf, args.dbsnp_index)
+                logger.info(f"dbSNP index: {dbsnp_index.header['record_count']} alleles in {len(dbsnp_index.regions)} regions"
+                            f" (build {dbsnp_index.dbsnp_build or 'unknown'})")
+            elif args.position_filter or args.position_filter_vcf:
+                position_filter = load_position_filter(variants_to_process, args.position_filter_vcf, args.position_filter)
+                logger.info(f"Position filter: {position_filter.header['interval_count']} intervals in "
+                            f"{len(position_filter.regions)} regions (build {position_filter.dbsnp_build or 'unknown'})")
+                if position_filter.dbsnp_build and position_filter.dbsnp_build != args.dbsnp_build:
+                    logger.error(f"Position filter is from dbSNP build {position_filter.dbsnp_build}, "
+                                 f"but --dbsnp-build is {args.dbsnp_build}")
+                    logger.error("Rebuild the filter from a matching dbSNP VCF, or set --dbsnp-build to match")
+                    position_filter.close()
+                    raise ValueError("Position filter dbSNP build doesn't match --dbsnp-build")
+        
+            annotate_rsids(
+                variants_to_process,
+                session,
+                lead_url,
+                test_mode=args.test_mode,
+                overwrite_all=args.overwrite_all,
+                clear_not_found=args.clear_not_found,
+                reference=reference,
+                workers=args.workers,
+                api_key=api_key,
+                dbsnp_index=dbsnp_index,
+                position_filter=position_filter,
+                rsid_cache=rsid_cache,
+                refresh_cache=args.refresh_cache,
+                not_found_ttl_days=args.not_found_ttl
+            )
+        
+        if reference:
+            reference.close()
+        if dbsnp_index:
+            dbsnp_index.close()
+        if position_filter:
+            position_filter.close()
+        if rsid_cache:
+            rsid_cache.close()
+        
+        log_connection_stats(session)
         
         logger.info("=" * 80)
         logger.info(f"ANNOTATION COMPLETE")
@@ -0,0 +1,125 @@
+"""
+Minimal reader for BGZF-compressed (bgzipped) files such as gnomAD and dbSNP sites VCFs.
+
+BGZF files are a series of independently compressed gzip blocks of at most 64 KB, so a
+reader can seek to any block start and decompress from there. This module provides:
+1. Block-level reading from a compressed file offset
+2. Line iteration starting at any block
+3. Locating the next block start after an arbitrary byte offset (used for binary search)
+
+Only the Python standard library is used, so no htslib/pysam installation is required.
+
+Author: Nick Gleadall
+Date: November 2025
+"""
+
+import os
+import struct
+import zlib
+
+BGZF_MAGIC = b'\x1f\x8b\x08\x04'
+
+# Maximum size of a single BGZF block (compressed or uncompressed)
+MAX_BLOCK_SIZE = 65536
+
+
+class BgzfReader:
+    """
+    Random-access reader for a BGZF file, addressed by compressed block offsets.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: Path to the bgzipped file
+        """
+        self.path = path
+        self.size = os.path.getsize(path)
+        self.handle = open(path, 'rb')
+
+    def close(self):
+        self.handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def read_block(self, offset):
+        """
+        Read and decompress the block starting at a compressed file offset.
+
+        :param offset: Compressed offset of the block start
+        :return: Tuple of (uncompressed bytes, offset of the next block), or (None, None) at end of file
+        :raises ValueError: If no valid BGZF block starts at offset
+        """
+        self.handle.seek(offset)
+        header = self.handle.read(12)
+        if not header:
+            return None, None
+        if len(header) < 12 or header[:4] != BGZF_MAGIC:
+            raise ValueError(f"No BGZF block at offset {offset} in {self.path}")
+
+        xlen = struct.unpack('<H', header[10:12])[0]
+        extra = self.handle.read(xlen)
+
+        # Find the 'BC' subfield holding the total block size minus one
+        block_size = None
+        pos = 0
+        while pos + 4 <= len(extra):
+            subfield_id = extra[pos:pos + 2]
+            subfield_length = struct.unpack('<H', extra[pos + 2:pos + 4])[0]
+            if subfield_id == b'BC' and subfield_length == 2:
+                block_size = struct.unpack('<H', extra[pos + 4:pos + 6])[0] + 1
+            pos += 4 + subfield_length
+        if block_size is None:
+            raise ValueError(f"Missing BGZF block size at offset {offset} in {self.path}")
+
+        compressed = self.handle.read(block_size - 12 - xlen)
+        data = zlib.decompress(compressed[:-8], -15)
+        return data, offset + block_size
+
+    def find_block(self, offset):
+        """
+        Find the first valid block starting at or after a compressed file offset.
+
+        :param offset: Any compressed file offset
+        :return: Offset of the next block start, or None if there is none
+        """
+        while offset < self.size:
+            self.handle.seek(offset)
+            window = self.handle.read(MAX_BLOCK_SIZE + len(BGZF_MAGIC))
+            candidate = window.find(BGZF_MAGIC)
+            while candidate != -1:
+                try:
+                    self.read_block(offset + candidate)
+                    return offset + candidate
+                except (ValueError, zlib.error, struct.error):
+                    candidate = window.find(BGZF_MAGIC, candidate + 1)
+            offset += MAX_BLOCK_SIZE
+        return None
+
+    def iter_lines(self, offset=0, skip_partial=False):
+        """
+        Iterate over the lines of the uncompressed stream starting at a block.
+
+        :param offset: Compressed offset of the block to start at
+        :param skip_partial: If True, drop the first line, which may start in an earlier block
+        :return: Generator of lines (bytes, without the trailing newline)
+        """
+        buffer = b''
+        first = skip_partial
+        while offset is not None and offset < self.size:
+            data, offset = self.read_block(offset)
+            if data is None:
+                break
+            buffer += data
+            lines = buffer.split(b'\n')
+            buffer = lines.pop()
+            for line in lines:
+                if first:
+                    first = False
+                    continue
+                yield line
+        if buffer and not first:
+            yield buffer
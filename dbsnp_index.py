@@ -0,0 +1,281 @@
+"""
+Offline rsID lookup from a locally indexed subset of the NCBI dbSNP GRCh38 VCF.
+
+The full dbSNP VCF is over 20 GB, but the blood group database only needs the records
+inside its gene loci. The records of those loci are read once (seeking to each locus with
+the region index of vcf_index.py) and written to a compact binary index:
+
+1. A JSON header (source VCF, dbSNP build, covered regions)
+2. Fixed-width records sorted by (chromosome, position): key, rsID and allele offset
+3. A blob of "REF>ALT" allele strings
+
+Later runs memory-map the file and binary-search the sorted keys, so a lookup touches only
+a few pages and no request is sent to NCBI.
+
+Alleles are stored trimmed to their minimal form (shared leading and trailing bases
+removed), so anchored VCF-style indels match regardless of the anchor base convention.
+
+Author: Nick Gleadall
+Date: November 2025
+"""
+
+import json
+import logging
+import mmap
+import os
+import struct
+
+import numpy as np
+
+from bgzf import BgzfReader
+from reference_genome import EMPTY_ALLELES, chromosome_aliases
+from vcf_index import CHROMOSOME_ORDER, read_regions
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'ISBTSNP1'
+
+# Chromosome codes stored in the upper 32 bits of each record key
+CHROMOSOME_CODES = {chrom: code for code, chrom in enumerate(CHROMOSOME_ORDER)}
+
+RECORD_DTYPE = np.dtype([
+    ('key', '<u8'),
+    ('rsid', '<u8'),
+    ('allele_offset', '<u4'),
+    ('allele_length', '<u4')
+])
+
+INDEX_SUFFIX = '.isbt-dbsnp.idx'
+
+
+def trim_alleles(pos, ref, alt):
+    """
+    Trim shared trailing, then shared leading, bases from a pair of alleles.
+
+    :param pos: Position of the first REF base (1-based)
+    :param ref: Reference allele
+    :param alt: Alternate allele
+    :return: Tuple of (pos, ref, alt); either allele may become empty
+    """
+    while ref and alt and ref[-1] == alt[-1]:
+        ref, alt = ref[:-1], alt[:-1]
+    while ref and alt and ref[0] == alt[0]:
+        ref, alt = ref[1:], alt[1:]
+        pos += 1
+    return pos, ref, alt
+
+
+def record_key(chrom, pos):
+    """
+    Sort key of a chromosome and position.
+
+    :param chrom: Chromosome name (any of 'chr1', '1', 'NC_000001.11')
+    :param pos: Position (1-based)
+    :return: Integer key, or None for chromosomes outside CHROMOSOME_ORDER
+    """
+    code = CHROMOSOME_CODES.get(chromosome_aliases(str(chrom)))
+    if code is None:
+        return None
+    return (code << 32) | int(pos)
+
+
+def get_index_path(vcf_path):
+    """
+    Default path of the dbSNP index for a VCF.
+    """
+    return vcf_path + INDEX_SUFFIX
+
+
+def read_dbsnp_build(vcf_path):
+    """
+    Read the dbSNP build number from the ##dbSNP_BUILD_ID header line.
+
+    :param vcf_path: Path to the bgzipped dbSNP VCF
+    :return: Build number as a string, or None if the header has none
+    """
+    with BgzfReader(vcf_path) as reader:
+        for line in reader.iter_lines(0):
+            if not line.startswith(b'#'):
+                break
+            if line.startswith(b'##dbSNP_BUILD_ID='):
+                return line.split(b'=', 1)[1].strip().decode()
+    return None
+
+
+def parse_dbsnp_record(line):
+    """
+    Parse the rsID and alleles of a dbSNP VCF record.
+
+    :param line: VCF record line (bytes)
+    :return: List of (key, rsid, allele string) tuples, one per ALT allele
+    """
+    chrom, pos, variant_ids, ref, alts = line.split(b'\t', 5)[:5]
+    key_pos = int(pos)
+    ref = ref.decode().upper()
+
+    rsids = [int(variant_id[2:]) for variant_id in variant_ids.split(b';') if variant_id.startswith(b'rs')]
+    if not rsids:
+        return []
+
+    entries = []
+    for alt in alts.decode().upper().split(','):
+        if alt in ('.', '*') or alt.startswith('<'):
+            continue
+        trimmed_pos, trimmed_ref, trimmed_alt = trim_alleles(key_pos, ref, alt)
+        key = record_key(chrom.decode(), trimmed_pos)
+        if key is not None:
+            entries.append((key, rsids[0], f"{trimmed_ref}>{trimmed_alt}"))
+    return entries
+
+
+def build_dbsnp_index(vcf_path, loci, index_path=None, contig_names=None):
+    """
+    Read the dbSNP records of each locus and write them to a binary index.
+
+    :param vcf_path: Path to the bgzipped dbSNP GRCh38 VCF
+    :param loci: List of dicts with 'chrom', 'start' and 'stop' (normalized chromosome names)
+    :param index_path: Path of the index file (default: next to the VCF)
+    :param contig_names: Dict mapping normalized chromosome names to the VCF's contig names
+                         (e.g. GRCh38 RefSeq accessions for the NCBI dbSNP VCF)
+    :return: Path of the written index file
+    """
+    index_path = index_path or get_index_path(vcf_path)
+    contig_names = contig_names or {}
+
+    vcf_loci = [dict(locus, chrom=contig_names.get(locus['chrom'], locus['chrom'])) for locus in loci]
+    entries = set()
+    for locus, lines in read_regions(vcf_path, vcf_loci, os.path.dirname(os.path.abspath(index_path))):
+        for line in lines:
+            entries.update(parse_dbsnp_record(line))
+    entries = sorted(entries)
+
+    records = np.zeros(len(entries), dtype=RECORD_DTYPE)
+    alleles = bytearray()
+    for i, (key, rsid, allele_string) in enumerate(entries):
+        encoded = allele_string.encode()
+        records[i] = (key, rsid, len(alleles), len(encoded))
+        alleles += encoded
+
+    stat = os.stat(vcf_path)
+    header = {
+        'vcf': os.path.basename(vcf_path),
+        'vcf_size': stat.st_size,
+        'vcf_mtime': int(stat.st_mtime),
+        'dbsnp_build': read_dbsnp_build(vcf_path),
+        'regions': [{'chrom': locus['chrom'], 'start': locus['start'], 'stop': locus['stop']} for locus in loci],
+        'record_count': len(records)
+    }
+    header_bytes = json.dumps(header).encode()
+    records_offset = len(MAGIC) + 4 + len(header_bytes)
+    # Align the record array so it can be memory-mapped directly
+    padding = (-records_offset) % RECORD_DTYPE.itemsize
+    records_offset += padding
+
+    tmp_path = index_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<I', len(header_bytes)))
+        f.write(header_bytes)
+        f.write(b'\0' * padding)
+        f.write(records.tobytes())
+        f.write(bytes(alleles))
+    os.replace(tmp_path, index_path)
+
+    logger.info(f"Saved dbSNP index ({len(records)} alleles in {len(loci)} regions): {index_path}")
+    return index_path
+
+
+class DbsnpIndex:
+    """
+    Memory-mapped, binary-searchable dbSNP index written by build_dbsnp_index.
+    """
+
+    def __init__(self, index_path):
+        """
+        :param index_path: Path of the index file
+        :raises ValueError: If the file is not a dbSNP index
+        """
+        self.path = index_path
+        self.handle = open(index_path, 'rb')
+        self.data = mmap.mmap(self.handle.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.data[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError(f"Not a dbSNP index: {index_path}")
+
+        header_length = struct.unpack('<I', self.data[len(MAGIC):len(MAGIC) + 4])[0]
+        header_end = len(MAGIC) + 4 + header_length
+        self.header = json.loads(self.data[len(MAGIC) + 4:header_end])
+
+        records_offset = header_end + (-header_end) % RECORD_DTYPE.itemsize
+        count = self.header['record_count']
+        self.records = np.frombuffer(self.data, dtype=RECORD_DTYPE, count=count, offset=records_offset)
+        self.keys = self.records['key']
+        self.alleles_offset = records_offset + count * RECORD_DTYPE.itemsize
+
+    def close(self):
+        # The NumPy views must be released before the mmap can be closed
+        self.records = None
+        self.keys = None
+        self.data.close()
+        self.handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def dbsnp_build(self):
+        return self.header.get('dbsnp_build')
+
+    @property
+    def regions(self):
+        return self.header['regions']
+
+    def is_current(self, vcf_path):
+        """
+        Whether the index was built from this VCF in its current state (same size and modification time).
+        """
+        stat = os.stat(vcf_path)
+        return self.header.get('vcf_size') == stat.st_size and self.header.get('vcf_mtime') == int(stat.st_mtime)
+
+    def covers(self, chrom, pos):
+        """
+        Whether a position lies inside the indexed regions (otherwise lookups can't tell "not in dbSNP").
+
+        :param chrom: Chromosome name
+        :param pos: Position (1-based)
+        """
+        chrom = chromosome_aliases(str(chrom))
+        pos = int(float(pos))
+        return any(region['chrom'] == chrom and region['start'] <= pos <= region['stop'] for region in self.regions)
+
+    def lookup(self, chrom, pos, ref, alt):
+        """
+        Find the rsID of a variant.
+
+        :param chrom: Chromosome name
+        :param pos: Position (1-based)
+        :param ref: Reference allele
+        :param alt: Alternate allele
+        :return: rsID number (without 'rs' prefix), or None if the variant is not in the index
+        """
+        ref = str(ref).strip().upper()
+        alt = str(alt).strip().upper()
+        ref = '' if ref in EMPTY_ALLELES else ref
+        alt = '' if alt in EMPTY_ALLELES else alt
+        pos, ref, alt = trim_alleles(int(float(pos)), ref, alt)
+        key = record_key(chrom, pos)
+        if key is None:
+            return None
+
+        wanted = f"{ref}>{alt}".encode()
+        start = np.searchsorted(self.keys, key, side='left')
+        stop = np.searchsorted(self.keys, key, side='right')
+        for record in self.records[start:stop]:
+            offset = self.alleles_offset + int(record['allele_offset'])
+            if self.data[offset:offset + int(record['allele_length'])] == wanted:
+                return int(record['rsid'])
+        return None
@@ -0,0 +1,212 @@
+"""
+Compact filter of the GRCh38 positions that have any dbSNP record.
+
+Full offline rsID lookups (dbsnp_index.py) need the dbSNP VCF, or an index of its alleles
+and rsIDs. This filter keeps only where dbSNP records are: the reference span of every
+record in the blood group loci, merged into sorted, non-overlapping intervals. dbSNP is dense,
+so neighbouring records collapse into few intervals, and the file stays small enough to build
+once and copy to any machine that runs the annotation.
+
+A variant whose span doesn't touch any interval can't have an rsID in that dbSNP build, so
+it is reported as "not found" without an NCBI request. Unlike a Bloom filter, the interval
+search is exact: there are no false positives and no false negatives, provided the variant
+span is the canonical (left-aligned) one. annotate_rsid.py therefore only filters indels
+when a reference FASTA is given, and substitutions otherwise.
+
+Author: Nick Gleadall
+Date: November 2025
+"""
+
+import json
+import logging
+import mmap
+import os
+import struct
+
+import numpy as np
+
+from dbsnp_index import read_dbsnp_build, record_key
+from reference_genome import chromosome_aliases
+from vcf_index import read_regions
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'ISBTPOS1'
+
+FILTER_SUFFIX = '.isbt-dbsnp-pos.idx'
+
+
+def get_filter_path(vcf_path):
+    """
+    Default path of the position filter for a VCF.
+    """
+    return vcf_path + FILTER_SUFFIX
+
+
+def merge_intervals(starts, ends):
+    """
+    Merge overlapping and adjacent intervals.
+
+    :param starts: NumPy array of interval starts (record keys, inclusive)
+    :param ends: NumPy array of interval ends (record keys, inclusive)
+    :return: Tuple of (starts, ends) arrays of sorted, non-overlapping intervals
+    """
+    if not len(starts):
+        return np.zeros(0, dtype='<u8'), np.zeros(0, dtype='<u8')
+    order = np.argsort(starts, kind='stable')
+    starts, ends = starts[order], ends[order]
+    reach = np.maximum.accumulate(ends)
+    # A new interval begins where a start lies beyond everything before it (plus one for adjacency)
+    new = np.ones(len(starts), dtype=bool)
+    new[1:] = starts[1:] > reach[:-1] + 1
+    first = np.flatnonzero(new)
+    last = np.append(first[1:], len(starts)) - 1
+    return starts[first].astype('<u8'), reach[last].astype('<u8')
+
+
+def build_position_filter(vcf_path, loci, filter_path=None, contig_names=None):
+    """
+    Read the dbSNP records of each locus and write their merged reference spans to a filter file.
+
+    :param vcf_path: Path to a bgzipped dbSNP GRCh38 VCF (the full file or an extract of it)
+    :param loci: List of dicts with 'chrom', 'start' and 'stop' (normalized chromosome names)
+    :param filter_path: Path of the filter file (default: next to the VCF)
+    :param contig_names: Dict mapping normalized chromosome names to the VCF's contig names
+    :return: Path of the written filter file
+    """
+    filter_path = filter_path or get_filter_path(vcf_path)
+    contig_names = contig_names or {}
+
+    vcf_loci = [dict(locus, chrom=contig_names.get(locus['chrom'], locus['chrom'])) for locus in loci]
+    starts = []
+    ends = []
+    record_count = 0
+    for locus, lines in read_regions(vcf_path, vcf_loci, os.path.dirname(os.path.abspath(filter_path))):
+        for line in lines:
+            chrom, pos, variant_ids, ref = line.split(b'\t', 5)[:4]
+            if b'rs' not in variant_ids:
+                continue
+            key = record_key(chrom.decode(), int(pos))
+            if key is None:
+                continue
+            starts.append(key)
+            ends.append(key + max(len(ref), 1) - 1)
+            record_count += 1
+
+    starts, ends = merge_intervals(np.array(starts, dtype='<u8'), np.array(ends, dtype='<u8'))
+
+    stat = os.stat(vcf_path)
+    header = {
+        'vcf': os.path.basename(vcf_path),
+        'vcf_size': stat.st_size,
+        'vcf_mtime': int(stat.st_mtime),
+        'dbsnp_build': read_dbsnp_build(vcf_path),
+        'regions': [{'chrom': locus['chrom'], 'start': locus['start'], 'stop': locus['stop']} for locus in loci],
+        'record_count': record_count,
+        'interval_count': len(starts)
+    }
+    header_bytes = json.dumps(header).encode()
+    arrays_offset = len(MAGIC) + 4 + len(header_bytes)
+    # Align the interval arrays so they can be memory-mapped directly
+    padding = (-arrays_offset) % 8
+
+    tmp_path = filter_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<I', len(header_bytes)))
+        f.write(header_bytes)
+        f.write(b'\0' * padding)
+        f.write(starts.tobytes())
+        f.write(ends.tobytes())
+    os.replace(tmp_path, filter_path)
+
+    logger.info(f"Saved dbSNP position filter ({record_count} records as {len(starts)} intervals "
+                f"in {len(loci)} regions): {filter_path}")
+    return filter_path
+
+
+class PositionFilter:
+    """
+    Memory-mapped dbSNP position filter written by build_position_filter.
+    """
+
+    def __init__(self, filter_path):
+        """
+        :param filter_path: Path of the filter file
+        :raises ValueError: If the file is not a dbSNP position filter
+        """
+        self.path = filter_path
+        self.handle = open(filter_path, 'rb')
+        self.data = mmap.mmap(self.handle.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.data[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError(f"Not a dbSNP position filter: {filter_path}")
+
+        header_length = struct.unpack('<I', self.data[len(MAGIC):len(MAGIC) + 4])[0]
+        header_end = len(MAGIC) + 4 + header_length
+        self.header = json.loads(self.data[len(MAGIC) + 4:header_end])
+
+        arrays_offset = header_end + (-header_end) % 8
+        count = self.header['interval_count']
+        self.starts = np.frombuffer(self.data, dtype='<u8', count=count, offset=arrays_offset)
+        self.ends = np.frombuffer(self.data, dtype='<u8', count=count, offset=arrays_offset + count * 8)
+
+    def close(self):
+        # The NumPy views must be released before the mmap can be closed
+        self.starts = None
+        self.ends = None
+        self.data.close()
+        self.handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def dbsnp_build(self):
+        return self.header.get('dbsnp_build')
+
+    @property
+    def regions(self):
+        return self.header['regions']
+
+    def is_current(self, vcf_path):
+        """
+        Whether the filter was built from this VCF in its current state (same size and modification time).
+        """
+        stat = os.stat(vcf_path)
+        return self.header.get('vcf_size') == stat.st_size and self.header.get('vcf_mtime') == int(stat.st_mtime)
+
+    def covers(self, chrom, start, stop=None):
+        """
+        Whether a span lies inside the filtered regions (otherwise the filter can't tell "no record").
+
+        :param chrom: Chromosome name
+        :param start: First position (1-based)
+        :param stop: Last position (default: start)
+        """
+        chrom = chromosome_aliases(str(chrom))
+        start = int(float(start))
+        stop = start if stop is None else int(float(stop))
+        return any(region['chrom'] == chrom and region['start'] <= start and stop <= region['stop']
+                   for region in self.regions)
+
+    def has_record(self, chrom, start, stop=None):
+        """
+        Whether any dbSNP record overlaps a span.
+
+        :param chrom: Chromosome name
+        :param start: First position (1-based)
+        :param stop: Last position (default: start)
+        :return: True if a record overlaps the span (or the chromosome can't be encoded)
+        """
+        start_key = record_key(chrom, int(float(start)))
+        if start_key is None:
+            return True
+        stop_key = start_key if stop is None else record_key(chrom, int(float(stop)))
+        # The last interval starting at or before the span's end is the only one that can overlap it
+        i = np.searchsorted(self.starts, np.uint64(stop_key), side='right') - 1
+        return bool(i >= 0 and self.ends[i] >= start_key)
@@ -0,0 +1,468 @@
+"""
+Exon/intron structure of RefSeq transcripts, cached on disk, and local exon/intron numbering.
+
+Most database variants lie on a small set of NM_ transcripts (one or two per blood group
+gene). Instead of a full VariantValidator call per variant, the exon table of each transcript
+is fetched once from VariantValidator's gene2transcripts tool and stored in a local SQLite
+file keyed by transcript version. Exon and intron numbers are then computed locally from the
+HGVS c. (or n.) positions of each variant, for the whole DataFrame at once:
+
+1. All descriptions are parsed with one vectorized regular expression pass. This covers
+   CDS, 5' UTR (c.-N) and 3' UTR (c.*N) positions, intronic offsets (c.N+k, c.-N-k),
+   bracketed positions (c.[-188]+3010G>T), ranges (c.100_102del) and allele lists (c.[a;b])
+2. c. positions are converted to transcript (n.) positions using the CDS start and end
+3. The exon containing each position is found by binary search over the exon starts of
+   its transcript; intronic offsets (+/-) select the intron after or before that exon
+
+Results use VariantValidator's variant_exonic_positions format, where an intronic position
+is reported as start_exon/end_exon '<n>i' and start_intron/end_intron '<n>' (intron n lies
+between exon n and exon n + 1).
+
+Transcripts that gene2transcripts doesn't return are recorded as not found, so later runs
+don't request them again until the entry is older than a TTL.
+
+Structures built from a RefSeq GFF3 (see refseq_gff.py) also carry the genomic exon
+intervals, so variants can be placed from their GRCh38 coordinates as well.
+
+Author: Nick Gleadall
+Date: November 2025
+"""
+
+import json
+import sqlite3
+import time
+
+import numpy as np
+import pandas as pd
+
+from dbsnp_index import trim_alleles
+from http_client import get_with_retries
+from reference_genome import EMPTY_ALLELES, GRCH38_ACCESSIONS
+from variant_regions import normalize_chromosome
+
+GENE2TRANSCRIPTS_URL = "https://rest.variantvalidator.org/VariantValidator/tools/gene2transcripts/{query}"
+
+DEFAULT_STRUCTURE_CACHE_PATH = "exon_structures.sqlite"
+
+# Default number of days before a transcript without a structure is requested again
+DEFAULT_NOT_FOUND_TTL_DAYS = 90
+
+# One HGVS c./n. position: optional UTR prefix, base position (optionally bracketed) and intronic offset
+POSITION_PATTERN = r'\[?(?P<{0}_utr>[-*]?)(?P<{0}_base>\d+)\]?(?P<{0}_offset>[+-]\d+)?'
+
+# Start and optional end position of a transcript HGVS description (c.123A>G, c.100_102del, c.[-188]+3010G>T, ...)
+HGVS_POSITIONS_PATTERN = (
+    r'^\s*(?P<transcript>[^:\s]+):(?P<kind>[cn])\.\[?' + POSITION_PATTERN.format('start') +
+    r'(?:_' + POSITION_PATTERN.format('end') + r')?'
+)
+
+# Last variant of an allele list (c.[123A>G;456C>T]), where the described range ends
+LAST_VARIANT_PATTERN = (
+    r';\s*' + POSITION_PATTERN.format('last_start') + r'(?:_' + POSITION_PATTERN.format('last_end') + r')?[^;]*$'
+)
+
+EXONIC_POSITION_FIELDS = ['start_exon', 'end_exon', 'start_intron', 'end_intron']
+
+COORDINATE_FIELDS = ['grch38_chr', 'grch38_pos', 'grch38_ref', 'grch38_alt']
+
+
+def parse_gene2transcripts(response_data):
+    """
+    Extract the exon structures from a gene2transcripts response.
+
+    :param response_data: Parsed JSON of a gene2transcripts response (one gene dict or a list of them)
+    :return: Dict mapping transcript IDs (with version) to structure dicts with 'coding_start' and
+             'coding_end' (transcript positions of the CDS, None for non-coding transcripts) and
+             'exons' (list of [exon number, transcript start, transcript end], in transcript order)
+    """
+    genes = response_data if isinstance(response_data, list) else [response_data]
+    structures = {}
+    for gene in genes:
+        for transcript in (gene or {}).get('transcripts') or []:
+            spans = transcript.get('genomic_spans') or {}
+            # Exon numbering is the same on every span; prefer the GRCh38 chromosome
+            accessions = sorted(spans, key=lambda accession: (accession in GRCH38_ACCESSIONS,
+                                                              accession.startswith('NC_')), reverse=True)
+            exon_structure = None
+            for accession in accessions:
+                exon_structure = spans[accession].get('exon_structure')
+                if exon_structure:
+                    break
+            if not exon_structure or not transcript.get('reference'):
+                continue
+
+            exons = sorted(([int(exon['exon_number']), int(exon['transcript_start']), int(exon['transcript_end'])]
+                            for exon in exon_structure), key=lambda exon: exon[1])
+            coding_start = transcript.get('coding_start')
+            coding_end = transcript.get('coding_end')
+            structures[transcript['reference']] = {
+                'coding_start': int(coding_start) if coding_start not in (None, '') else None,
+                'coding_end': int(coding_end) if coding_end not in (None, '') else None,
+                'exons': exons
+            }
+    return structures
+
+
+def fetch_exon_structures(transcript, session):
+    """
+    Fetch the exon structures of a transcript's gene from VariantValidator.
+
+    :param transcript: Transcript ID with version (e.g. 'NM_020469.3')
+    :param session: Requests session object
+    :return: Dict mapping transcript IDs to structure dicts (all transcripts of the gene)
+    :raises requests.exceptions.RequestException: If the request fails
+    """
+    response = get_with_retries(session, GENE2TRANSCRIPTS_URL.format(query=transcript), timeout=30)
+    response.raise_for_status()
+    return parse_gene2transcripts(response.json())
+
+
+def position_columns(parsed, prefix):
+    """
+    UTR prefix, base and offset columns of one parsed position.
+    """
+    utr = parsed[f'{prefix}_utr'].fillna('')
+    base = pd.to_numeric(parsed[f'{prefix}_base'], errors='coerce')
+    offset = pd.to_numeric(parsed[f'{prefix}_offset'], errors='coerce').fillna(0)
+    return utr, base, offset
+
+
+def parse_hgvs_positions(descriptions):
+    """
+    Parse the start and end positions of many HGVS transcript descriptions.
+
+    :param descriptions: Pandas Series of HGVS transcript descriptions
+    :return: Pandas DataFrame with transcript, kind ('c' or 'n') and start/end utr, base and
+             offset columns (base is NaN for descriptions that can't be parsed)
+    """
+    descriptions = descriptions.astype(str)
+    parsed = descriptions.str.extract(HGVS_POSITIONS_PATTERN)
+    last = descriptions.str.extract(LAST_VARIANT_PATTERN)
+
+    start_utr, start_base, start_offset = position_columns(parsed, 'start')
+    end_utr, end_base, end_offset = position_columns(parsed, 'end')
+    last_start_utr, last_start_base, last_start_offset = position_columns(last, 'last_start')
+    last_end_utr, last_end_base, last_end_offset = position_columns(last, 'last_end')
+
+    # Single positions end where they start; allele lists end at their last variant
+    has_end = end_base.notna()
+    end_utr = end_utr.where(has_end, start_utr)
+    end_base = end_base.where(has_end, start_base)
+    end_offset = end_offset.where(has_end, start_offset)
+    for has_last, utr, base, offset in ((last_start_base.notna(), last_start_utr, last_start_base, last_start_offset),
+                                        (last_end_base.notna(), last_end_utr, last_end_base, last_end_offset)):
+        end_utr = utr.where(has_last, end_utr)
+        end_base = base.where(has_last, end_base)
+        end_offset = offset.where(has_last, end_offset)
+
+    return pd.DataFrame({
+        'transcript': parsed['transcript'],
+        'kind': parsed['kind'],
+        'start_utr': start_utr, 'start_base': start_base, 'start_offset': start_offset,
+        'end_utr': end_utr, 'end_base': end_base, 'end_offset': end_offset
+    }, index=descriptions.index)
+
+
+def locate_positions(structure, kind, utr, base, offset):
+    """
+    Find the exon or intron of many c./n. positions on one transcript.
+
+    :param structure: Transcript structure dict
+    :param kind: NumPy array of 'c' or 'n'
+    :param utr: NumPy array of UTR prefixes ('', '-' or '*')
+    :param base: NumPy float array of base positions (NaN where unparsed)
+    :param offset: NumPy array of intronic offsets (positive: after the exon base, negative: before it)
+    :return: Tuple of (region, number) arrays; region is 1 for exons, 2 for introns and 0 outside the
+             transcript, and intron n lies between exon n and exon n + 1
+    """
+    exons = np.array(structure['exons'], dtype=np.int64).reshape(-1, 3)
+    numbers, starts, ends = exons[:, 0], exons[:, 1], exons[:, 2]
+    coding_start = structure['coding_start']
+    coding_end = structure['coding_end']
+
+    valid = ~np.isnan(base)
+    base = np.where(valid, base, 0).astype(np.int64)
+    if coding_start is None or coding_end is None:
+        # Non-coding transcript: only n. positions can be placed
+        position = base
+        valid &= (kind == 'n') & (utr == '')
+    else:
+        position = np.where(utr == '-', coding_start - base,
+                            np.where(utr == '*', coding_end + base, coding_start + base - 1))
+        position = np.where(kind == 'n', base, position)
+        valid &= (kind == 'c') | (utr == '')
+
+    if not len(exons):
+        return np.zeros(len(base), dtype=np.int8), np.zeros(len(base), dtype=np.int64)
+
+    i = np.searchsorted(starts, position, side='right') - 1
+    inside = valid & (i >= 0) & (position <= ends[np.clip(i, 0, len(ends) - 1)])
+    current = numbers[np.clip(i, 0, len(numbers) - 1)]
+    previous = numbers[np.clip(i - 1, 0, len(numbers) - 1)]
+
+    in_exon = inside & (offset == 0)
+    # Intron n follows exon n: there is none after the last exon or before the first
+    after = inside & (offset > 0) & (i + 1 < len(exons))
+    before = inside & (offset < 0) & (i > 0)
+
+    region = np.select([in_exon, after | before], [1, 2], 0).astype(np.int8)
+    number = np.where(before, previous, current)
+    return region, number
+
+
+def map_exonic_positions(descriptions, structures):
+    """
+    Compute the exon/intron positions of many transcript variants locally.
+
+    :param descriptions: Pandas Series of HGVS transcript descriptions (e.g. 'NM_020469.3:c.261del')
+    :param structures: Dict mapping transcript IDs to structure dicts
+    :return: Pandas DataFrame indexed like descriptions, with start_exon, end_exon, start_intron and
+             end_intron (VariantValidator format), for the descriptions that could be mapped only
+    """
+    descriptions = descriptions.dropna()
+    parsed = parse_hgvs_positions(descriptions)
+    results = []
+
+    for transcript, group in parsed[parsed['start_base'].notna()].groupby('transcript'):
+        structure = structures.get(transcript)
+        if structure is None:
+            continue
+        kind = group['kind'].to_numpy()
+        start_region, start_number = locate_positions(
+            structure, kind, group['start_utr'].to_numpy(), group['start_base'].to_numpy(dtype=float),
+            group['start_offset'].to_numpy()
+        )
+        end_region, end_number = locate_positions(
+            structure, kind, group['end_utr'].to_numpy(), group['end_base'].to_numpy(dtype=float),
+            group['end_offset'].to_numpy()
+        )
+        results.append(exonic_position_frame(group.index, start_region, start_number, end_region, end_number))
+
+    return combine_exonic_positions(results)
+
+
+def exonic_position_frame(index, start_region, start_number, end_region, end_number):
+    """
+    VariantValidator-style exon/intron fields of the variants whose start and end were both located.
+
+    :param index: Index labels of the variants
+    :param start_region: NumPy array of start regions (1 exon, 2 intron, 0 outside the transcript)
+    :param start_number: NumPy array of start exon/intron numbers
+    :param end_region: NumPy array of end regions
+    :param end_number: NumPy array of end exon/intron numbers
+    :return: Pandas DataFrame with EXONIC_POSITION_FIELDS columns
+    """
+    located = {}
+    for side, region, number in (('start', start_region, start_number), ('end', end_region, end_number)):
+        number = number.astype(str)
+        located[f'{side}_exon'] = np.where(region == 1, number, np.char.add(number, 'i'))
+        located[f'{side}_intron'] = np.where(region == 2, number, None)
+
+    mapped = (start_region > 0) & (end_region > 0)
+    return pd.DataFrame({field: located[field][mapped] for field in EXONIC_POSITION_FIELDS}, index=index[mapped])
+
+
+def combine_exonic_positions(results):
+    """
+    Concatenate per-transcript results, with None (not NaN) for missing introns.
+    """
+    if not results:
+        return pd.DataFrame(columns=EXONIC_POSITION_FIELDS)
+    mapped = pd.concat(results).astype(object)
+    return mapped.where(mapped.notna(), None)
+
+
+def locate_genomic_positions(structure, position):
+    """
+    Find the exon or intron of many GRCh38 positions on one transcript.
+
+    :param structure: Transcript structure dict with 'genomic_exons' (see refseq_gff.py)
+    :param position: NumPy integer array of GRCh38 positions (1-based)
+    :return: Tuple of (region, number) arrays, as for locate_positions
+    """
+    exons = np.array(structure.get('genomic_exons') or [], dtype=np.int64).reshape(-1, 3)
+    if not len(exons):
+        return np.zeros(len(position), dtype=np.int8), np.zeros(len(position), dtype=np.int64)
+    exons = exons[np.argsort(exons[:, 1])]
+    numbers, starts, ends = exons[:, 0], exons[:, 1], exons[:, 2]
+
+    i = np.searchsorted(starts, position, side='right') - 1
+    current = np.clip(i, 0, len(exons) - 1)
+    following = np.clip(i + 1, 0, len(exons) - 1)
+    in_exon = (i >= 0) & (position <= ends[current])
+    # Between two exons: the intron takes the lower of their numbers on either strand
+    in_intron = ~in_exon & (i >= 0) & (i + 1 < len(exons))
+
+    region = np.select([in_exon, in_intron], [1, 2], 0).astype(np.int8)
+    number = np.where(in_intron, np.minimum(numbers[current], numbers[following]), numbers[current])
+    return region, number
+
+
+def genomic_spans(variants):
+    """
+    GRCh38 reference spans of VCF-style variants, with shared anchor bases trimmed.
+
+    :param variants: Pandas DataFrame with grch38_chr, grch38_pos, grch38_ref and grch38_alt
+    :return: Pandas DataFrame with chrom, start and end for the variants with complete coordinates
+             (an insertion spans the two bases it lies between)
+    """
+    coordinates = variants.dropna(subset=COORDINATE_FIELDS)
+    spans = {}
+    for index, chrom, pos, ref, alt in coordinates[COORDINATE_FIELDS].itertuples():
+        try:
+            pos, ref, alt = trim_alleles(int(float(pos)), str(ref).strip().upper(), str(alt).strip().upper())
+        except ValueError:
+            continue
+        ref = '' if ref in EMPTY_ALLELES else ref
+        if ref:
+            spans[index] = (normalize_chromosome(chrom), pos, pos + len(ref) - 1)
+        else:
+            spans[index] = (normalize_chromosome(chrom), pos - 1, pos)
+    return pd.DataFrame.from_dict(spans, orient='index', columns=['chrom', 'start', 'end'])
+
+
+def map_genomic_positions(variants, structures):
+    """
+    Compute the exon/intron positions of many variants from their GRCh38 coordinates.
+
+    Each variant is placed on the transcript of its hgvs_transcript, so descriptions that
+    can't be parsed (uncertain positions, unusual syntax) can still be numbered.
+
+    :param variants: Pandas DataFrame with hgvs_transcript and GRCh38 coordinate fields
+    :param structures: Dict mapping transcript IDs to structure dicts with 'chrom', 'strand' and 'genomic_exons'
+    :return: Pandas DataFrame like map_exonic_positions, for the variants that could be mapped only
+    """
+    if 'hgvs_transcript' not in variants.columns or not set(COORDINATE_FIELDS) <= set(variants.columns):
+        return combine_exonic_positions([])
+
+    spans = genomic_spans(variants)
+    spans['transcript'] = variants['hgvs_transcript'].astype(str).str.split(':').str[0].reindex(spans.index)
+    results = []
+
+    for transcript, group in spans.groupby('transcript'):
+        structure = structures.get(transcript)
+        if structure is None or not structure.get('genomic_exons'):
+            continue
+        group = group[group['chrom'] == structure['chrom']]
+        low_region, low_number = locate_genomic_positions(structure, group['start'].to_numpy(dtype=np.int64))
+        high_region, high_number = locate_genomic_positions(structure, group['end'].to_numpy(dtype=np.int64))
+        # The variant starts at its highest genomic position on minus-strand transcripts
+        if structure['strand'] == '-':
+            results.append(exonic_position_frame(group.index, high_region, high_number, low_region, low_number))
+        else:
+            results.append(exonic_position_frame(group.index, low_region, low_number, high_region, high_number))
+
+    return combine_exonic_positions(results)
+
+
+class ExonStructureCache:
+    """
+    SQLite-backed store of transcript exon structures, keyed by transcript ID and version.
+    """
+
+    def __init__(self, path=DEFAULT_STRUCTURE_CACHE_PATH):
+        """
+        :param path: Path to the SQLite cache file (created if it doesn't exist)
+        """
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS exon_structures (
+                transcript TEXT PRIMARY KEY,
+                structure TEXT NOT NULL,
+                fetched_at REAL NOT NULL
+            )
+        """)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS exon_structures_not_found (
+                transcript TEXT PRIMARY KEY,
+                checked_at REAL NOT NULL
+            )
+        """)
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def get_many(self, transcripts):
+        """
+        Look up cached structures.
+
+        :param transcripts: Iterable of transcript IDs (with version)
+        :return: Dict mapping cached transcript IDs to structure dicts
+        """
+        transcripts = list(dict.fromkeys(transcripts))
+        results = {}
+
+        # SQLite limits the number of bound parameters per statement
+        for i in range(0, len(transcripts), 500):
+            chunk = transcripts[i:i + 500]
+            placeholders = ','.join('?' * len(chunk))
+            rows = self.connection.execute(
+                f"SELECT transcript, structure FROM exon_structures WHERE transcript IN ({placeholders})",
+                chunk
+            )
+            for transcript, structure in rows:
+                results[transcript] = json.loads(structure)
+
+        return results
+
+    def put_many(self, structures):
+        """
+        Store structures.
+
+        :param structures: Dict mapping transcript IDs to structure dicts
+        """
+        now = time.time()
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO exon_structures (transcript, structure, fetched_at) VALUES (?, ?, ?)",
+            [(transcript, json.dumps(structure), now) for transcript, structure in structures.items()]
+        )
+        # A transcript that has a structure is no longer a negative result
+        self.connection.executemany(
+            "DELETE FROM exon_structures_not_found WHERE transcript = ?",
+            [(transcript,) for transcript in structures]
+        )
+        self.connection.commit()
+
+    def get_not_found(self, transcripts, ttl_days=DEFAULT_NOT_FOUND_TTL_DAYS):
+        """
+        Look up transcripts recorded as having no exon structure.
+
+        :param transcripts: Iterable of transcript IDs (with version)
+        :param ttl_days: Ignore entries older than this many days (None for no expiry)
+        :return: Set of transcript IDs with a current "not found" entry
+        """
+        transcripts = list(dict.fromkeys(transcripts))
+        oldest = time.time() - ttl_days * 86400 if ttl_days is not None else 0
+        not_found = set()
+
+        for i in range(0, len(transcripts), 500):
+            chunk = transcripts[i:i + 500]
+            placeholders = ','.join('?' * len(chunk))
+            rows = self.connection.execute(
+                f"SELECT transcript FROM exon_structures_not_found WHERE checked_at >= ? AND transcript IN ({placeholders})",
+                [oldest] + chunk
+            )
+            not_found.update(transcript for (transcript,) in rows)
+
+        return not_found
+
+    def put_not_found(self, transcripts):
+        """
+        Record transcripts as having no exon structure.
+
+        :param transcripts: Iterable of transcript IDs (with version)
+        """
+        now = time.time()
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO exon_structures_not_found (transcript, checked_at) VALUES (?, ?)",
+            [(transcript, now) for transcript in transcripts]
+        )
+        self.connection.commit()
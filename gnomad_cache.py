@@ -0,0 +1,203 @@
+"""
+Persistent on-disk cache of raw gnomAD population counts.
+
+annotate_gnomad.py stores the exome and genome per-population AC/AN it receives from gnomAD
+(API, region prefetch or offline VCFs), keyed by gnomAD variant ID and gnomAD release.
+Reruns and changes to the MAF rules can then be recomputed locally instead of re-querying
+gnomAD at 10 requests per minute.
+
+Variants that gnomAD reports as not found are recorded per release as well (a negative
+cache), so fill-in-gaps runs don't spend a rate-limited request on them again until the
+release changes or the entry is older than a configurable TTL.
+
+The cache is a single SQLite file, so it needs no extra dependencies.
+
+Author: Nick Gleadall
+Date: November 2025
+"""
+
+import json
+import sqlite3
+import time
+
+# Default gnomAD release label used to key cached results
+GNOMAD_RELEASE = "v4.1"
+
+DEFAULT_CACHE_PATH = "gnomad_cache.sqlite"
+
+# Default number of days before a "not found" result is checked again
+DEFAULT_NOT_FOUND_TTL_DAYS = 90
+
+
+class GnomadCache:
+    """
+    SQLite-backed store of raw gnomAD exome/genome population counts for one release.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, release=GNOMAD_RELEASE):
+        """
+        :param path: Path to the SQLite cache file (created if it doesn't exist)
+        :param release: gnomAD release label that cached results are stored under
+        """
+        self.path = path
+        self.release = release
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS gnomad_counts (
+                variant_id TEXT NOT NULL,
+                release TEXT NOT NULL,
+                exome TEXT,
+                genome TEXT,
+                fetched_at REAL NOT NULL,
+                PRIMARY KEY (variant_id, release)
+            )
+        """)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS gnomad_not_found (
+                variant_id TEXT NOT NULL,
+                release TEXT NOT NULL,
+                checked_at REAL NOT NULL,
+                PRIMARY KEY (variant_id, release)
+            )
+        """)
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def get_many(self, variant_ids, release=None):
+        """
+        Look up cached variant data.
+
+        :param variant_ids: Iterable of gnomAD variant IDs
+        :param release: gnomAD release to read (default: the cache's release)
+        :return: Dict mapping cached variant IDs to variant data (same shape as the GraphQL response)
+        """
+        release = release or self.release
+        variant_ids = list(dict.fromkeys(variant_ids))
+        results = {}
+
+        # SQLite limits the number of bound parameters per statement
+        for i in range(0, len(variant_ids), 500):
+            chunk = variant_ids[i:i + 500]
+            placeholders = ','.join('?' * len(chunk))
+            rows = self.connection.execute(
+                f"SELECT variant_id, exome, genome FROM gnomad_counts WHERE release = ? AND variant_id IN ({placeholders})",
+                [release] + chunk
+            )
+            for variant_id, exome, genome in rows:
+                results[variant_id] = {
+                    'variant_id': variant_id,
+                    'exome': json.loads(exome) if exome else None,
+                    'genome': json.loads(genome) if genome else None
+                }
+
+        return results
+
+    def get_all(self, release=None):
+        """
+        Read every cached variant for a release.
+
+        :param release: gnomAD release to read (default: the cache's release)
+        :return: Dict mapping variant IDs to variant data
+        """
+        release = release or self.release
+        rows = self.connection.execute(
+            "SELECT variant_id, exome, genome FROM gnomad_counts WHERE release = ?", [release]
+        )
+        return {
+            variant_id: {
+                'variant_id': variant_id,
+                'exome': json.loads(exome) if exome else None,
+                'genome': json.loads(genome) if genome else None
+            }
+            for variant_id, exome, genome in rows
+        }
+
+    def put_many(self, variant_data_by_id, release=None):
+        """
+        Store raw exome/genome population counts.
+
+        Only the counts are kept ('ac', 'an' and the full 'populations' list, including
+        sex-specific and sub-populations), so any MAF rule can be re-applied later.
+
+        :param variant_data_by_id: Dict mapping gnomAD variant IDs to variant data
+        :param release: gnomAD release to store under (default: the cache's release)
+        """
+        release = release or self.release
+        now = time.time()
+        rows = []
+        for variant_id, variant_data in variant_data_by_id.items():
+            if not variant_data:
+                continue
+            sources = []
+            for source in ('exome', 'genome'):
+                source_data = variant_data.get(source)
+                if source_data:
+                    source_data = {
+                        'ac': source_data.get('ac'),
+                        'an': source_data.get('an'),
+                        'populations': [
+                            {'id': pop['id'], 'ac': pop.get('ac', 0), 'an': pop.get('an', 0)}
+                            for pop in source_data.get('populations', [])
+                        ]
+                    }
+                sources.append(json.dumps(source_data) if source_data else None)
+            rows.append((variant_id, release, sources[0], sources[1], now))
+
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO gnomad_counts (variant_id, release, exome, genome, fetched_at) VALUES (?, ?, ?, ?, ?)",
+            rows
+        )
+        # A variant that has been found is no longer a negative result
+        self.connection.executemany(
+            "DELETE FROM gnomad_not_found WHERE variant_id = ? AND release = ?",
+            [(row[0], release) for row in rows]
+        )
+        self.connection.commit()
+
+    def get_not_found(self, variant_ids, ttl_days=DEFAULT_NOT_FOUND_TTL_DAYS, release=None):
+        """
+        Look up variants recorded as not found in gnomAD.
+
+        :param variant_ids: Iterable of gnomAD variant IDs
+        :param ttl_days: Ignore entries older than this many days (None for no expiry)
+        :param release: gnomAD release to read (default: the cache's release)
+        :return: Set of variant IDs with a current "not found" entry
+        """
+        release = release or self.release
+        variant_ids = list(dict.fromkeys(variant_ids))
+        oldest = time.time() - ttl_days * 86400 if ttl_days is not None else 0
+        not_found = set()
+
+        for i in range(0, len(variant_ids), 500):
+            chunk = variant_ids[i:i + 500]
+            placeholders = ','.join('?' * len(chunk))
+            rows = self.connection.execute(
+                f"SELECT variant_id FROM gnomad_not_found WHERE release = ? AND checked_at >= ? AND variant_id IN ({placeholders})",
+                [release, oldest] + chunk
+            )
+            not_found.update(variant_id for (variant_id,) in rows)
+
+        return not_found
+
+    def put_not_found(self, variant_ids, release=None):
+        """
+        Record variants as not found in gnomAD.
+
+        :param variant_ids: Iterable of gnomAD variant IDs
+        :param release: gnomAD release to store under (default: the cache's release)
+        """
+        release = release or self.release
+        now = time.time()
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO gnomad_not_found (variant_id, release, checked_at) VALUES (?, ?, ?)",
+            [(variant_id, release, now) for variant_id in variant_ids]
+        )
+        self.connection.commit()
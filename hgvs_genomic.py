@@ -0,0 +1,213 @@
+"""
+Local parser for GRCh38 genomic HGVS descriptions (hgvs_genomic_grch38).
+
+Recovers chrom/pos/ref/alt for variants that have an HGVS g. description but no GRCh38
+coordinate fields, without calling VariantValidator or any other service:
+1. All descriptions of a DataFrame are parsed in one vectorized regular expression pass
+2. The reference FASTA supplies the bases HGVS leaves implicit (deleted and duplicated
+   sequence, and the anchor base of VCF-style indels)
+
+Supported edits: substitutions (g.100A>G), deletions (g.100del, g.100_102del), duplications
+(g.100dup, g.100_102dup), insertions (g.100_101insCAG) and deletion-insertions
+(g.100_102delinsTT). Uncertain positions, intronic offsets and inserted sequence given by
+reference are reported as unsupported. Without a reference FASTA only substitutions can be
+converted.
+
+Author: Nick Gleadall
+Date: November 2025
+"""
+
+import logging
+import re
+
+import pandas as pd
+
+from reference_genome import GRCH38_ACCESSIONS
+from variant_regions import normalize_chromosome
+
+logger = logging.getLogger(__name__)
+
+HGVS_GENOMIC_PATTERN = (
+    r'^\s*(?P<accession>NC_\d+\.\d+):g\.(?P<start>\d+)(?:_(?P<end>\d+))?'
+    r'(?:(?P<ref>[ACGTN]+)>(?P<alt>[ACGTN]+)|(?P<edit>delins|del|dup|ins)(?P<sequence>[ACGTN]*))\s*$'
+)
+
+COORDINATE_FIELDS = ['grch38_chr', 'grch38_pos', 'grch38_ref', 'grch38_alt']
+
+
+def parse_hgvs_genomic(descriptions):
+    """
+    Split genomic HGVS descriptions into their parts.
+
+    :param descriptions: Pandas Series of HGVS strings (e.g. 'NC_000009.12:g.133257521dup')
+    :return: Pandas DataFrame with accession, start, end, ref, alt, edit and sequence columns
+             (all NaN for descriptions that don't match a supported edit)
+    """
+    parsed = descriptions.astype(str).str.extract(HGVS_GENOMIC_PATTERN, flags=re.IGNORECASE)
+    parsed['accession'] = parsed['accession'].str.upper()
+    parsed['edit'] = parsed['edit'].str.lower()
+    for column in ('ref', 'alt', 'sequence'):
+        parsed[column] = parsed[column].str.upper()
+    return parsed
+
+
+def hgvs_edit_to_vcf(reference, chrom, start, end, ref, alt, edit, sequence):
+    """
+    Convert one parsed HGVS edit to VCF-style coordinates.
+
+    :param reference: ReferenceGenome, or None (substitutions only)
+    :param chrom: Chromosome name
+    :param start: First position of the edit (1-based)
+    :param end: Last position of the edit (None for single-position edits)
+    :param ref: Reference base of a substitution (None otherwise)
+    :param alt: Alternate base of a substitution (None otherwise)
+    :param edit: 'del', 'dup', 'ins' or 'delins' (None for substitutions)
+    :param sequence: Sequence given with the edit ('' if none)
+    :return: Tuple of (pos, ref, alt, error); error is None on success and the rest None otherwise
+    """
+    end = start if end is None else end
+    if end < start:
+        return None, None, None, f"End position {end} is before start position {start}"
+    if reference is not None and not reference.has_chromosome(chrom):
+        return None, None, None, f"Chromosome {chrom} not in reference FASTA"
+
+    if edit is None:
+        if end != start + len(ref) - 1:
+            return None, None, None, f"Substitution of {len(ref)} bases doesn't span {start}_{end}"
+        if reference is not None:
+            reference_bases = reference.fetch(chrom, start, end)
+            if reference_bases != ref:
+                return None, None, None, f"REF {ref} does not match reference {reference_bases} at {chrom}:{start}"
+        return start, ref, alt, None
+
+    if reference is None:
+        return None, None, None, f"'{edit}' needs a reference FASTA"
+
+    if edit in ('del', 'dup') and sequence:
+        reference_bases = reference.fetch(chrom, start, end)
+        if reference_bases != sequence:
+            return None, None, None, f"{edit} sequence {sequence[:20]} does not match reference {reference_bases[:20]}"
+
+    if edit == 'del':
+        if start <= 1:
+            return None, None, None, f"Can't anchor a deletion at the start of chromosome {chrom}"
+        bases = reference.fetch(chrom, start - 1, end)
+        return start - 1, bases, bases[0], None
+
+    if edit == 'dup':
+        # The duplicate is inserted after the last duplicated base
+        bases = reference.fetch(chrom, start, end)
+        return end, bases[-1], bases[-1] + bases, None
+
+    if edit == 'ins':
+        if end != start + 1:
+            return None, None, None, f"Insertion must be between adjacent positions ({start}_{end})"
+        if not sequence:
+            return None, None, None, "Insertion without inserted sequence"
+        base = reference.fetch(chrom, start, start)
+        return start, base, base + sequence, None
+
+    # delins
+    if not sequence:
+        return None, None, None, "Deletion-insertion without inserted sequence"
+    return start, reference.fetch(chrom, start, end), sequence, None
+
+
+def coordinates_from_hgvs(variants, reference=None):
+    """
+    Derive GRCh38 coordinates from the hgvs_genomic_grch38 column.
+
+    :param variants: Pandas DataFrame with an hgvs_genomic_grch38 column
+    :param reference: Optional ReferenceGenome (required for everything but substitutions)
+    :return: Tuple of (Pandas DataFrame with grch38_chr/pos/ref/alt for the converted rows,
+             dict mapping index labels of rows that couldn't be converted to the reason)
+    """
+    if 'hgvs_genomic_grch38' not in variants.columns:
+        return pd.DataFrame(columns=COORDINATE_FIELDS), {}
+
+    descriptions = variants['hgvs_genomic_grch38'].dropna()
+    descriptions = descriptions[descriptions.astype(str).str.strip() != '']
+    parsed = parse_hgvs_genomic(descriptions)
+
+    rows = {}
+    errors = {}
+    for index, accession, start, end, ref, alt, edit, sequence in parsed.itertuples():
+        if pd.isna(accession):
+            errors[index] = f"Unsupported HGVS description: {str(descriptions[index])[:60]}"
+            continue
+        chrom = GRCH38_ACCESSIONS.get(accession)
+        if chrom is None:
+            errors[index] = f"{accession} is not a GRCh38 chromosome"
+            continue
+        start = int(start)
+        end = None if pd.isna(end) else int(end)
+        pos, vcf_ref, vcf_alt, error = hgvs_edit_to_vcf(
+            reference, chrom, start, end,
+            None if pd.isna(ref) else ref, None if pd.isna(alt) else alt,
+            None if pd.isna(edit) else edit, '' if pd.isna(sequence) else sequence
+        )
+        if error:
+            errors[index] = error
+        else:
+            rows[index] = (chrom, pos, vcf_ref, vcf_alt)
+
+    return pd.DataFrame.from_dict(rows, orient='index', columns=COORDINATE_FIELDS), errors
+
+
+def fill_coordinates_from_hgvs(variants, reference=None):
+    """
+    Fill in missing GRCh38 coordinate fields from hgvs_genomic_grch38 (in memory only).
+
+    Only rows with a missing coordinate field are converted. Fields the row already has are
+    kept, and rows whose stored chromosome or position contradicts the HGVS description are
+    left unchanged.
+
+    :param variants: Pandas DataFrame containing variants
+    :param reference: Optional ReferenceGenome (required for everything but substitutions)
+    :return: Copy of the DataFrame with the recovered coordinates filled in
+    """
+    variants = variants.copy()
+    for field in COORDINATE_FIELDS:
+        if field not in variants.columns:
+            variants[field] = None
+
+    missing = variants[COORDINATE_FIELDS].isna().any(axis=1)
+    if not missing.any():
+        return variants
+
+    coordinates, errors = coordinates_from_hgvs(variants[missing], reference)
+
+    filled = 0
+    conflicting = 0
+    malformed = 0
+    for index, chrom, pos, ref, alt in coordinates.itertuples():
+        row = variants.loc[index]
+        derived = {'grch38_chr': chrom, 'grch38_pos': pos, 'grch38_ref': ref, 'grch38_alt': alt}
+        existing = {field: row[field] for field in COORDINATE_FIELDS if pd.notna(row[field])}
+        stored_pos = None
+        if 'grch38_pos' in existing:
+            try:
+                stored_pos = int(float(existing['grch38_pos']))
+            except (TypeError, ValueError):
+                logger.warning(f"Variant {row.get('id')}: stored grch38_pos {existing['grch38_pos']!r} "
+                               f"is not a position, hgvs_genomic_grch38 not used")
+                malformed += 1
+                continue
+        if (('grch38_chr' in existing and normalize_chromosome(existing['grch38_chr']) != chrom) or
+                (stored_pos is not None and stored_pos != pos)):
+            logger.warning(f"Variant {row.get('id')}: hgvs_genomic_grch38 {row['hgvs_genomic_grch38']} "
+                           f"contradicts the stored GRCh38 position, not used")
+            conflicting += 1
+            continue
+        for field, value in derived.items():
+            if field not in existing:
+                variants.at[index, field] = value
+        filled += 1
+
+    for index, error in errors.items():
+        logger.info(f"Variant {variants.loc[index].get('id')}: can't use hgvs_genomic_grch38 ({error})")
+
+    logger.info(f"Recovered GRCh38 coordinates from hgvs_genomic_grch38 for {filled} of {int(missing.sum())} "
+                f"variants missing them ({len(errors)} unsupported or invalid, {conflicting} conflicting"
+                f"{f', {malformed} with a malformed stored position' if malformed else ''})")
+    return variants
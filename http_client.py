@@ -0,0 +1,182 @@
+"""
+Long-lived, retry-enabled HTTP sessions with per-host connection pools.
+
+Creating a new requests.Session for every API call means a new TCP connection and TLS
+handshake per variant. Instead, one session is created per run and configured once here:
+1. Retries with exponential backoff for transient errors (429 and 5xx)
+2. Keep-alive connection pools per host, sized for the number of concurrent requests
+3. Connection-reuse statistics read from the underlying urllib3 pools
+
+TokenBucket limits how often requests start when several worker threads share one
+API rate limit.
+
+Author: Nick Gleadall
+Date: November 2025
+"""
+
+import logging
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+RETRY_METHODS = ["HEAD", "GET", "OPTIONS", "POST", "PATCH"]
+
+# Number of hosts to keep pools for, and connections kept alive per host
+DEFAULT_POOL_CONNECTIONS = 10
+DEFAULT_POOL_MAXSIZE = 10
+
+
+def configure_session(session, retries=3, backoff_factor=0.3,
+                      pool_connections=DEFAULT_POOL_CONNECTIONS, pool_maxsize=DEFAULT_POOL_MAXSIZE):
+    """
+    Mount retrying, pooled adapters on a session (in place, keeping its cookies and headers).
+
+    :param session: requests.Session to configure
+    :param retries: Number of retries before giving up
+    :param backoff_factor: Factor to increase delay between retries
+    :param pool_connections: Number of per-host connection pools to keep
+    :param pool_maxsize: Maximum number of kept-alive connections per host
+    :return: The same session
+    """
+    retry_strategy = Retry(
+        total=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=RETRY_STATUS_CODES,
+        allowed_methods=RETRY_METHODS,
+    )
+    adapter = HTTPAdapter(max_retries=retry_strategy, pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def disable_transport_retries(session, prefixes, pool_maxsize=DEFAULT_POOL_MAXSIZE):
+    """
+    Mount pooled adapters without transport-level retries for some URL prefixes.
+
+    Used for hosts whose requests are retried by the caller instead, so that every HTTP
+    attempt goes through the caller's rate limiting.
+
+    :param session: requests.Session to configure
+    :param prefixes: URL prefixes (e.g. 'https://api.ncbi.nlm.nih.gov/')
+    :param pool_maxsize: Maximum number of kept-alive connections per host
+    :return: The same session
+    """
+    adapter = HTTPAdapter(max_retries=0, pool_connections=len(prefixes), pool_maxsize=pool_maxsize)
+    for prefix in prefixes:
+        session.mount(prefix, adapter)
+    return session
+
+
+def get_with_retries(session, url, bucket=None, retries=3, backoff_factor=0.3, **kwargs):
+    """
+    GET a URL whose host has no transport-level retries (see disable_transport_retries).
+
+    Connection errors, timeouts and 429/5xx responses are retried with exponential backoff
+    (or the server's Retry-After, if longer). With a bucket, a token is taken before every
+    attempt, retries included, so retries stay within the shared rate limit.
+
+    :param session: requests.Session
+    :param url: URL to request
+    :param bucket: Optional TokenBucket shared with other workers
+    :param retries: Number of retries before giving up
+    :param backoff_factor: Factor to increase delay between retries
+    :param kwargs: Further arguments for session.get (e.g. params, timeout)
+    :return: Response (the last one if every attempt got 429 or 5xx)
+    :raises requests.exceptions.RequestException: If the last attempt fails to connect or times out
+    """
+    for attempt in range(retries + 1):
+        if bucket is not None:
+            bucket.acquire()
+        wait_time = backoff_factor * (2 ** attempt)
+        try:
+            response = session.get(url, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            if attempt == retries:
+                raise
+            failure = str(e)[:100]
+        else:
+            if response.status_code not in RETRY_STATUS_CODES or attempt == retries:
+                return response
+            failure = f"status {response.status_code}"
+            retry_after = response.headers.get('Retry-After', '')
+            if retry_after.isdigit():
+                wait_time = max(wait_time, int(retry_after))
+        logger.warning(f"Attempt {attempt + 1} failed ({failure}). Retrying in {wait_time:.2f} seconds...")
+        time.sleep(wait_time)
+
+
+def get_connection_stats(session):
+    """
+    Count requests and newly opened connections per host.
+
+    :param session: requests.Session configured with configure_session
+    :return: Dict mapping host to {'requests', 'connections', 'reused'} counts
+    """
+    stats = {}
+    adapters = {id(adapter): adapter for adapter in session.adapters.values()}
+    for adapter in adapters.values():
+        poolmanager = getattr(adapter, 'poolmanager', None)
+        if poolmanager is None:
+            continue
+        for key in list(poolmanager.pools.keys()):
+            pool = poolmanager.pools.get(key)
+            if pool is None:
+                continue
+            host_stats = stats.setdefault(pool.host, {'requests': 0, 'connections': 0, 'reused': 0})
+            host_stats['requests'] += pool.num_requests
+            host_stats['connections'] += pool.num_connections
+            host_stats['reused'] += max(0, pool.num_requests - pool.num_connections)
+    return stats
+
+
+def log_connection_stats(session):
+    """
+    Log connection reuse per host.
+
+    :param session: requests.Session configured with configure_session
+    """
+    for host, host_stats in sorted(get_connection_stats(session).items()):
+        if not host_stats['requests']:
+            continue
+        reuse_rate = host_stats['reused'] / host_stats['requests']
+        logger.info(f"Connections to {host}: {host_stats['requests']} requests over "
+                    f"{host_stats['connections']} connections ({reuse_rate:.0%} reused)")
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket limiting how many requests start per second.
+    """
+
+    def __init__(self, rate, capacity=1):
+        """
+        :param rate: Tokens added per second (requests per second)
+        :param capacity: Maximum number of requests that may start at once (1 spaces requests evenly)
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Block until a token is available and take it.
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
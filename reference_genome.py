@@ -0,0 +1,284 @@
+"""
+Memory-mapped access to a local GRCh38 reference FASTA, and variant normalization.
+
+The FASTA is memory-mapped and addressed through a samtools-style .fai index, so opening
+it is instant and only the bases that are actually read are loaded from disk. If the .fai
+file doesn't exist it is built once and saved next to the FASTA.
+
+Variants are normalized before any rate-limited upstream lookup:
+1. REF is checked against the reference genome
+2. Alleles are left-aligned and trimmed to their minimal VCF-style representation
+
+Variants that can't be valid are rejected locally instead of being sent to gnomAD or dbSNP.
+
+For dbSNP, indels are also expanded to NCBI's canonical SPDI form (the fully justified
+representation from the Variant Overprecision Correction Algorithm), so every way of writing
+the same indel in a repeat maps to one SPDI string.
+
+Author: Nick Gleadall
+Date: November 2025
+"""
+
+import mmap
+import os
+import re
+
+from variant_regions import normalize_chromosome
+
+VALID_ALLELE = re.compile(r'^[ACGTN]*$')
+
+# Alleles written as '-' or '.' mean "no bases" (insertion REF or deletion ALT)
+EMPTY_ALLELES = ('-', '.')
+
+# GRCh38/hg38 chromosome to RefSeq accession mapping
+GRCH38_CHROMOSOMES = {
+    '1': 'NC_000001.11', '2': 'NC_000002.12', '3': 'NC_000003.12',
+    '4': 'NC_000004.12', '5': 'NC_000005.10', '6': 'NC_000006.12',
+    '7': 'NC_000007.14', '8': 'NC_000008.11', '9': 'NC_000009.12',
+    '10': 'NC_000010.11', '11': 'NC_000011.10', '12': 'NC_000012.12',
+    '13': 'NC_000013.11', '14': 'NC_000014.9', '15': 'NC_000015.10',
+    '16': 'NC_000016.10', '17': 'NC_000017.11', '18': 'NC_000018.10',
+    '19': 'NC_000019.10', '20': 'NC_000020.11', '21': 'NC_000021.9',
+    '22': 'NC_000022.11', 'X': 'NC_000023.11', 'Y': 'NC_000024.10',
+    'MT': 'NC_012920.1', 'M': 'NC_012920.1'
+}
+
+# RefSeq accession to GRCh38 chromosome mapping
+GRCH38_ACCESSIONS = {accession: chrom for chrom, accession in GRCH38_CHROMOSOMES.items() if chrom != 'M'}
+
+
+def build_fasta_index(fasta_path):
+    """
+    Build a samtools-style .fai index for an uncompressed FASTA file.
+
+    :param fasta_path: Path to the FASTA file
+    :return: Path of the written .fai file
+    :raises ValueError: If sequence lines of a contig have inconsistent lengths
+    """
+    fai_path = fasta_path + '.fai'
+    entries = []
+    current = None
+
+    with open(fasta_path, 'rb') as f:
+        offset = 0
+        for line in f:
+            if line.startswith(b'>'):
+                if current:
+                    entries.append(current)
+                name = line[1:].split()[0].decode()
+                current = {'name': name, 'length': 0, 'offset': offset + len(line),
+                           'linebases': None, 'linewidth': None, 'short_line': False}
+            elif current is not None:
+                bases = len(line.rstrip(b'\r\n'))
+                if current['short_line'] and bases:
+                    raise ValueError(f"Inconsistent line lengths in {current['name']}, can't index {fasta_path}")
+                if current['linebases'] is None:
+                    current['linebases'] = bases
+                    current['linewidth'] = len(line)
+                elif bases != current['linebases']:
+                    current['short_line'] = True
+                current['length'] += bases
+            offset += len(line)
+        if current:
+            entries.append(current)
+
+    with open(fai_path, 'w') as f:
+        for entry in entries:
+            f.write(f"{entry['name']}\t{entry['length']}\t{entry['offset']}\t"
+                    f"{entry['linebases'] or 0}\t{entry['linewidth'] or 0}\n")
+
+    return fai_path
+
+
+def chromosome_aliases(name):
+    """
+    Names a FASTA sequence can be looked up by (e.g. 'chr1', '1' and 'NC_000001.11' all map to '1').
+
+    :param name: Sequence name from the FASTA header
+    :return: Normalized chromosome name
+    """
+    match = re.match(r'^NC_0000(\d\d)\.\d+$', name)
+    if match:
+        number = int(match.group(1))
+        return {23: 'X', 24: 'Y'}.get(number, str(number))
+    if name.startswith('NC_012920'):
+        return 'MT'
+    return normalize_chromosome(name)
+
+
+class ReferenceGenome:
+    """
+    Random access to an indexed, memory-mapped reference FASTA.
+    """
+
+    def __init__(self, fasta_path):
+        """
+        :param fasta_path: Path to an uncompressed GRCh38 FASTA (a .fai index is built if missing)
+        """
+        if fasta_path.endswith('.gz') or fasta_path.endswith('.bgz'):
+            raise ValueError(f"Compressed FASTA is not supported, decompress it first: {fasta_path}")
+
+        self.path = fasta_path
+        fai_path = fasta_path + '.fai'
+        if not os.path.exists(fai_path):
+            build_fasta_index(fasta_path)
+
+        self.contigs = {}
+        with open(fai_path) as f:
+            for line in f:
+                name, length, offset, linebases, linewidth = line.split('\t')[:5]
+                self.contigs[chromosome_aliases(name)] = (int(length), int(offset), int(linebases), int(linewidth))
+
+        self.handle = open(fasta_path, 'rb')
+        self.data = mmap.mmap(self.handle.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        self.data.close()
+        self.handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def has_chromosome(self, chrom):
+        return chromosome_aliases(str(chrom)) in self.contigs
+
+    def fetch(self, chrom, start, end):
+        """
+        Read reference bases.
+
+        :param chrom: Chromosome name (any of 'chr1', '1', 'NC_000001.11')
+        :param start: First base (1-based, inclusive)
+        :param end: Last base (1-based, inclusive)
+        :return: Upper-case sequence string (shorter than requested if it runs off the contig end)
+        :raises KeyError: If the chromosome isn't in the FASTA
+        """
+        length, offset, linebases, linewidth = self.contigs[chromosome_aliases(str(chrom))]
+        start = max(1, start)
+        end = min(end, length)
+        if end < start:
+            return ''
+
+        def file_offset(position):
+            # position is 0-based within the contig
+            return offset + (position // linebases) * linewidth + position % linebases
+
+        raw = self.data[file_offset(start - 1):file_offset(end - 1) + 1]
+        return raw.replace(b'\n', b'').replace(b'\r', b'').decode().upper()
+
+
+def normalize_variant(reference, chrom, pos, ref, alt):
+    """
+    Check REF against the reference and left-align and trim a variant.
+
+    Follows the usual left-align-and-trim procedure (as in vt normalize / bcftools norm):
+    matching trailing bases are trimmed, an anchor base is prepended when an allele
+    becomes empty, and finally matching leading bases are trimmed down to one anchor base.
+    Alleles written as '-' are treated as empty; for insertions pos is then the base after
+    the insertion point.
+
+    :param reference: ReferenceGenome
+    :param chrom: Chromosome name
+    :param pos: Position (1-based)
+    :param ref: Reference allele
+    :param alt: Alternate allele
+    :return: Tuple of (pos, ref, alt, error); error is None for valid variants and the rest None otherwise
+    """
+    ref = str(ref).strip().upper()
+    alt = str(alt).strip().upper()
+    ref = '' if ref in EMPTY_ALLELES else ref
+    alt = '' if alt in EMPTY_ALLELES else alt
+    pos = int(float(pos))
+
+    if not reference.has_chromosome(chrom):
+        return None, None, None, f"Chromosome {chrom} not in reference FASTA"
+    if not VALID_ALLELE.match(ref) or not VALID_ALLELE.match(alt):
+        return None, None, None, f"Invalid allele characters (REF:{ref[:20]}, ALT:{alt[:20]})"
+    if ref == alt:
+        return None, None, None, f"REF and ALT are identical ({ref})"
+
+    if ref:
+        reference_bases = reference.fetch(chrom, pos, pos + len(ref) - 1)
+        if reference_bases != ref:
+            return None, None, None, f"REF {ref[:20]} does not match reference {reference_bases[:20]} at {chrom}:{pos}"
+
+    while True:
+        changed = False
+        if ref and alt and ref[-1] == alt[-1]:
+            ref, alt = ref[:-1], alt[:-1]
+            changed = True
+        if not ref or not alt:
+            if pos <= 1:
+                return None, None, None, f"Can't left-align past the start of chromosome {chrom}"
+            pos -= 1
+            base = reference.fetch(chrom, pos, pos)
+            ref, alt = base + ref, base + alt
+            changed = True
+        if not changed:
+            break
+
+    while len(ref) >= 2 and len(alt) >= 2 and ref[0] == alt[0]:
+        ref, alt = ref[1:], alt[1:]
+        pos += 1
+
+    return pos, ref, alt, None
+
+
+def canonicalize_spdi(reference, chrom, pos, ref, alt):
+    """
+    Compute NCBI's canonical SPDI alleles of a variant.
+
+    The variant is normalized first (see normalize_variant) and the anchor base is removed.
+    Substitutions are then already canonical. For insertions and deletions, the deleted and
+    inserted sequences are extended to the whole stretch of reference in which the indel
+    could be placed, so equivalent indels in a repeat get identical SPDI strings.
+
+    :param reference: ReferenceGenome
+    :param chrom: Chromosome name
+    :param pos: Position (1-based)
+    :param ref: Reference allele
+    :param alt: Alternate allele
+    :return: Tuple of (pos, deleted, inserted, error); pos is 1-based (the first deleted base,
+             or the base after the insertion point), error is None for valid variants and the rest None otherwise
+    """
+    pos, ref, alt, error = normalize_variant(reference, chrom, pos, ref, alt)
+    if error:
+        return None, None, None, error
+
+    # Drop the VCF anchor base
+    while ref and alt and ref[0] == alt[0]:
+        ref, alt = ref[1:], alt[1:]
+        pos += 1
+
+    if ref and alt:
+        return pos, ref, alt, None
+
+    # The indel is already left-aligned; count how far it can be shifted to the right
+    sequence = ref or alt
+    length = len(sequence)
+    shift = 0
+    window = 64
+    while True:
+        if ref:
+            # Deletion: base i of the region must equal base i + length
+            bases = reference.fetch(chrom, pos + shift, pos + shift + length + window - 1)
+            expected, actual = bases[:window], bases[length:length + window]
+        else:
+            # Insertion: the reference must continue the inserted sequence
+            actual = reference.fetch(chrom, pos + shift, pos + shift + window - 1)
+            expected = ''.join(sequence[(shift + i) % length] for i in range(len(actual)))
+        matched = 0
+        while matched < min(len(expected), len(actual)) and expected[matched] == actual[matched]:
+            matched += 1
+        shift += matched
+        if matched < window:
+            break
+
+    if ref:
+        deleted = reference.fetch(chrom, pos, pos + length + shift - 1)
+        return pos, deleted, deleted[length:], None
+
+    region = reference.fetch(chrom, pos, pos + shift - 1) if shift else ''
+    return pos, region, sequence + region, None
@@ -0,0 +1,219 @@
+"""
+Offline exon/intron structures of RefSeq transcripts from a local GFF3 annotation.
+
+annotate_exons.py normally asks VariantValidator for the exon structure of each transcript.
+With a RefSeq GFF3 on disk (the full GRCh38 annotation, e.g. GCF_000001405.40_GRCh38.p14_genomic.gff.gz,
+or the smaller MANE Select release, e.g. MANE.GRCh38.v1.3.refseq_genomic.gff.gz), no request is needed:
+
+1. The GFF3 is streamed once and the exon and CDS features of every NM_/NR_ transcript on a
+   GRCh38 chromosome are collected
+2. Exons are numbered in transcript order, and their transcript (n.) coordinates and the CDS
+   start and end are derived from the genomic exon lengths
+3. The structures are written to a SQLite index next to the GFF3, with one row per transcript
+   in the format of exon_structures.py plus the chromosome, strand and genomic exon intervals
+
+Later runs open the index and load only the transcripts they need. The index remembers the
+size and modification time of the GFF3 and is rebuilt when the file changes.
+
+Transcript coordinates assume the transcript aligns to GRCh38 without gaps, which holds for
+MANE Select and nearly all RefSeq transcripts.
+
+Author: Nick Gleadall
+Date: November 2025
+"""
+
+import gzip
+import logging
+import os
+import sqlite3
+import time
+from urllib.parse import unquote
+
+from exon_structures import ExonStructureCache
+from reference_genome import GRCH38_ACCESSIONS
+
+logger = logging.getLogger(__name__)
+
+INDEX_SUFFIX = '.isbt-exons.sqlite'
+
+# Transcript prefixes kept from the GFF3 (curated RefSeq coding and non-coding transcripts)
+TRANSCRIPT_PREFIXES = ('NM_', 'NR_')
+
+
+def get_index_path(gff_path):
+    """
+    Default path of the exon index for a GFF3 file.
+    """
+    return gff_path + INDEX_SUFFIX
+
+
+def parse_attributes(column):
+    """
+    Parse the attribute column of a GFF3 line.
+
+    :param column: Attribute column (e.g. 'ID=exon-NM_020469.3-1;Parent=rna-NM_020469.3')
+    :return: Dict of attribute names to (URL-decoded) values
+    """
+    attributes = {}
+    for field in column.strip().split(';'):
+        if '=' in field:
+            key, value = field.split('=', 1)
+            attributes[key] = unquote(value)
+    return attributes
+
+
+def read_transcript_features(gff_path):
+    """
+    Collect the exon and CDS intervals of RefSeq transcripts on GRCh38 chromosomes.
+
+    :param gff_path: Path to a RefSeq GFF3 file (plain or gzip/bgzip-compressed)
+    :return: Dict mapping transcript IDs to dicts with 'chrom', 'strand', 'exons' and 'cds'
+             (lists of [start, end] genomic intervals, 1-based inclusive)
+    """
+    opener = gzip.open if gff_path.endswith(('.gz', '.bgz')) else open
+    transcripts = {}
+    # Transcripts placed more than once (PAR genes on X and Y) keep their first placement
+    parents = {}
+
+    with opener(gff_path, 'rt') as f:
+        for line in f:
+            if line.startswith('#'):
+                continue
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) < 9 or fields[2] not in ('exon', 'CDS'):
+                continue
+            chrom = GRCH38_ACCESSIONS.get(fields[0])
+            if chrom is None:
+                continue
+
+            attributes = parse_attributes(fields[8])
+            parent = attributes.get('Parent', '')
+            if not parent.startswith('rna-'):
+                continue
+            transcript = attributes.get('transcript_id') or parent[len('rna-'):]
+            if not transcript.startswith(TRANSCRIPT_PREFIXES):
+                continue
+            if parents.setdefault(transcript, parent) != parent:
+                continue
+
+            features = transcripts.setdefault(transcript, {'chrom': chrom, 'strand': fields[6], 'exons': [], 'cds': []})
+            interval = [int(fields[3]), int(fields[4])]
+            features['exons' if fields[2] == 'exon' else 'cds'].append(interval)
+
+    return transcripts
+
+
+def transcript_position(genomic_exons, strand, position):
+    """
+    Transcript (n.) position of a genomic position inside an exon.
+
+    :param genomic_exons: List of [exon number, genomic start, genomic end, transcript start]
+    :param strand: '+' or '-'
+    :param position: GRCh38 position (1-based)
+    :return: Transcript position, or None if the position is not exonic
+    """
+    for _, start, end, transcript_start in genomic_exons:
+        if start <= position <= end:
+            return transcript_start + (position - start if strand == '+' else end - position)
+    return None
+
+
+def build_structure(features):
+    """
+    Build the exon structure of one transcript from its GFF3 features.
+
+    :param features: Dict with 'chrom', 'strand', 'exons' and 'cds' (see read_transcript_features)
+    :return: Structure dict with 'coding_start', 'coding_end', 'exons' (as in exon_structures.py),
+             'chrom', 'strand' and 'genomic_exons' (list of [exon number, genomic start, genomic end])
+    """
+    strand = features['strand']
+    # Exons are numbered 5' to 3' along the transcript
+    ordered = sorted(features['exons'], key=lambda exon: exon[0], reverse=(strand == '-'))
+
+    numbered = []
+    transcript_start = 1
+    for number, (start, end) in enumerate(ordered, start=1):
+        numbered.append([number, start, end, transcript_start])
+        transcript_start += end - start + 1
+
+    coding_start = coding_end = None
+    if features['cds']:
+        cds_low = min(start for start, _ in features['cds'])
+        cds_high = max(end for _, end in features['cds'])
+        first, last = (cds_low, cds_high) if strand == '+' else (cds_high, cds_low)
+        coding_start = transcript_position(numbered, strand, first)
+        coding_end = transcript_position(numbered, strand, last)
+
+    return {
+        'coding_start': coding_start,
+        'coding_end': coding_end,
+        'exons': [[number, transcript_start, transcript_start + end - start]
+                  for number, start, end, transcript_start in numbered],
+        'chrom': features['chrom'],
+        'strand': strand,
+        'genomic_exons': sorted([[number, start, end] for number, start, end, _ in numbered], key=lambda exon: exon[1])
+    }
+
+
+def build_exon_index(gff_path, index_path=None):
+    """
+    Parse a RefSeq GFF3 and write the exon structures of all its transcripts to an index.
+
+    :param gff_path: Path to a RefSeq GFF3 file
+    :param index_path: Path of the index (default: next to the GFF3)
+    :return: Path of the written index
+    """
+    index_path = index_path or get_index_path(gff_path)
+    started = time.time()
+    features = read_transcript_features(gff_path)
+    structures = {transcript: build_structure(transcript_features)
+                  for transcript, transcript_features in features.items() if transcript_features['exons']}
+
+    tmp_path = index_path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    stat = os.stat(gff_path)
+    with ExonStructureCache(tmp_path) as index:
+        index.put_many(structures)
+        index.connection.execute("CREATE TABLE gff_source (name TEXT, size INTEGER, mtime INTEGER)")
+        index.connection.execute("INSERT INTO gff_source VALUES (?, ?, ?)",
+                                 (os.path.basename(gff_path), stat.st_size, int(stat.st_mtime)))
+        index.connection.commit()
+    os.replace(tmp_path, index_path)
+
+    logger.info(f"Saved exon index of {len(structures)} transcripts in {time.time() - started:.1f}s: {index_path}")
+    return index_path
+
+
+def index_is_current(index_path, gff_path):
+    """
+    Whether an index was built from this GFF3 in its current state (same size and modification time).
+    """
+    stat = os.stat(gff_path)
+    with ExonStructureCache(index_path) as index:
+        try:
+            source = index.connection.execute("SELECT size, mtime FROM gff_source").fetchone()
+        except sqlite3.OperationalError:
+            return False
+    return source == (stat.st_size, int(stat.st_mtime))
+
+
+def open_exon_index(gff_path=None, index_path=None):
+    """
+    Open the exon index of a GFF3, building it first if it is missing or out of date.
+
+    :param gff_path: Path to a RefSeq GFF3 file (optional if index_path exists)
+    :param index_path: Path of the index (default: next to the GFF3)
+    :return: ExonStructureCache reading the index
+    :raises ValueError: If neither a GFF3 nor an existing index is given
+    """
+    if not gff_path and not (index_path and os.path.exists(index_path)):
+        raise ValueError("An exon index needs a GFF3 file or an existing index")
+    index_path = index_path or get_index_path(gff_path)
+
+    if gff_path and not (os.path.exists(index_path) and index_is_current(index_path, gff_path)):
+        logger.info(f"Indexing exons of RefSeq transcripts (one-off): {gff_path}")
+        build_exon_index(gff_path, index_path)
+    else:
+        logger.info(f"Using exon index: {index_path}")
+    return ExonStructureCache(index_path)
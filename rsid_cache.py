@@ -0,0 +1,194 @@
+"""
+Persistent on-disk cache of dbSNP rsID lookups.
+
+annotate_rsid.py stores the answer of every NCBI Variation API lookup, keyed by the SPDI
+string that was queried and the dbSNP build. Both hits and "no rsID" answers are kept, so
+reruns (including --overwrite-all --clear-not-found) only ask NCBI about variants whose
+answer isn't known yet.
+
+Entries of other dbSNP builds are ignored, so a new build re-checks every variant.
+"No rsID" answers also expire after a configurable TTL, since new rsIDs are assigned
+between builds.
+
+The status of stored rsIDs (current, merged into another rsID, withdrawn, ...) is cached
+per dbSNP build as well, for validating existing annotations, and so are the GRCh38 SPDI
+placements of rsIDs, for filling in missing coordinates.
+
+Author: Nick Gleadall
+Date: November 2025
+"""
+
+import sqlite3
+import time
+
+# Default dbSNP build label used to key cached results
+DBSNP_BUILD = "156"
+
+DEFAULT_CACHE_PATH = "rsid_cache.sqlite"
+
+# Default number of days before a "no rsID" answer is checked again
+DEFAULT_NOT_FOUND_TTL_DAYS = 30
+
+
+class RsidCache:
+    """
+    SQLite-backed store of SPDI to rsID answers for one dbSNP build.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, build=DBSNP_BUILD):
+        """
+        :param path: Path to the SQLite cache file (created if it doesn't exist)
+        :param build: dbSNP build label that cached results are stored under
+        """
+        self.path = path
+        self.build = build
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS rsid_lookups (
+                spdi TEXT NOT NULL,
+                build TEXT NOT NULL,
+                rsid INTEGER,
+                checked_at REAL NOT NULL,
+                PRIMARY KEY (spdi, build)
+            )
+        """)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS refsnp_status (
+                rsid INTEGER NOT NULL,
+                build TEXT NOT NULL,
+                status TEXT NOT NULL,
+                merged_into INTEGER,
+                checked_at REAL NOT NULL,
+                PRIMARY KEY (rsid, build)
+            )
+        """)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS refsnp_placements (
+                rsid INTEGER NOT NULL,
+                build TEXT NOT NULL,
+                spdis TEXT NOT NULL,
+                checked_at REAL NOT NULL,
+                PRIMARY KEY (rsid, build)
+            )
+        """)
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def get_many(self, spdis, not_found_ttl_days=DEFAULT_NOT_FOUND_TTL_DAYS):
+        """
+        Look up cached answers.
+
+        :param spdis: Iterable of SPDI strings
+        :param not_found_ttl_days: Ignore "no rsID" answers older than this many days (None for no expiry)
+        :return: Dict mapping cached SPDI strings to rsID numbers (None for "no rsID")
+        """
+        spdis = list(dict.fromkeys(spdis))
+        oldest = time.time() - not_found_ttl_days * 86400 if not_found_ttl_days is not None else 0
+        results = {}
+
+        # SQLite limits the number of bound parameters per statement
+        for i in range(0, len(spdis), 500):
+            chunk = spdis[i:i + 500]
+            placeholders = ','.join('?' * len(chunk))
+            rows = self.connection.execute(
+                f"SELECT spdi, rsid FROM rsid_lookups WHERE build = ? AND spdi IN ({placeholders}) "
+                f"AND (rsid IS NOT NULL OR checked_at >= ?)",
+                [self.build] + chunk + [oldest]
+            )
+            results.update(rows)
+
+        return results
+
+    def put_many(self, rsids_by_spdi):
+        """
+        Store answers.
+
+        :param rsids_by_spdi: Dict mapping SPDI strings to rsID numbers (None for "no rsID")
+        """
+        now = time.time()
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO rsid_lookups (spdi, build, rsid, checked_at) VALUES (?, ?, ?, ?)",
+            [(spdi, self.build, rsid, now) for spdi, rsid in rsids_by_spdi.items()]
+        )
+        self.connection.commit()
+
+    def get_refsnp_status(self, rsids):
+        """
+        Look up the cached dbSNP status of rsIDs.
+
+        :param rsids: Iterable of rsID numbers
+        :return: Dict mapping cached rsID numbers to (status, merged_into) tuples
+        """
+        rsids = list(dict.fromkeys(rsids))
+        results = {}
+
+        for i in range(0, len(rsids), 500):
+            chunk = rsids[i:i + 500]
+            placeholders = ','.join('?' * len(chunk))
+            rows = self.connection.execute(
+                f"SELECT rsid, status, merged_into FROM refsnp_status WHERE build = ? AND rsid IN ({placeholders})",
+                [self.build] + chunk
+            )
+            for rsid, status, merged_into in rows:
+                results[rsid] = (status, merged_into)
+
+        return results
+
+    def put_refsnp_status(self, statuses):
+        """
+        Store the dbSNP status of rsIDs.
+
+        :param statuses: Dict mapping rsID numbers to (status, merged_into) tuples
+        """
+        now = time.time()
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO refsnp_status (rsid, build, status, merged_into, checked_at) VALUES (?, ?, ?, ?, ?)",
+            [(rsid, self.build, status, merged_into, now) for rsid, (status, merged_into) in statuses.items()]
+        )
+        self.connection.commit()
+
+    def get_placements(self, rsids, not_found_ttl_days=DEFAULT_NOT_FOUND_TTL_DAYS):
+        """
+        Look up the cached GRCh38 SPDI placements of rsIDs.
+
+        :param rsids: Iterable of rsID numbers
+        :param not_found_ttl_days: Ignore "no placement" answers older than this many days (None for no expiry)
+        :return: Dict mapping cached rsID numbers to lists of SPDI strings (empty for "no placement")
+        """
+        rsids = list(dict.fromkeys(rsids))
+        oldest = time.time() - not_found_ttl_days * 86400 if not_found_ttl_days is not None else 0
+        results = {}
+
+        for i in range(0, len(rsids), 500):
+            chunk = rsids[i:i + 500]
+            placeholders = ','.join('?' * len(chunk))
+            rows = self.connection.execute(
+                f"SELECT rsid, spdis FROM refsnp_placements WHERE build = ? AND rsid IN ({placeholders}) "
+                f"AND (spdis != '' OR checked_at >= ?)",
+                [self.build] + chunk + [oldest]
+            )
+            for rsid, spdis in rows:
+                results[rsid] = spdis.split(',') if spdis else []
+
+        return results
+
+    def put_placements(self, placements):
+        """
+        Store the GRCh38 SPDI placements of rsIDs.
+
+        :param placements: Dict mapping rsID numbers to lists of SPDI strings (empty for "no placement")
+        """
+        now = time.time()
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO refsnp_placements (rsid, build, spdis, checked_at) VALUES (?, ?, ?, ?)",
+            [(rsid, self.build, ','.join(spdis), now) for rsid, spdis in placements.items()]
+        )
+        self.connection.commit()
@@ -0,0 +1,77 @@
+"""
+Helpers for grouping blood group variants into genomic loci.
+
+Almost all variants in the database fall in a few dozen blood group gene loci
+(ABO, RHD, RHCE, KEL, FUT2, ...). The annotation scripts use these helpers to
+turn per-variant lookups into per-locus lookups using GRCh38 coordinates.
+
+Author: Nick Gleadall
+Date: November 2025
+"""
+
+import pandas as pd
+
+# Variants further apart than this (bp) are split into separate loci
+DEFAULT_MAX_SPAN = 50000
+
+
+def normalize_chromosome(chrom):
+    """
+    Normalize a chromosome name to the bare form used by gnomAD (1-22, X, Y, MT).
+
+    :param chrom: Chromosome name, with or without 'chr' prefix
+    :return: Chromosome name without prefix
+    """
+    chrom = str(chrom).strip()
+    for prefix in ('chr', 'Chr', 'CHR'):
+        if chrom.startswith(prefix):
+            chrom = chrom[len(prefix):]
+    return 'MT' if chrom == 'M' else chrom
+
+
+def group_variants_by_locus(variants, max_span=DEFAULT_MAX_SPAN, padding=0):
+    """
+    Group variants into loci of nearby GRCh38 positions.
+
+    Variants are sorted by chromosome and position, and a new locus is started whenever
+    the next variant would make the current locus span more than max_span bp.
+    Variants with missing coordinates are ignored.
+
+    :param variants: Pandas DataFrame with grch38_chr, grch38_pos and (optionally) grch38_ref columns
+    :param max_span: Maximum distance (bp) between the first and last variant of a locus
+    :param padding: Number of bp to add on either side of each locus
+    :return: List of dicts with 'chrom', 'start', 'stop' (1-based, inclusive) and 'index' (DataFrame index labels)
+    """
+    coords = variants[variants['grch38_chr'].notna() & variants['grch38_pos'].notna()]
+    if coords.empty:
+        return []
+
+    chroms = coords['grch38_chr'].map(normalize_chromosome)
+    starts = coords['grch38_pos'].astype(float).astype(int)
+    if 'grch38_ref' in coords.columns:
+        ref_lengths = coords['grch38_ref'].map(lambda ref: len(str(ref)) if pd.notna(ref) else 1)
+    else:
+        ref_lengths = pd.Series(1, index=coords.index)
+    stops = starts + ref_lengths - 1
+
+    table = pd.DataFrame({'chrom': chroms, 'start': starts, 'stop': stops}, index=coords.index)
+    table = table.sort_values(['chrom', 'start'], kind='stable')
+
+    loci = []
+    current = None
+    for index, chrom, start, stop in zip(table.index, table['chrom'], table['start'], table['stop']):
+        if current is None or chrom != current['chrom'] or stop - current['first'] > max_span:
+            current = {'chrom': chrom, 'first': start, 'start': start, 'stop': stop, 'index': []}
+            loci.append(current)
+        current['stop'] = max(current['stop'], stop)
+        current['index'].append(index)
+
+    return [
+        {
+            'chrom': locus['chrom'],
+            'start': max(1, locus['start'] - padding),
+            'stop': locus['stop'] + padding,
+            'index': locus['index']
+        }
+        for locus in loci
+    ]
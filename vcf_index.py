@@ -0,0 +1,227 @@
+"""
+Persistent region index for bgzipped, position-sorted VCF files.
+
+Full gnomAD and dbSNP sites VCFs are many GB in size, but the annotation scripts only need
+records inside the blood group gene loci. Instead of scanning whole files, the start of each
+locus is located by binary search over the BGZF blocks, and the block offset is saved to a
+small JSON index next to the VCF. Later runs seek straight to the records of each locus.
+
+The index is extended automatically when variants fall outside the indexed regions, and
+rebuilt if the VCF file changes (size or modification time).
+
+Author: Nick Gleadall
+Date: November 2025
+"""
+
+import json
+import logging
+import os
+
+from bgzf import MAX_BLOCK_SIZE, BgzfReader
+from variant_regions import normalize_chromosome
+
+logger = logging.getLogger(__name__)
+
+# Sort order of chromosomes when the VCF header has no ##contig lines
+CHROMOSOME_ORDER = [str(i) for i in range(1, 23)] + ['X', 'Y', 'MT']
+
+INDEX_SUFFIX = '.isbt-index.json'
+
+
+def read_contig_order(reader):
+    """
+    Read the contig order from the ##contig header lines of a VCF.
+
+    :param reader: BgzfReader for the VCF
+    :return: List of normalized chromosome names in file order
+    """
+    contigs = []
+    for line in reader.iter_lines(0):
+        if not line.startswith(b'#'):
+            break
+        if line.startswith(b'##contig=<'):
+            for field in line[len(b'##contig=<'):].rstrip(b'>').split(b','):
+                if field.startswith(b'ID='):
+                    contigs.append(normalize_chromosome(field[3:].decode()))
+                    break
+    return contigs or list(CHROMOSOME_ORDER)
+
+
+def record_key(line, contig_ranks):
+    """
+    Sort key (contig rank, position) of a VCF record line.
+
+    :param line: VCF record line (bytes)
+    :param contig_ranks: Dict mapping normalized chromosome names to their rank
+    :return: Tuple of (rank, position)
+    """
+    chrom, pos = line.split(b'\t', 2)[:2]
+    return contig_ranks.get(normalize_chromosome(chrom.decode()), len(contig_ranks)), int(pos)
+
+
+def first_record_key(reader, offset, contig_ranks):
+    """
+    Find the first block at or after offset and the sort key of its first complete record.
+
+    :param reader: BgzfReader for the VCF
+    :param offset: Any compressed file offset
+    :param contig_ranks: Dict mapping normalized chromosome names to their rank
+    :return: Tuple of (block offset, key); key is (-1, 0) inside the header and None at end of file
+    """
+    block = reader.find_block(offset)
+    if block is None:
+        return None, None
+    for line in reader.iter_lines(block, skip_partial=True):
+        if line.startswith(b'#'):
+            return block, (-1, 0)
+        return block, record_key(line, contig_ranks)
+    return block, None
+
+
+def find_region_offset(reader, contig_ranks, chrom, start):
+    """
+    Binary search for a block offset from which reading reaches every record at or after chrom:start.
+
+    :param reader: BgzfReader for the VCF
+    :param contig_ranks: Dict mapping normalized chromosome names to their rank
+    :param chrom: Normalized chromosome name
+    :param start: Region start (1-based)
+    :return: Compressed block offset to start reading from
+    """
+    target = (contig_ranks.get(chrom, len(contig_ranks)), start)
+    lo, hi, best = 0, reader.size, 0
+
+    while hi - lo > MAX_BLOCK_SIZE:
+        mid = (lo + hi) // 2
+        block, key = first_record_key(reader, mid, contig_ranks)
+        if block is None or key is None or key >= target:
+            hi = mid
+        else:
+            best = block
+            lo = block
+
+    return best
+
+
+def iter_region(reader, offset, contig_ranks, chrom, start, stop):
+    """
+    Iterate over the VCF records of a region, starting from an indexed block offset.
+
+    :param reader: BgzfReader for the VCF
+    :param offset: Block offset from the region index
+    :param contig_ranks: Dict mapping normalized chromosome names to their rank
+    :param chrom: Normalized chromosome name
+    :param start: Region start (1-based, inclusive)
+    :param stop: Region end (1-based, inclusive)
+    :return: Generator of record lines (bytes)
+    """
+    if chrom not in contig_ranks:
+        return
+    first, last = (contig_ranks[chrom], start), (contig_ranks[chrom], stop)
+    for line in reader.iter_lines(offset, skip_partial=offset > 0):
+        if not line or line.startswith(b'#'):
+            continue
+        key = record_key(line, contig_ranks)
+        if key < first:
+            continue
+        if key > last:
+            break
+        yield line
+
+
+def get_index_path(vcf_path, index_dir=None):
+    """
+    Path of the region index file for a VCF.
+
+    :param vcf_path: Path to the bgzipped VCF
+    :param index_dir: Directory for index files (default: next to the VCF)
+    :return: Path of the index file
+    """
+    if index_dir:
+        return os.path.join(index_dir, os.path.basename(vcf_path) + INDEX_SUFFIX)
+    return vcf_path + INDEX_SUFFIX
+
+
+def load_region_index(vcf_path, index_dir=None):
+    """
+    Load the region index for a VCF, discarding it if the VCF has changed since it was built.
+
+    :param vcf_path: Path to the bgzipped VCF
+    :param index_dir: Directory for index files (default: next to the VCF)
+    :return: Index dict with 'vcf_size', 'vcf_mtime', 'contigs' and 'regions', or None
+    """
+    index_path = get_index_path(vcf_path, index_dir)
+    if not os.path.exists(index_path):
+        return None
+
+    with open(index_path) as f:
+        index = json.load(f)
+
+    stat = os.stat(vcf_path)
+    if index.get('vcf_size') != stat.st_size or index.get('vcf_mtime') != int(stat.st_mtime):
+        logger.info(f"VCF changed since index was built, rebuilding: {vcf_path}")
+        return None
+
+    return index
+
+
+def save_region_index(vcf_path, index, index_dir=None):
+    """
+    Save the region index for a VCF.
+
+    :param vcf_path: Path to the bgzipped VCF
+    :param index: Index dict
+    :param index_dir: Directory for index files (default: next to the VCF)
+    """
+    index_path = get_index_path(vcf_path, index_dir)
+    tmp_path = index_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f, indent=1)
+    os.replace(tmp_path, index_path)
+
+
+def read_regions(vcf_path, loci, index_dir=None):
+    """
+    Read the VCF records of each locus, using (and extending) the persisted region index.
+
+    :param vcf_path: Path to the bgzipped VCF
+    :param loci: List of dicts with 'chrom', 'start' and 'stop' (see group_variants_by_locus)
+    :param index_dir: Directory for index files (default: next to the VCF)
+    :return: Generator of (locus, list of record lines) tuples
+    """
+    with BgzfReader(vcf_path) as reader:
+        index = load_region_index(vcf_path, index_dir)
+        if index is None:
+            stat = os.stat(vcf_path)
+            index = {
+                'vcf_size': stat.st_size,
+                'vcf_mtime': int(stat.st_mtime),
+                'contigs': read_contig_order(reader),
+                'regions': []
+            }
+
+        contig_ranks = {chrom: rank for rank, chrom in enumerate(index['contigs'])}
+        index_changed = False
+
+        try:
+            for locus in loci:
+                region = next((region for region in index['regions']
+                               if region['chrom'] == locus['chrom'] and
+                               region['start'] <= locus['start'] and locus['stop'] <= region['stop']), None)
+                if region is None:
+                    region = {
+                        'chrom': locus['chrom'],
+                        'start': locus['start'],
+                        'stop': locus['stop'],
+                        'offset': find_region_offset(reader, contig_ranks, locus['chrom'], locus['start'])
+                    }
+                    index['regions'].append(region)
+                    index_changed = True
+
+                lines = list(iter_region(reader, region['offset'], contig_ranks,
+                                         locus['chrom'], locus['start'], locus['stop']))
+                yield locus, lines
+        finally:
+            if index_changed:
+                save_region_index(vcf_path, index, index_dir)
+                logger.info(f"Saved region index ({len(index['regions'])} regions): {get_index_path(vcf_path, index_dir)}")
@@ -0,0 +1,151 @@
+"""
+Persistent on-disk cache of VariantValidator exon/intron answers.
+
+annotate_exons.py stores the raw variant_exonic_positions payload of every VariantValidator
+answer, keyed by the submitted hgvs_transcript, the genome build and the VariantValidator
+release (software, database and transcript archive versions, read from the /hello endpoint).
+Negative answers are kept too: a rejected description (4xx status), a response without the
+submitted transcript and a response without exonic positions are stored with their reason.
+Reruns, including --overwrite-all and --clear-not-found, then replay every known answer
+locally and only query VariantValidator for new or changed HGVS strings.
+
+Answers of other releases are ignored, so a new VariantValidator release re-checks every variant.
+Without a known release the cache is neither read nor written, because answers of an older
+release (negative ones in particular) could clear data that the current release would keep.
+
+Author: Nick Gleadall
+Date: November 2025
+"""
+
+import json
+import logging
+import sqlite3
+import time
+
+import requests
+
+from http_client import get_with_retries
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_PATH = "variantvalidator_cache.sqlite"
+
+# Genome build that VariantValidator is queried with
+GENOME_BUILD = "GRCh38"
+
+HELLO_URL = "https://rest.variantvalidator.org/hello/"
+
+
+def fetch_vv_release(session):
+    """
+    Read the current VariantValidator release from its /hello endpoint.
+
+    :param session: Requests session object
+    :return: Release label (e.g. 'vv:3.0.2|vvdb:vvdb_2025_3|vvta:vvta_2025_02'), or None if unavailable
+    """
+    try:
+        response = get_with_retries(session, HELLO_URL, params={"content-type": "application/json"}, timeout=30)
+        response.raise_for_status()
+        metadata = response.json().get("metadata") or {}
+    except (requests.exceptions.RequestException, ValueError) as e:
+        logger.warning(f"Could not read the VariantValidator release: {str(e)[:100]}")
+        return None
+
+    versions = [(label, metadata.get(key)) for label, key in (('vv', 'variantvalidator_version'),
+                                                              ('vvdb', 'vvdb_version'),
+                                                              ('vvta', 'vvta_version'))]
+    if not any(version for _, version in versions):
+        return None
+    return '|'.join(f"{label}:{version}" for label, version in versions)
+
+
+class VariantValidatorCache:
+    """
+    SQLite-backed store of VariantValidator exon/intron answers for one genome build and release.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, release=None, build=GENOME_BUILD):
+        """
+        :param path: Path to the SQLite cache file (created if it doesn't exist)
+        :param release: VariantValidator release label that answers are stored under (None: cache disabled)
+        :param build: Genome build that answers are stored under
+        """
+        self.path = path
+        self.build = build
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS vv_exonic_positions (
+                hgvs TEXT NOT NULL,
+                build TEXT NOT NULL,
+                release TEXT NOT NULL,
+                positions TEXT,
+                reason TEXT,
+                fetched_at REAL NOT NULL,
+                PRIMARY KEY (hgvs, build, release)
+            )
+        """)
+        self.connection.commit()
+
+        self.release = release
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def latest_release(self):
+        """
+        Release label of the most recently stored answer for the cache's genome build, or None.
+        """
+        row = self.connection.execute(
+            "SELECT release FROM vv_exonic_positions WHERE build = ? ORDER BY fetched_at DESC LIMIT 1",
+            [self.build]
+        ).fetchone()
+        return row[0] if row else None
+
+    def get_many(self, descriptions):
+        """
+        Look up cached answers.
+
+        :param descriptions: Iterable of HGVS transcript descriptions
+        :return: Dict mapping cached descriptions to (variant_exonic_positions dict or None, reason or None) tuples
+        """
+        descriptions = list(dict.fromkeys(descriptions))
+        results = {}
+        if self.release is None:
+            return results
+
+        # SQLite limits the number of bound parameters per statement
+        for i in range(0, len(descriptions), 500):
+            chunk = descriptions[i:i + 500]
+            placeholders = ','.join('?' * len(chunk))
+            rows = self.connection.execute(
+                f"SELECT hgvs, positions, reason FROM vv_exonic_positions "
+                f"WHERE build = ? AND release = ? AND hgvs IN ({placeholders})",
+                [self.build, self.release] + chunk
+            )
+            for hgvs, positions, reason in rows:
+                results[hgvs] = (json.loads(positions) if positions else None, reason)
+
+        return results
+
+    def put_many(self, answers):
+        """
+        Store answers (ignored without a release).
+
+        :param answers: Dict mapping descriptions to (variant_exonic_positions dict or None, reason or None) tuples
+        """
+        if self.release is None or not answers:
+            return
+        now = time.time()
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO vv_exonic_positions (hgvs, build, release, positions, reason, fetched_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            [(hgvs, self.build, self.release, json.dumps(positions) if positions else None, reason, now)
+             for hgvs, (positions, reason) in answers.items()]
+        )
+        self.connection.commit()